@@ -0,0 +1,54 @@
+import os
+import stat
+from pathlib import Path
+from typing import Optional
+
+# A plain sh script, so the stub costs about as much to spawn as a small
+# binary and does not add an interpreter start to every call.
+SCRIPT = '''#!/bin/sh
+if [ -n "$FAKE_COMPOSE_LOG" ]; then
+    echo "$*" >> "$FAKE_COMPOSE_LOG"
+fi
+sleep "${FAKE_COMPOSE_LATENCY:-0}"
+echo "fake docker-compose $*"
+rate="${FAKE_COMPOSE_FAILURE_RATE:-0}"
+if [ "$rate" != "0" ]; then
+    roll=$(od -An -N2 -tu2 /dev/urandom | tr -d ' ')
+    if awk -v roll="$roll" -v rate="$rate" 'BEGIN { exit !(roll / 65536 < rate) }'; then
+        echo "fake failure" >&2
+        exit 1
+    fi
+fi
+exit 0
+'''
+
+
+def install(bin_dir: Path, latency: float = 0.0, failure_rate: float = 0.0) -> Path:
+    """Put a stub `docker-compose` first on PATH.
+
+    Every call sleeps `latency` seconds and fails with probability
+    `failure_rate`.
+    """
+    bin_dir.mkdir(parents=True, exist_ok=True)
+    script = bin_dir / 'docker-compose'
+    script.write_text(SCRIPT)
+    script.chmod(script.stat().st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}"
+    os.environ['FAKE_COMPOSE_LATENCY'] = str(latency)
+    os.environ['FAKE_COMPOSE_FAILURE_RATE'] = str(failure_rate)
+    return script
+
+
+def log_calls(log_file: Optional[Path]):
+    """Append the arguments of every following call to `log_file`, None stops logging."""
+    if log_file:
+        os.environ['FAKE_COMPOSE_LOG'] = str(log_file)
+    else:
+        os.environ.pop('FAKE_COMPOSE_LOG', None)
+
+
+def call_count(log_file: Path) -> int:
+    if not log_file.exists():
+        return 0
+    with open(log_file) as f:
+        return sum(1 for _ in f)
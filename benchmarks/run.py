@@ -0,0 +1,125 @@
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+from benchmarks import fake_compose, scenarios
+
+BENCHMARKS = ('reconcile', 'watch_storm', 'cron_jitter', 'web_refresh')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compose Mate benchmarks')
+    parser.add_argument(
+        '--only',
+        choices=BENCHMARKS,
+        action='append',
+        help='Benchmark to run, can be repeated (default: all)'
+    )
+    parser.add_argument(
+        '--output',
+        type=str,
+        default='benchmark-results.json',
+        help='File the JSON results are written to (default: benchmark-results.json)'
+    )
+    parser.add_argument(
+        '--latency',
+        type=float,
+        default=0.05,
+        help='Seconds every fake docker-compose call takes (default: 0.05)'
+    )
+    parser.add_argument(
+        '--failure-rate',
+        type=float,
+        default=0.0,
+        help='Probability that a fake docker-compose call fails (default: 0.0)'
+    )
+    parser.add_argument(
+        '--apps',
+        type=str,
+        default='10,100,1000',
+        help='Comma separated app counts of the reconcile benchmark (default: 10,100,1000)'
+    )
+    parser.add_argument(
+        '--storm-events',
+        type=int,
+        default=10000,
+        help='File events of the watcher storm benchmark (default: 10000)'
+    )
+    parser.add_argument(
+        '--cron-tasks',
+        type=int,
+        default=50,
+        help='Tasks firing every second in the cron jitter benchmark (default: 50)'
+    )
+    parser.add_argument(
+        '--cron-duration',
+        type=float,
+        default=10.0,
+        help='Seconds the cron jitter benchmark runs (default: 10)'
+    )
+    parser.add_argument(
+        '--sessions',
+        type=str,
+        default='1,10,50',
+        help='Comma separated web session counts (default: 1,10,50)'
+    )
+    parser.add_argument(
+        '--parallelism',
+        type=int,
+        default=4,
+        help='Number of apps reconciled concurrently (default: 4)'
+    )
+    return parser.parse_args()
+
+
+def _revision() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'],
+                              capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def main():
+    args = parse_args()
+    selected = args.only or BENCHMARKS
+    options = {'parallelism': args.parallelism}
+
+    results = {
+        'revision': _revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'started_at': datetime.now().isoformat(),
+        'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+        'results': {},
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        fake_compose.install(Path(tmp) / 'bin', args.latency, args.failure_rate)
+        for name in selected:
+            print(f"Running {name}...", file=sys.stderr)
+            if name == 'reconcile':
+                result = scenarios.bench_reconcile(
+                    [int(count) for count in args.apps.split(',')], **options)
+            elif name == 'watch_storm':
+                result = scenarios.bench_watch_storm(events=args.storm_events, **options)
+            elif name == 'cron_jitter':
+                result = scenarios.bench_cron_jitter(args.cron_tasks, args.cron_duration, **options)
+            else:
+                result = scenarios.bench_web_refresh(
+                    sessions=[int(count) for count in args.sessions.split(',')], **options)
+            results['results'][name] = result
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
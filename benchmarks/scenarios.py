@@ -0,0 +1,297 @@
+import asyncio
+import json
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List
+
+import yaml
+from watchdog.events import FileModifiedEvent
+
+from benchmarks import fake_compose
+from compose_mate.core.events import CONFIG_CHANGED, TASK_FINISHED
+from compose_mate.core.manager import ComposeManager, ConfigChangeHandler
+
+# Never fires during a benchmark
+IDLE_CRON = '0 0 1 1 *'
+
+
+def summarize(samples: List[float]) -> Dict[str, float]:
+    """Return count, mean and percentiles of a list of samples."""
+    if not samples:
+        return {'count': 0}
+    ordered = sorted(samples)
+
+    def percentile(p: float) -> float:
+        return ordered[min(int(p * len(ordered)), len(ordered) - 1)]
+
+    return {
+        'count': len(ordered),
+        'mean': statistics.fmean(ordered),
+        'p50': percentile(0.50),
+        'p95': percentile(0.95),
+        'p99': percentile(0.99),
+        'max': ordered[-1],
+    }
+
+
+def generate_repo(root: Path, app_count: int, tasks_per_app: int = 1) -> Path:
+    """Write a repository of `app_count` apps, each with a compose file and idle tasks."""
+    repo = root / 'repo'
+    apps = []
+    for i in range(app_count):
+        app_id = f"app-{i:04d}"
+        app_dir = repo / 'apps' / app_id
+        app_dir.mkdir(parents=True)
+        (app_dir / 'docker-compose.yaml').write_text(
+            f"services:\n  main:\n    image: busybox\n    command: sleep {i}\n"
+        )
+        apps.append({
+            'id': app_id,
+            'path': f"apps/{app_id}",
+            'tasks': [
+                {'id': f"task-{j}", 'cron': IDLE_CRON,
+                 'steps': [{'type': 'compose_run', 'compose_service': 'main'}]}
+                for j in range(tasks_per_app)
+            ],
+        })
+    (repo / 'docs').mkdir(parents=True)
+    with open(repo / '.cm.yaml', 'w') as f:
+        yaml.safe_dump({'apps': apps}, f)
+    return repo
+
+
+def create_manager(root: Path, repo: Path, **options) -> ComposeManager:
+    """Create a manager and wait until its startup reconcile finished."""
+    options.setdefault('docker_backend', 'cli')
+    manager = ComposeManager(str(repo), str(root / 'state'), **options)
+    manager.startup_reconcile.result()
+    return manager
+
+
+def bench_reconcile(app_counts: List[int], repeat: int = 3, **options) -> List[dict]:
+    """Reconcile latency against the number of apps.
+
+    `startup` includes the first reconcile, which brings every app up.
+    `noop` reconciles with nothing changed, `one_changed` after changing the
+    command of a single service.
+    """
+    results = []
+    for app_count in app_counts:
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            repo = generate_repo(root, app_count)
+            calls = root / 'compose-calls.log'
+            fake_compose.log_calls(calls)
+
+            started = time.perf_counter()
+            manager = create_manager(root, repo, **options)
+            startup = time.perf_counter() - started
+            startup_calls = fake_compose.call_count(calls)
+            try:
+                noop, one_changed = [], []
+                for i in range(repeat):
+                    started = time.perf_counter()
+                    manager.reconcile()
+                    noop.append(time.perf_counter() - started)
+
+                    compose_file = repo / 'apps' / 'app-0000' / 'docker-compose.yaml'
+                    compose_file.write_text(compose_file.read_text().replace(
+                        'command: sleep', f"command: sleep {i} &&"))
+                    started = time.perf_counter()
+                    manager.reconcile({compose_file.relative_to(repo).as_posix()})
+                    one_changed.append(time.perf_counter() - started)
+            finally:
+                manager.stop()
+
+            results.append({
+                'apps': app_count,
+                'startup_seconds': startup,
+                'startup_compose_calls': startup_calls,
+                'noop_seconds': summarize(noop),
+                'one_changed_seconds': summarize(one_changed),
+                'compose_calls': fake_compose.call_count(calls),
+            })
+    return results
+
+
+def bench_watch_storm(app_count: int = 100, events: int = 10000, changed_apps: int = 10,
+                      **options) -> dict:
+    """Throughput of ConfigChangeHandler when a burst of file events arrives.
+
+    Half of the events touch files of `changed_apps` edited apps, the rest
+    paths outside of any app. Reports how fast events are accepted and how
+    long it takes until the resulting reconcile finished.
+    """
+    options.setdefault('watch_quiet_window', 0.2)
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        repo = generate_repo(root, app_count)
+        calls = root / 'compose-calls.log'
+        fake_compose.log_calls(None)
+        manager = create_manager(root, repo, **options)
+        try:
+            fake_compose.log_calls(calls)
+            reconciled = threading.Event()
+            batches = []
+            callback = manager.reconcile_queue.callback
+
+            def on_reconcile(paths):
+                callback(paths)
+                batches.append(len(paths))
+                reconciled.set()
+
+            manager.reconcile_queue.callback = on_reconcile
+            handler = ConfigChangeHandler(manager, manager.change_coalescer)
+
+            app_files = []
+            for i in range(changed_apps):
+                compose_file = repo / 'apps' / f"app-{i:04d}" / 'docker-compose.yaml'
+                # a comment alone would not touch any service
+                compose_file.write_text(compose_file.read_text().replace('busybox', 'busybox:edited'))
+                app_files.append(str(compose_file))
+            noise = [str(repo / 'docs' / f"page-{i}.md") for i in range(100)]
+
+            started = time.perf_counter()
+            for i in range(events):
+                paths = app_files if i % 2 == 0 else noise
+                handler.on_modified(FileModifiedEvent(paths[i // 2 % len(paths)]))
+            dispatched = time.perf_counter()
+            reconciled.wait(timeout=600)
+            settled = time.perf_counter()
+            compose_calls = fake_compose.call_count(calls)
+        finally:
+            manager.stop()
+
+    return {
+        'apps': app_count,
+        'events': events,
+        'changed_apps': changed_apps,
+        'dispatch_seconds': dispatched - started,
+        'events_per_second': events / max(dispatched - started, 1e-9),
+        'settle_seconds': settled - dispatched,
+        'reconcile_batches': batches,
+        'compose_calls': compose_calls,
+    }
+
+
+def bench_cron_jitter(task_count: int = 50, duration: float = 10.0, **options) -> dict:
+    """Delay between a task's planned fire time and the start of its run.
+
+    Every task fires each second, so runs pile up on the scheduler, the
+    runner loop and the fake docker-compose at the same time.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        repo = generate_repo(root, task_count)
+        fake_compose.log_calls(None)
+        manager = create_manager(root, repo, **options)
+        try:
+            tasks = list(manager.config_store.snapshot().tasks_by_key.values())
+            for app, task in tasks:
+                manager.scheduler.add_job(manager.executor.trigger_task, 'cron', second='*',
+                                          args=[app, task], id=f"bench-{app.id}-{task.id}")
+            time.sleep(duration)
+            for app, task in tasks:
+                manager.scheduler.remove_job(f"bench-{app.id}-{task.id}")
+            # let started runs finish before reading the history
+            while manager.executor.running_count() or manager.executor.queue.depth():
+                time.sleep(0.1)
+
+            lags, statuses = [], {}
+            for app, task in tasks:
+                for run in manager.store.recent_runs(app.id, task.id, limit=int(duration) + 5):
+                    # runs are planned on whole seconds
+                    started_at = datetime.fromisoformat(run.started_at)
+                    lags.append(started_at.microsecond / 1e6)
+                    statuses[run.status] = statuses.get(run.status, 0) + 1
+        finally:
+            manager.stop()
+
+    return {
+        'tasks': task_count,
+        'duration_seconds': duration,
+        'planned_runs': int(task_count * duration),
+        'runs': statuses,
+        'lag_seconds': summarize(lags),
+    }
+
+
+def bench_web_refresh(app_count: int = 100, sessions: List[int] = (1, 10, 50),
+                      **options) -> List[dict]:
+    """Server-side cost of rendering the page for each open web session.
+
+    Sessions run the real page coroutine in-process without a browser.
+    Measures the first render, then a redraw after one task changed and
+    after the config changed, which redraws the whole tree.
+    """
+    from pywebio.session import register_session_implement_for_target
+    from pywebio.session.base import get_session_info_from_headers
+
+    from compose_mate.web.app import REDRAW_INTERVAL, WebInterface
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp)
+        repo = generate_repo(root, app_count)
+        fake_compose.log_calls(None)
+        manager = create_manager(root, repo, **options)
+        web_interface = WebInterface(manager)
+        session_cls = register_session_implement_for_target(web_interface.index)
+        first_app = manager.config_store.snapshot().apps[0]
+
+        async def measure(session_count: int) -> dict:
+            sent = {}
+            last_sent = [0.0]
+
+            def on_task_command(session):
+                commands = session.get_task_commands()
+                sent[id(session)] = sent.get(id(session), 0) + len(json.dumps(commands, default=str))
+                last_sent[0] = time.perf_counter()
+
+            async def render(action) -> tuple:
+                """Run `action`, wait until every session stopped sending, return time and bytes."""
+                sent.clear()
+                started = time.perf_counter()
+                result = action()
+                idle = 0
+                while idle < 10 or len(sent) < session_count:
+                    before = sum(sent.values())
+                    await asyncio.sleep(0)
+                    idle = idle + 1 if sum(sent.values()) == before else 0
+                    if time.perf_counter() - started > 60:
+                        raise TimeoutError('Web sessions did not render within 60s')
+                return result, last_sent[0] - started, sum(sent.values())
+
+            opened, first_seconds, first_bytes = await render(lambda: [
+                session_cls(web_interface.index, get_session_info_from_headers({}),
+                            on_task_command=on_task_command)
+                for _ in range(session_count)
+            ])
+
+            await asyncio.sleep(REDRAW_INTERVAL + 0.1)
+            _, task_seconds, task_bytes = await render(lambda: manager.events.publish(
+                TASK_FINISHED, first_app.id, first_app.tasks[0].id))
+            await asyncio.sleep(REDRAW_INTERVAL + 0.1)
+            _, tree_seconds, tree_bytes = await render(lambda: manager.events.publish(CONFIG_CHANGED))
+            for session in opened:
+                session.close()
+
+            return {
+                'apps': app_count,
+                'sessions': session_count,
+                'first_render_seconds_per_session': first_seconds / session_count,
+                'first_render_bytes_per_session': first_bytes / session_count,
+                'task_update_seconds_per_session': task_seconds / session_count,
+                'task_update_bytes_per_session': task_bytes / session_count,
+                'full_redraw_seconds_per_session': tree_seconds / session_count,
+                'full_redraw_bytes_per_session': tree_bytes / session_count,
+            }
+
+        try:
+            return [asyncio.run(measure(count)) for count in sessions]
+        finally:
+            manager.stop()
+
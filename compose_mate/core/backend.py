@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+import yaml
+
+from compose_mate.core.docker_api import (DockerClient, DockerAPIError, Exec, ONEOFF_LABEL,
+                                         PROJECT_LABEL)
+from compose_mate.core.fingerprint import find_compose_files
+from compose_mate.core.runner import CommandError, ProcessRunner, TAIL_LINES
+
+
+def project_name(app_path: Path) -> str:
+    """Resolve the compose project name the same way docker compose does."""
+    name = None
+    for compose_file in find_compose_files(app_path):
+        try:
+            if compose_file.name == '.env':
+                with open(compose_file) as f:
+                    for line in f:
+                        key, _, value = line.strip().partition('=')
+                        if key == 'COMPOSE_PROJECT_NAME' and value:
+                            return value.strip('\'"')
+            else:
+                # later files override the name of earlier ones
+                with open(compose_file) as f:
+                    name = (yaml.safe_load(f) or {}).get('name') or name
+        except (OSError, yaml.YAMLError, AttributeError):
+            continue
+    if not name:
+        name = os.path.basename(os.path.abspath(app_path))
+    return re.sub(r'[^a-z0-9_-]', '', name.lower())
+
+
+class CliBackend:
+    """Talks to docker through the docker-compose CLI, one process per call."""
+
+    def __init__(self, runner: ProcessRunner):
+        self.runner = runner
+
+    def _compose(self, app_path: Path, *args: str) -> List[str]:
+        return ["docker-compose", "--project-directory", str(app_path), *args]
+
+    async def up(self, app_path: Path, logger: logging.Logger,
+                 build: Optional[List[str]] = None, services: Optional[List[str]] = None):
+        """Bring an app up, rebuilding the images of `build` services first.
+
+        With `build` None every service with a build section is rebuilt.
+        Otherwise only `services` are brought up if given, all if not.
+        """
+        if build is None:
+            await self.runner.run(self._compose(app_path, "up", "-d", "--build"), logger,
+                                  name="compose up")
+            return
+        if build:
+            await self.runner.run(self._compose(app_path, "build", *build), logger,
+                                  name="compose build")
+        await self.runner.run(self._compose(app_path, "up", "-d", "--no-build", *(services or ())),
+                              logger, name="compose up")
+
+    async def down(self, app_path: Path, logger: logging.Logger):
+        await self.runner.run(self._compose(app_path, "down"), logger, name="compose down")
+
+    async def up_service(self, app_path: Path, service: str, logger: logging.Logger):
+        """Recreate the containers of one service, leaving the rest of the app alone."""
+        await self.runner.run(
+            self._compose(app_path, "up", "-d", "--no-build", "--no-deps", "--force-recreate", service),
+            logger,
+            name="compose up"
+        )
+
+    async def run(self, app_path: Path, service: str, logger: logging.Logger,
+                  timeout: Optional[float] = None, labels: Optional[Dict[str, str]] = None):
+        label_args = [arg for key, value in (labels or {}).items() for arg in ("--label", f"{key}={value}")]
+        await self.runner.run(self._compose(app_path, "run", "--rm", *label_args, service), logger,
+                              timeout=timeout, name="compose run")
+
+    async def exec(self, app_path: Path, service: str, command: List[str],
+                   logger: logging.Logger, timeout: Optional[float] = None) -> str:
+        result = await self.runner.run(self._compose(app_path, "exec", "-T", service, *command),
+                                       logger, timeout=timeout, name="compose exec")
+        return result.output
+
+    async def service_image(self, app_path: Path, service: str) -> Optional[str]:
+        """Return the image ID of a running service, None if it can't be found cheaply."""
+        return None
+
+    async def running_services(self, app_path: Path) -> Dict[str, int]:
+        """Return the number of running containers per service of an app."""
+        result = await self.runner.run(
+            self._compose(app_path, "ps", "--services", "--status", "running"),
+            logging.getLogger('compose_mate.backend'),
+            name="compose ps"
+        )
+        return {service: 1 for service in result.output.split() if service}
+
+    async def running_projects(self) -> Optional[Set[str]]:
+        """Return the names of all compose projects with running containers.
+
+        One call covers every app. Returns None when the installed
+        docker-compose can't list projects.
+        """
+        try:
+            result = await self.runner.run(
+                ["docker-compose", "ls", "--format", "json"],
+                logging.getLogger('compose_mate.backend'),
+                name="compose ls"
+            )
+            projects = json.loads(result.output)
+        except (CommandError, ValueError):
+            return None
+        return {project['Name'] for project in projects
+                if 'running' in project.get('Status', '')}
+
+
+class EngineBackend(CliBackend):
+    """Uses the Docker Engine API for exec and container queries.
+
+    Compose projects are resolved through the labels compose puts on their
+    containers. Building, creating and removing containers still goes through
+    the CLI, which knows how to turn a compose file into containers.
+    """
+
+    def __init__(self, runner: ProcessRunner, client: DockerClient):
+        super().__init__(runner)
+        self.client = client
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def service_container(self, app_path: Path, service: str) -> dict:
+        project = project_name(app_path)
+        containers = await self._call(self.client.project_containers, project)
+        for container in containers.get(service, []):
+            if (container.get('Labels') or {}).get(ONEOFF_LABEL) != 'True':
+                return container
+        raise CommandError(f"No running container for service {service} of project {project}")
+
+    async def service_image(self, app_path: Path, service: str) -> Optional[str]:
+        container = await self.service_container(app_path, service)
+        return container.get('ImageID')
+
+    async def exec(self, app_path: Path, service: str, command: List[str],
+                   logger: logging.Logger, timeout: Optional[float] = None) -> str:
+        container = await self.service_container(app_path, service)
+        tail = deque(maxlen=TAIL_LINES)
+
+        def on_line(line: str, is_stderr: bool):
+            tail.append(line)
+            logger.log(logging.WARNING if is_stderr else logging.INFO, line)
+
+        try:
+            handle = await self._call(self.client.exec_create, container['Id'], command)
+            try:
+                exit_code = await self._call(handle.run, on_line, timeout)
+            except asyncio.CancelledError:
+                # the blocked thread and the process inside the container don't
+                # stop with the task, kill the process without waiting for it
+                asyncio.get_running_loop().run_in_executor(None, self._cancel_exec, handle, logger)
+                raise
+        except TimeoutError:
+            raise CommandError(f"Command timed out after {timeout}s: {' '.join(command)}",
+                               output='\n'.join(tail))
+        except (DockerAPIError, OSError) as e:
+            raise CommandError(f"Command failed: {e}", output='\n'.join(tail))
+
+        output = '\n'.join(tail)
+        if exit_code != 0:
+            raise CommandError(f"Command failed: {output}", exit_code, output)
+        return output
+
+    @staticmethod
+    def _cancel_exec(handle: Exec, logger: logging.Logger):
+        try:
+            handle.cancel()
+        except (DockerAPIError, OSError) as e:
+            logger.warning(f"Failed to kill the cancelled command: {e}")
+
+    async def running_services(self, app_path: Path) -> Dict[str, int]:
+        containers = await self._call(self.client.project_containers, project_name(app_path))
+        running = {}
+        for service, items in containers.items():
+            count = sum(1 for c in items if (c.get('Labels') or {}).get(ONEOFF_LABEL) != 'True')
+            if count:
+                running[service] = count
+        return running
+
+    async def running_projects(self) -> Optional[Set[str]]:
+        try:
+            containers = await self._call(self.client.list_containers, [PROJECT_LABEL])
+        except (DockerAPIError, OSError):
+            return None
+        return {(c.get('Labels') or {})[PROJECT_LABEL] for c in containers
+                if (c.get('Labels') or {}).get(ONEOFF_LABEL) != 'True'}
+
+
+def create_backend(kind: str, runner: ProcessRunner, socket_path: str,
+                   logger: logging.Logger) -> CliBackend:
+    """Create the backend for `kind` ('auto', 'engine' or 'cli').
+
+    'auto' picks the Engine API when the docker socket answers a ping.
+    """
+    if kind == 'cli':
+        return CliBackend(runner)
+
+    client = DockerClient(socket_path)
+    if kind == 'engine' or client.ping():
+        logger.info(f"Using Docker Engine API at {socket_path}")
+        return EngineBackend(runner, client)
+
+    logger.info("Docker socket not reachable, using the docker-compose CLI")
+    return CliBackend(runner)
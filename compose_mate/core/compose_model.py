@@ -0,0 +1,320 @@
+import hashlib
+import json
+import os
+import re
+import shlex
+import threading
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import yaml
+
+from compose_mate.core.fingerprint import HashCache, compose_files
+
+# Service keys whose lists are appended to, not replaced, when files are merged
+MERGED_LISTS = ('ports', 'expose', 'external_links', 'dns', 'dns_search', 'tmpfs', 'volumes',
+                'devices', 'secrets', 'configs', 'cap_add', 'cap_drop', 'env_file', 'networks')
+# Service keys written either as a list of KEY=VALUE or as a mapping
+KEY_VALUE_KEYS = ('environment', 'labels', 'extra_hosts', 'sysctls', 'annotations')
+# Top-level sections services refer to by name
+REFERENCED_SECTIONS = ('networks', 'volumes', 'configs', 'secrets')
+
+VARIABLE_RE = re.compile(r'\$(?:(\$)|\{([^}]*)\}|([A-Za-z_][A-Za-z0-9_]*))')
+EXPRESSION_RE = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)(?:(:?[-?+])(.*))?$', re.DOTALL)
+
+
+class ComposeModel(NamedTuple):
+    name: Optional[str]
+    # service -> effective definition, interpolated, extended and normalized
+    services: Dict[str, dict]
+    # service -> hash of its definition and of the networks etc. it uses
+    hashes: Dict[str, str]
+    # every file read besides the compose files of the project directory:
+    # files named by `extends`, then the services' env files
+    extra_files: Tuple[Path, ...]
+
+
+def read_env_file(path: Path) -> Dict[str, str]:
+    env = {}
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        return env
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('export '):
+            line = line[len('export '):]
+        key, sep, value = line.partition('=')
+        if not sep:
+            continue
+        value = value.strip()
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '\'"':
+            value = value[1:-1]
+        env[key.strip()] = value
+    return env
+
+
+def interpolate(value, env: Dict[str, str]):
+    """Replace $VAR, ${VAR}, ${VAR:-default}, ${VAR:?error} etc. in every string of `value`."""
+    if isinstance(value, dict):
+        return {key: interpolate(item, env) for key, item in value.items()}
+    if isinstance(value, list):
+        return [interpolate(item, env) for item in value]
+    if not isinstance(value, str):
+        return value
+
+    def substitute(match: re.Match) -> str:
+        if match.group(1):
+            return '$'
+        if match.group(3):
+            return env.get(match.group(3), '')
+        expression = EXPRESSION_RE.match(match.group(2))
+        if not expression:
+            raise ValueError(f"Invalid interpolation: {match.group(0)}")
+        name, operator, argument = expression.groups()
+        current = env.get(name)
+        if operator is None:
+            return current or ''
+        unset = current is None or (operator.startswith(':') and current == '')
+        if operator.endswith('-'):
+            return interpolate(argument, env) if unset else current
+        if operator.endswith('?'):
+            if unset:
+                raise ValueError(f"Required variable {name} is missing: {argument}")
+            return current
+        return '' if unset else interpolate(argument, env)
+
+    return VARIABLE_RE.sub(substitute, value)
+
+
+def _key_values(value, separators: str = '=') -> dict:
+    if isinstance(value, dict):
+        return {str(key): None if item is None else str(item) for key, item in value.items()}
+    result = {}
+    for item in value or ():
+        item = str(item)
+        positions = [item.find(sep) for sep in separators if sep in item]
+        if positions:
+            split = min(positions)
+            result[item[:split]] = item[split + 1:]
+        else:
+            result[item] = None
+    return result
+
+
+def normalize_service(service: dict) -> dict:
+    """Bring the equivalent spellings of a service to one form."""
+    service = dict(service or {})
+    for key in KEY_VALUE_KEYS:
+        if key in service:
+            # extra_hosts may also be written host:ip
+            service[key] = _key_values(service[key], '=:' if key == 'extra_hosts' else '=')
+    build = service.get('build')
+    if isinstance(build, str):
+        service['build'] = {'context': build}
+    if isinstance(service.get('build'), dict) and 'args' in service['build']:
+        service['build'] = {**service['build'], 'args': _key_values(service['build']['args'])}
+    if isinstance(service.get('env_file'), (str, dict)):
+        service['env_file'] = [service['env_file']]
+    depends_on = service.get('depends_on')
+    if isinstance(depends_on, list):
+        service['depends_on'] = {name: {'condition': 'service_started'} for name in depends_on}
+    networks = service.get('networks')
+    if isinstance(networks, list):
+        service['networks'] = {name: None for name in networks}
+    for key in ('command', 'entrypoint'):
+        if isinstance(service.get(key), str):
+            try:
+                service[key] = shlex.split(service[key])
+            except ValueError:
+                pass
+    return service
+
+
+def merge(base, override, key: Optional[str] = None):
+    """Merge two definitions like docker compose merges files and `extends`."""
+    if isinstance(base, dict) and isinstance(override, dict):
+        merged = dict(base)
+        for item_key, value in override.items():
+            merged[item_key] = merge(base[item_key], value, item_key) if item_key in base else value
+        return merged
+    if isinstance(base, list) and isinstance(override, list) and key in MERGED_LISTS:
+        return base + [item for item in override if item not in base]
+    return override
+
+
+class _Loader:
+    def __init__(self, app_path: Path, env: Dict[str, str]):
+        self.app_path = app_path
+        self.env = env
+        self.files: Dict[Path, dict] = {}
+        self.extra_files: List[Path] = []
+
+    def load(self, path: Path) -> dict:
+        path = path.resolve()
+        if path not in self.files:
+            with open(path) as f:
+                config = yaml.safe_load(f) or {}
+            if not isinstance(config, dict):
+                raise ValueError(f"{path.name} is not a mapping")
+            self.files[path] = interpolate(config, self.env)
+        return self.files[path]
+
+    def _rebase(self, entry, directory: Path):
+        if isinstance(entry, dict):
+            return {**entry, 'path': self._rebase(entry.get('path', ''), directory)}
+        return os.path.relpath((directory / str(entry)).resolve(), self.app_path.resolve())
+
+    def service(self, path: Path, name: str, seen: Tuple[Tuple[Path, str], ...] = ()) -> dict:
+        """Return a service of a file with its `extends` chain resolved."""
+        path = path.resolve()
+        if (path, name) in seen:
+            raise ValueError(f"Service {name} extends itself")
+        services = self.load(path).get('services') or {}
+        if name not in services:
+            raise ValueError(f"Service {name} not found in {path.name}")
+        service = normalize_service(services[name])
+        if service.get('env_file') and path.parent != self.app_path.resolve():
+            # relative to the file defining them, the project directory may be elsewhere
+            service['env_file'] = [self._rebase(entry, path.parent) for entry in service['env_file']]
+        extends = service.pop('extends', None)
+        if extends is None:
+            return service
+        if isinstance(extends, str):
+            extends = {'service': extends}
+
+        base_path = path
+        if extends.get('file'):
+            base_path = (path.parent / extends['file']).resolve()
+            if base_path not in self.extra_files:
+                self.extra_files.append(base_path)
+        base = self.service(base_path, extends['service'], seen + ((path, name),))
+        return merge(base, service)
+
+
+def load_compose_model(app_path: Path) -> ComposeModel:
+    """Load the effective compose configuration of an app, raises ValueError if it is invalid."""
+    env = read_env_file(app_path / '.env')
+    # the shell environment, which docker-compose inherits, wins over .env
+    env.update(os.environ)
+    loader = _Loader(app_path, env)
+
+    name = None
+    services: Dict[str, dict] = {}
+    sections: Dict[str, dict] = {section: {} for section in REFERENCED_SECTIONS}
+    try:
+        for path in compose_files(app_path):
+            config = loader.load(path)
+            name = config.get('name', name)
+            for section in REFERENCED_SECTIONS:
+                sections[section] = merge(sections[section], config.get(section) or {})
+            for service in config.get('services') or {}:
+                resolved = loader.service(path, service)
+                services[service] = merge(services[service], resolved) if service in services else resolved
+    except (OSError, yaml.YAMLError, AttributeError, TypeError) as e:
+        raise ValueError(f"Failed to load compose files: {e}") from e
+
+    hashes = {}
+    extra_files = list(loader.extra_files)
+    for service, definition in services.items():
+        used = {
+            section: {ref: sections[section].get(ref) for ref in _references(definition, section)}
+            for section in REFERENCED_SECTIONS
+        }
+        # compose recreates a service when its env files change, not just their names
+        env_files = {}
+        for env_path in env_file_paths(app_path, definition):
+            env_files[str(env_path)] = _content_hash(env_path)
+            if env_path not in extra_files:
+                extra_files.append(env_path)
+        # a renamed project gets new containers for every service
+        data = json.dumps({'project': name, 'service': definition, 'uses': used,
+                           'env_files': env_files}, sort_keys=True, default=str)
+        hashes[service] = hashlib.sha256(data.encode()).hexdigest()
+    return ComposeModel(name, services, hashes, tuple(extra_files))
+
+
+def env_file_paths(app_path: Path, service: dict) -> List[Path]:
+    """Return the env files of a service, relative paths are relative to the project directory."""
+    paths = []
+    for entry in service.get('env_file') or ():
+        path = entry.get('path') if isinstance(entry, dict) else entry
+        if path:
+            paths.append((app_path / str(path)).resolve())
+    return paths
+
+
+def _content_hash(path: Path) -> Optional[str]:
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        # a missing optional env file counts too, creating it changes the service
+        return None
+
+
+def _references(service: dict, section: str) -> List[str]:
+    value = service.get(section)
+    if section == 'networks' and not value and service.get('network_mode') is None:
+        return ['default']
+    if isinstance(value, dict):
+        return sorted(value)
+    refs = []
+    for item in value or ():
+        if isinstance(item, dict):
+            ref = item.get('source')
+        elif section == 'volumes':
+            # host paths contain a slash, named volumes don't
+            ref = str(item).split(':')[0]
+            ref = None if '/' in ref or ref.startswith('.') or ref.startswith('~') else ref
+        else:
+            ref = str(item)
+        if ref:
+            refs.append(ref)
+    return sorted(set(refs))
+
+
+class ComposeModelCache:
+    """Compose models of apps, reloaded only when one of the files they were read from changed.
+
+    Files are compared by content hash through a HashCache, so a reconcile
+    that finds nothing changed doesn't parse any YAML.
+    """
+
+    def __init__(self, hash_cache: HashCache):
+        self.hash_cache = hash_cache
+        # app path -> (hash of the files read, model)
+        self._models: Dict[Path, Tuple[str, ComposeModel]] = {}
+        self._lock = threading.Lock()
+
+    def _files_key(self, app_path: Path, extra_files: Tuple[Path, ...]) -> str:
+        digest = hashlib.sha256()
+        for path in [*compose_files(app_path), app_path / '.env', *extra_files]:
+            digest.update(str(path).encode())
+            digest.update(b'\0')
+            digest.update(self.hash_cache.file_hash(path).encode())
+        return digest.hexdigest()
+
+    def get(self, app_path: Path) -> ComposeModel:
+        """Return the model of an app, raises ValueError if its compose files are invalid."""
+        with self._lock:
+            cached = self._models.get(app_path)
+        extra_files = cached[1].extra_files if cached else ()
+        # hashed before loading, a change made meanwhile is picked up next time
+        key = self._files_key(app_path, extra_files)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+
+        model = load_compose_model(app_path)
+        if model.extra_files != extra_files:
+            key = self._files_key(app_path, model.extra_files)
+        with self._lock:
+            self._models[app_path] = (key, model)
+        return model
+
+    def forget(self, app_path: Path):
+        with self._lock:
+            self._models.pop(app_path, None)
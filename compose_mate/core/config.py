@@ -0,0 +1,121 @@
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import MappingProxyType
+from typing import Mapping, Optional, Tuple
+
+import yaml
+from apscheduler.triggers.cron import CronTrigger
+
+from compose_mate.core.cron import compile_cron
+from compose_mate.core.models import AppConfig, TaskConfig
+
+# libyaml based loader is several times faster, fall back when it isn't built
+YamlLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    apps: Tuple[AppConfig, ...] = ()
+    digest: str = ''
+    apps_by_id: Mapping[str, AppConfig] = field(default_factory=lambda: MappingProxyType({}))
+    # "<app_id>_<task_id>" -> (app, task), same keys as State.tasks
+    tasks_by_key: Mapping[str, Tuple[AppConfig, TaskConfig]] = field(
+        default_factory=lambda: MappingProxyType({}))
+    # task key -> trigger compiled from the task's cron, H tokens hashed by task key
+    triggers: Mapping[str, CronTrigger] = field(default_factory=lambda: MappingProxyType({}))
+
+    @classmethod
+    def from_apps(cls, apps: Tuple[AppConfig, ...], digest: str) -> 'ConfigSnapshot':
+        """Index the apps and compile their cron expressions, raises ValueError if one is invalid."""
+        tasks_by_key = {f"{app.id}_{task.id}": (app, task) for app in apps for task in app.tasks}
+        triggers = {}
+        for task_key, (app, task) in tasks_by_key.items():
+            try:
+                triggers[task_key] = compile_cron(task.cron, task_key, task.jitter)
+            except ValueError as e:
+                raise ValueError(f"Task {task.id} of app {app.id}: {e}") from e
+        return cls(
+            apps=apps,
+            digest=digest,
+            apps_by_id=MappingProxyType({app.id: app for app in apps}),
+            tasks_by_key=MappingProxyType(tasks_by_key),
+            triggers=MappingProxyType(triggers)
+        )
+
+
+class ConfigStore:
+    """Caches the parsed `.cm.yaml` as an immutable snapshot.
+
+    `snapshot()` never touches the disk unless the store was invalidated,
+    which the file watcher does when the config file changes. `refresh()`
+    checks the file's mtime/size and content hash and only re-parses when
+    the content actually changed.
+    """
+
+    def __init__(self, config_file: Path, logger):
+        self.config_file = config_file
+        self.logger = logger
+        self._snapshot = ConfigSnapshot()
+        self._stat: Optional[Tuple[int, int]] = None
+        self._error: Optional[Exception] = None
+        self._dirty = True
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._dirty = True
+
+    def snapshot(self) -> ConfigSnapshot:
+        if not self._dirty:
+            return self._snapshot
+        try:
+            return self.refresh()
+        except (OSError, ValueError) as e:
+            self.logger.error(f"Failed to load config: {e}")
+            return self._snapshot
+
+    def refresh(self) -> ConfigSnapshot:
+        """Reload the config if the file changed, raises ValueError if it is invalid."""
+        with self._lock:
+            self._dirty = False
+            try:
+                stat = self.config_file.stat()
+            except FileNotFoundError:
+                self._stat, self._error = None, None
+                self._snapshot = ConfigSnapshot()
+                return self._snapshot
+            except OSError as e:
+                raise ValueError(f"Can't read {self.config_file.name}: {e}")
+
+            stat_key = (stat.st_mtime_ns, stat.st_size)
+            if stat_key != self._stat:
+                self._stat = stat_key
+                try:
+                    self._load()
+                except OSError as e:
+                    # removed or replaced since the stat, read it again next time
+                    self._stat = None
+                    raise ValueError(f"Can't read {self.config_file.name}: {e}")
+
+            if self._error:
+                raise self._error
+            return self._snapshot
+
+    def _load(self):
+        with open(self.config_file, 'rb') as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        if digest == self._snapshot.digest and not self._error:
+            return
+
+        try:
+            config = yaml.load(content, Loader=YamlLoader) or {}
+            apps = tuple(AppConfig(**app_data) for app_data in config.get('apps', []))
+            snapshot = ConfigSnapshot.from_apps(apps, digest)
+        except (yaml.YAMLError, ValueError, TypeError, AttributeError) as e:
+            self._error = ValueError(f"Invalid {self.config_file.name}: {e}")
+            return
+
+        self._error = None
+        self._snapshot = snapshot
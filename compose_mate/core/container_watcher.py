@@ -0,0 +1,346 @@
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from apscheduler.jobstores.base import JobLookupError
+from compose_mate.core.backend import project_name
+from compose_mate.core.config import ConfigSnapshot
+from compose_mate.core.docker_api import (APP_LABEL, DockerAPIError, DockerClient, EventStream,
+                                          ONEOFF_LABEL, PROJECT_LABEL, RUN_LABEL, SERVICE_LABEL,
+                                          TASK_LABEL)
+from compose_mate.core.events import CONTAINERS_CHANGED
+from compose_mate.core.metrics import CONTAINER_EVENTS, SERVICE_HEALS
+
+# Container events the watcher subscribes to
+EVENT_FILTERS = {
+    'type': ['container'],
+    'event': ['start', 'kill', 'die', 'oom', 'health_status', 'destroy'],
+    'label': [PROJECT_LABEL],
+}
+# Seconds before reconnecting a broken stream, doubled up to the maximum
+RECONNECT_DELAY = 1.0
+MAX_RECONNECT_DELAY = 60.0
+# Seconds before a failed service is recreated, doubled with every failure
+# in a row up to the maximum; a service failing less often starts over
+HEAL_DELAY = 10.0
+MAX_HEAL_DELAY = 600.0
+HEAL_RESET = 1800.0
+
+
+def is_failure(state: str) -> bool:
+    return state in ('oom', 'unhealthy') or state.startswith('exited')
+
+
+class ContainerEvents:
+    """A single Docker events stream, handed to the container watchers of every repository.
+
+    On every (re)connect, the current containers are listed once and given
+    to each watcher before the events since then are replayed.
+    """
+
+    def __init__(self, client: DockerClient, logger: logging.Logger):
+        self.client = client
+        self.logger = logger
+        self._watchers: List['ContainerWatcher'] = []
+        self._lock = threading.Lock()
+        self._stream: Optional[EventStream] = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cm-container-events', daemon=True)
+
+    def add(self, watcher: 'ContainerWatcher'):
+        with self._lock:
+            self._watchers.append(watcher)
+            started = self._thread.is_alive()
+        if started:
+            # the stream is already past its listing, catch up on our own
+            try:
+                watcher.load(self._list_containers())
+            except (DockerAPIError, OSError, ValueError) as e:
+                self.logger.error(f"Failed to list containers: {e}")
+
+    def remove(self, watcher: 'ContainerWatcher'):
+        with self._lock:
+            if watcher in self._watchers:
+                self._watchers.remove(watcher)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        with self._lock:
+            stream = self._stream
+        if stream is not None:
+            stream.close()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _list_containers(self) -> List[dict]:
+        return self.client.list_containers([PROJECT_LABEL], all=True)
+
+    def _run(self):
+        delay = RECONNECT_DELAY
+        while not self._stopped.is_set():
+            # events since the listing are replayed, nothing falls in between
+            since = int(time.time())
+            try:
+                containers = self._list_containers()
+                with self._lock:
+                    watchers = list(self._watchers)
+                for watcher in watchers:
+                    watcher.load(containers)
+                stream = self.client.events(EVENT_FILTERS, since=since)
+                with self._lock:
+                    self._stream = stream
+                if self._stopped.is_set():
+                    stream.close()
+                    return
+                self.logger.info("Watching container events")
+                delay = RECONNECT_DELAY
+                for event in stream:
+                    with self._lock:
+                        watchers = list(self._watchers)
+                    for watcher in watchers:
+                        watcher.handle(event)
+            except (DockerAPIError, OSError, ValueError) as e:
+                self.logger.error(f"Container events stream failed: {e}")
+            except Exception as e:
+                self.logger.exception(f"Error handling container events: {e}")
+            if self._stopped.wait(delay):
+                return
+            self.logger.info("Reconnecting to container events")
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+
+class ContainerWatcher:
+    """Follows the containers of the apps of one repository through ContainerEvents.
+
+    Container events are mapped to apps through the compose project label,
+    and to task runs through the labels task containers are started with.
+    An app whose service containers crashed, ran out of memory or turned
+    unhealthy is marked 'degraded' until they are running again. With `heal`,
+    a failed service is recreated on its own, with an exponential backoff for
+    services that keep failing.
+    """
+
+    def __init__(self, manager, heal: bool = False):
+        self.manager = manager
+        self.heal = heal
+        self.logger = manager.logger
+
+        # container id -> (app id, service, state)
+        self._containers: Dict[str, Tuple[str, str, str]] = {}
+        # containers that got a kill, their exit is not a crash
+        self._killed: Set[str] = set()
+        # compose project -> app id, rebuilt when the config changes
+        self._projects: Dict[str, str] = {}
+        self._projects_digest: Optional[str] = None
+        # (app id, service) -> (failures in a row, time of the last failure)
+        self._failures: Dict[Tuple[str, str], Tuple[int, float]] = {}
+        self._heal_jobs: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def close(self):
+        """Drop the recreations still planned."""
+        with self._lock:
+            job_ids, self._heal_jobs = self._heal_jobs, set()
+        for job_id in job_ids:
+            try:
+                self.manager.scheduler.remove_job(job_id)
+            except JobLookupError:
+                # already ran
+                pass
+
+    def service_states(self, app_id: str) -> Dict[str, str]:
+        """Return the state of each service of an app, the worst of its containers."""
+        services: Dict[str, str] = {}
+        with self._lock:
+            for owner, service, state in self._containers.values():
+                if owner != app_id:
+                    continue
+                current = services.get(service)
+                if current is None or is_failure(state) or (current == 'stopped' and state == 'running'):
+                    services[service] = state
+        return services
+
+    def refresh(self, snapshot: ConfigSnapshot):
+        """Pick up changed apps after a reconcile and reapply their container state."""
+        self._update_projects(snapshot, force=True)
+        with self._lock:
+            app_ids = {app_id for app_id, _, _ in self._containers.values()}
+        for app_id in app_ids:
+            self._update_app(app_id, notify=False)
+
+    def _update_projects(self, snapshot: ConfigSnapshot, force: bool = False):
+        if not force and snapshot.digest == self._projects_digest:
+            return
+        projects = {project_name(self.manager.repo_path / app.path): app.id for app in snapshot.apps}
+        with self._lock:
+            self._projects = projects
+            self._projects_digest = snapshot.digest
+
+    def _app_for_project(self, project: Optional[str]) -> Optional[str]:
+        self._update_projects(self.manager.config_store.snapshot())
+        with self._lock:
+            return self._projects.get(project)
+
+    def load(self, listed: List[dict]):
+        """Start from the current containers, only events tell about failures."""
+        containers = {}
+        for container in listed:
+            labels = container.get('Labels') or {}
+            app_id = self._app_for_project(labels.get(PROJECT_LABEL))
+            if app_id is None or labels.get(ONEOFF_LABEL) == 'True':
+                continue
+            if container.get('State') != 'running':
+                state = 'stopped'
+            elif '(unhealthy)' in container.get('Status', ''):
+                state = 'unhealthy'
+            else:
+                state = 'running'
+            containers[container['Id']] = (app_id, labels.get(SERVICE_LABEL, ''), state)
+
+        with self._lock:
+            app_ids = {app_id for app_id, _, _ in self._containers.values()}
+            self._containers = containers
+            self._killed.clear()
+        for app_id in app_ids | {app_id for app_id, _, _ in containers.values()}:
+            self._update_app(app_id)
+
+    def handle(self, event: dict):
+        actor = event.get('Actor') or {}
+        attributes = actor.get('Attributes') or {}
+        container_id = actor.get('ID') or event.get('id')
+        action = event.get('Action') or event.get('status') or ''
+        kind = action.partition(':')[0]
+
+        app_id = self._app_for_project(attributes.get(PROJECT_LABEL))
+        if app_id is None or not container_id:
+            return
+        CONTAINER_EVENTS.inc(app=app_id, action=kind)
+
+        if attributes.get(ONEOFF_LABEL) == 'True':
+            self._handle_task_container(attributes, container_id, kind, action)
+            return
+
+        service = attributes.get(SERVICE_LABEL, '')
+        with self._lock:
+            previous = self._containers.get(container_id, (app_id, service, 'stopped'))[2]
+            if kind == 'destroy':
+                self._containers.pop(container_id, None)
+                self._killed.discard(container_id)
+                state = None
+            else:
+                state = self._next_state(container_id, previous, kind, action, attributes)
+                self._containers[container_id] = (app_id, service, state)
+
+        if state is not None and is_failure(state) and not is_failure(previous):
+            self.logger.warning(f"Service {service} of app {app_id} failed: {state}")
+            if self.heal:
+                self._schedule_heal(app_id, service)
+        self._update_app(app_id)
+
+    def _next_state(self, container_id: str, previous: str, kind: str, action: str,
+                    attributes: Dict[str, str]) -> str:
+        if kind == 'start':
+            self._killed.discard(container_id)
+            return 'running'
+        if kind == 'kill':
+            self._killed.add(container_id)
+            return previous
+        if kind == 'oom':
+            return 'oom'
+        if kind == 'health_status':
+            return 'unhealthy' if action.endswith('unhealthy') else 'running'
+        if kind == 'die':
+            if container_id in self._killed:
+                # stopped on purpose, by compose or by hand
+                self._killed.discard(container_id)
+                return 'stopped'
+            if previous == 'oom':
+                return previous
+            exit_code = attributes.get('exitCode', '0')
+            return 'stopped' if exit_code == '0' else f"exited ({exit_code})"
+        return previous
+
+    def _handle_task_container(self, attributes: Dict[str, str], container_id: str,
+                               kind: str, action: str):
+        app_id, task_id = attributes.get(APP_LABEL), attributes.get(TASK_LABEL)
+        if not app_id or not task_id:
+            return
+        run_id = attributes.get(RUN_LABEL)
+        name = attributes.get('name', container_id[:12])
+        logger = self.manager.log_manager.get_task_logger(app_id, task_id)
+        if kind == 'oom':
+            logger.error(f"Container {name} of run {run_id} ran out of memory")
+        elif kind == 'health_status' and action.endswith('unhealthy'):
+            logger.warning(f"Container {name} of run {run_id} is unhealthy")
+
+    def _update_app(self, app_id: str, notify: bool = True):
+        """Mark an app degraded while one of its services failed, running once none does.
+
+        Subscribers are told about changed service states with `notify`, and
+        always when the app's status changed.
+        """
+        failed = any(is_failure(state) for state in self.service_states(app_id).values())
+        manager = self.manager
+        with manager.state_lock:
+            app_state = manager.state.apps.get(app_id)
+            # apps that are stopped or failed to come up keep their status
+            if app_state is None or app_state.status not in ('running', 'degraded'):
+                return
+            status = 'degraded' if failed else 'running'
+            if app_state.status != status:
+                manager.update_app_state(app_id, status=status)
+                notify = True
+        if notify:
+            manager.events.publish(CONTAINERS_CHANGED, app_id)
+
+    def _schedule_heal(self, app_id: str, service: str):
+        now = time.monotonic()
+        with self._lock:
+            failures, last_failure = self._failures.get((app_id, service), (0, 0.0))
+            if now - last_failure > HEAL_RESET:
+                failures = 0
+            self._failures[(app_id, service)] = (failures + 1, now)
+        delay = min(HEAL_DELAY * 2 ** failures, MAX_HEAL_DELAY)
+        self.logger.info(f"Recreating service {service} of app {app_id} in {delay:.0f}s")
+        job_id = self.manager.executor.job_id(f"heal_{app_id}_{service}")
+        with self._lock:
+            self._heal_jobs.add(job_id)
+        self.manager.scheduler.add_job(
+            self._heal,
+            'date',
+            run_date=datetime.now() + timedelta(seconds=delay),
+            args=[app_id, service, job_id],
+            id=job_id,
+            replace_existing=True
+        )
+
+    def _heal(self, app_id: str, service: str, job_id: str):
+        with self._lock:
+            self._heal_jobs.discard(job_id)
+        # a restart policy or a reconcile may have brought it back meanwhile
+        if not is_failure(self.service_states(app_id).get(service, 'running')):
+            return
+        app = self.manager.config_store.snapshot().apps_by_id.get(app_id)
+        app_state = self.manager.state.apps.get(app_id)
+        if app is None or app_state is None or app_state.status != 'degraded':
+            return
+        if not self.manager.lease.check():
+            # another instance took over while the heal waited, it decides now
+            self.logger.debug(f"Not holding the lease, not recreating service {service} of app {app_id}")
+            return
+
+        self.logger.info(f"Recreating service {service} of app {app_id}")
+        app_path = self.manager.repo_path / app.path
+        try:
+            self.manager.runner.submit(
+                self.manager.backend.up_service(app_path, service, self.manager.logger)
+            ).result()
+            SERVICE_HEALS.inc(app=app_id, outcome='success')
+        except Exception as e:
+            self.logger.error(f"Failed to recreate service {service} of app {app_id}: {e}")
+            SERVICE_HEALS.inc(app=app_id, outcome='failed')
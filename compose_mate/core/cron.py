@@ -0,0 +1,97 @@
+import hashlib
+import re
+from datetime import timedelta
+from typing import Dict, Optional
+
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+
+# cron field -> range an H token picks from, days stop at 28 so every month has them
+FIELDS = (
+    ('minute', 0, 59),
+    ('hour', 0, 23),
+    ('day', 1, 28),
+    ('month', 1, 12),
+    ('day_of_week', 0, 6),
+)
+
+# H, H(a-b), H/n and H(a-b)/n
+HASH_RE = re.compile(r'^H(?:\((\d+)-(\d+)\))?(?:/(\d+))?$')
+
+
+def _hash(seed: str) -> int:
+    return int.from_bytes(hashlib.sha256(seed.encode()).digest()[:8], 'big')
+
+
+def _expand_hash(part: str, seed: str, low: int, high: int) -> str:
+    match = HASH_RE.match(part)
+    if not match:
+        raise ValueError(f"Invalid H token: {part}")
+    if match.group(1) is not None:
+        low, high = int(match.group(1)), int(match.group(2))
+        if low > high:
+            raise ValueError(f"Invalid H range: {part}")
+    step = match.group(3)
+    if step is None:
+        return str(low + _hash(seed) % (high - low + 1))
+    step = int(step)
+    if step < 1:
+        raise ValueError(f"Invalid H step: {part}")
+    return f"{low + _hash(seed) % min(step, high - low + 1)}-{high}/{step}"
+
+
+def parse_cron(cron_str: str, seed: str) -> Dict[str, str]:
+    """Split a five field cron expression into APScheduler cron fields.
+
+    Jenkins style `H` tokens are replaced by a value derived from `seed`,
+    so a task always fires at the same, but spread out, time:
+    `H` picks one value, `H(a-b)` one value in a range and `H/n` or
+    `H(a-b)/n` every n-th value starting from a hashed offset.
+    """
+    parts = cron_str.split()
+    if len(parts) != len(FIELDS):
+        raise ValueError(f"Invalid cron expression: {cron_str}")
+
+    fields = {}
+    for (name, low, high), value in zip(FIELDS, parts):
+        fields[name] = ','.join(
+            _expand_hash(part, f"{seed}:{name}", low, high) if part.startswith('H') else part
+            for part in value.split(',')
+        )
+    return fields
+
+
+def compile_cron(cron_str: str, seed: str, jitter: Optional[int] = None) -> CronTrigger:
+    """Build the trigger of a cron expression, raises ValueError if it is invalid."""
+    fields = parse_cron(cron_str, seed)
+    try:
+        return CronTrigger(jitter=jitter, **fields)
+    except ValueError as e:
+        raise ValueError(f"Invalid cron expression {cron_str!r}: {e}") from e
+
+
+def stagger_offset(seed: str, window: float) -> float:
+    """Return a stable delay in [0, window) seconds for `seed`."""
+    if window <= 0:
+        return 0.0
+    return _hash(seed) % int(window * 1000) / 1000
+
+
+class StaggeredTrigger(BaseTrigger):
+    """Fires `offset` seconds after every fire time of the wrapped trigger."""
+
+    def __init__(self, trigger: BaseTrigger, offset: float):
+        self.trigger = trigger
+        self.offset = timedelta(seconds=offset)
+
+    def get_next_fire_time(self, previous_fire_time, now):
+        if previous_fire_time is not None:
+            previous_fire_time -= self.offset
+        next_fire_time = self.trigger.get_next_fire_time(previous_fire_time, now - self.offset)
+        return next_fire_time + self.offset if next_fire_time else None
+
+    def __str__(self):
+        return f"{self.trigger} + {self.offset.total_seconds():g}s"
+
+    def __repr__(self):
+        return f"<StaggeredTrigger ({self.trigger!r}, offset={self.offset.total_seconds():g}s)>"
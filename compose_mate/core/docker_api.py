@@ -0,0 +1,368 @@
+import http.client
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Iterator, List, Optional
+from urllib.parse import quote, urlencode
+
+from compose_mate.core.metrics import DOCKER_API_DURATION
+
+DEFAULT_SOCKET = '/var/run/docker.sock'
+API_VERSION = 'v1.41'
+
+# Labels docker compose puts on the containers it creates
+PROJECT_LABEL = 'com.docker.compose.project'
+SERVICE_LABEL = 'com.docker.compose.service'
+ONEOFF_LABEL = 'com.docker.compose.oneoff'
+# Labels Compose Mate puts on the containers of task runs
+APP_LABEL = 'compose_mate.app'
+TASK_LABEL = 'compose_mate.task'
+RUN_LABEL = 'compose_mate.run'
+
+# Environment variable marking the processes of an exec, and their children
+EXEC_MARKER_ENV = 'COMPOSE_MATE_EXEC'
+# Kills every process of the container whose environment holds the marker
+KILL_SCRIPT = (
+    'for p in /proc/[0-9]*; do '
+    'if [ "${{p#/proc/}}" != $$ ] && grep -q "{marker}" "$p/environ" 2>/dev/null; '
+    'then kill -KILL "${{p#/proc/}}" 2>/dev/null; fi; '
+    'done; exit 0'
+)
+# Seconds the exec killing a process may take
+KILL_TIMEOUT = 10.0
+
+
+class DockerAPIError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.status = status
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path: str, timeout: float):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class EventStream:
+    """Docker events arriving on a dedicated connection, one dict per event.
+
+    Iterating blocks until the next event, `close()` from another thread
+    ends the iteration.
+    """
+
+    def __init__(self, conn: UnixHTTPConnection, sock: socket.socket,
+                 response: http.client.HTTPResponse):
+        self.conn = conn
+        self.sock = sock
+        self.response = response
+
+    def __iter__(self) -> Iterator[dict]:
+        while True:
+            try:
+                line = self.response.readline()
+            except (OSError, ValueError, http.client.HTTPException):
+                # closed while reading
+                return
+            if not line:
+                return
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.conn.close()
+
+
+class Exec:
+    """A command running inside a container through the Engine API.
+
+    The process belongs to the daemon, closing the output stream doesn't
+    stop it. On timeout, and when `cancel` is called from another thread,
+    it is killed from inside the container: the pid the daemon reports is
+    the host's, which a client in another pid namespace can't signal.
+    """
+
+    def __init__(self, client: 'DockerClient', exec_id: str, container_id: str, marker: str):
+        self.client = client
+        self.id = exec_id
+        self.container_id = container_id
+        # set in the environment of the process, the children it starts inherit it
+        self.marker = marker
+        self._sock: Optional[socket.socket] = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def run(self, on_line: Callable[[str, bool], None], timeout: Optional[float] = None) -> int:
+        """Start the command and return its exit code.
+
+        Output is passed to `on_line(line, is_stderr)` as it arrives. When
+        `timeout` passes the process is killed and TimeoutError raised.
+        """
+        try:
+            return self._run(on_line, time.monotonic() + timeout if timeout else None)
+        except TimeoutError:
+            try:
+                self.kill()
+            except (DockerAPIError, OSError) as e:
+                raise TimeoutError(f"exec timed out, failed to kill it: {e}")
+            raise
+
+    def _run(self, on_line: Callable[[str, bool], None], deadline: Optional[float]) -> int:
+        # the daemon hijacks the connection for the output stream, never pool it
+        conn = UnixHTTPConnection(self.client.socket_path, self.client.timeout)
+        try:
+            conn.connect()
+            # http.client drops conn.sock once it sees the stream won't be reusable
+            with self._lock:
+                if self._cancelled:
+                    raise DockerAPIError('exec cancelled')
+                self._sock = conn.sock
+            response = self.client._send(conn, 'POST', f"/exec/{self.id}/start", None,
+                                         {'Detach': False, 'Tty': False})
+            if response.status >= 400:
+                raise DockerAPIError(f"Failed to start exec: {response.read().decode(errors='replace')}",
+                                     response.status)
+            self._read_stream(response, on_line, deadline)
+            response.close()
+        finally:
+            with self._lock:
+                self._sock = None
+            conn.close()
+
+        if self._cancelled:
+            raise DockerAPIError('exec cancelled')
+        return self.client.request('GET', f"/exec/{self.id}/json")['ExitCode']
+
+    def cancel(self):
+        """Kill the process and end `run` in the thread reading its output."""
+        with self._lock:
+            self._cancelled = True
+            if self._sock is not None:
+                try:
+                    self._sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+        self.kill()
+
+    def kill(self):
+        """Kill the process and its children if it is still running.
+
+        A second exec in the same container finds them by the marker in
+        their environment, it needs `sh` there. Raises DockerAPIError if
+        the kill fails.
+        """
+        if not self.client.request('GET', f"/exec/{self.id}/json").get('Running'):
+            return
+        output = []
+        killer = self.client.exec_create(self.container_id, ['sh', '-c', KILL_SCRIPT.format(
+            marker=f"{EXEC_MARKER_ENV}={self.marker}")], marked=False)
+        exit_code = killer._run(lambda line, is_stderr: output.append(line),
+                                time.monotonic() + KILL_TIMEOUT)
+        if exit_code != 0:
+            raise DockerAPIError(f"kill exited with {exit_code}: {' '.join(output)}")
+
+    def _read_stream(self, response: http.client.HTTPResponse,
+                     on_line: Callable[[str, bool], None], deadline: Optional[float]):
+        buffers = {1: b'', 2: b''}
+        while True:
+            # a long quiet command is fine without a deadline, so don't use the
+            # client timeout here; a timed out socket file can't be read again
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError('exec timed out')
+            try:
+                self._sock.settimeout(remaining)
+                header = response.read(8)
+            except socket.timeout:
+                raise TimeoutError('exec timed out')
+            except (OSError, ValueError, http.client.HTTPException):
+                if self._cancelled:
+                    # the socket was shut down by cancel()
+                    break
+                raise
+            if len(header) < 8:
+                break
+            stream_type, length = struct.unpack('>BxxxL', header)
+            chunk = response.read(length)
+            stream_type = stream_type if stream_type in buffers else 1
+            lines = (buffers[stream_type] + chunk).split(b'\n')
+            buffers[stream_type] = lines.pop()
+            for line in lines:
+                on_line(line.decode(errors='replace').rstrip('\r'), stream_type == 2)
+
+        for stream_type, rest in buffers.items():
+            if rest:
+                on_line(rest.decode(errors='replace'), stream_type == 2)
+
+
+class DockerClient:
+    """Minimal Docker Engine API client talking HTTP over the unix socket.
+
+    Connections are kept alive and reused through a small pool, so a request
+    costs a round trip on an open socket instead of a process spawn.
+    """
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, pool_size: int = 4,
+                 timeout: float = 30.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+
+    def _acquire(self) -> UnixHTTPConnection:
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            return UnixHTTPConnection(self.socket_path, self.timeout)
+
+    def _release(self, conn: UnixHTTPConnection):
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def close(self):
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def _send(self, conn: UnixHTTPConnection, method: str, path: str,
+              params: Optional[dict], body) -> http.client.HTTPResponse:
+        url = f"/{API_VERSION}{path}"
+        if params:
+            url += '?' + urlencode(params)
+        headers = {}
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        conn.request(method, url, body=payload, headers=headers)
+        return conn.getresponse()
+
+    def request(self, method: str, path: str, params: Optional[dict] = None, body=None):
+        started = time.perf_counter()
+        outcome = 'failed'
+        try:
+            result = self._request(method, path, params, body)
+            outcome = 'success'
+            return result
+        finally:
+            DOCKER_API_DURATION.observe(time.perf_counter() - started, method=method, outcome=outcome)
+
+    def _request(self, method: str, path: str, params: Optional[dict], body):
+        conn = self._acquire()
+        try:
+            try:
+                response = self._send(conn, method, path, params, body)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                # the daemon closed an idle keep-alive connection, retry on a fresh one
+                conn.close()
+                response = self._send(conn, method, path, params, body)
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+
+        if response.status >= 400:
+            try:
+                message = json.loads(data).get('message', '')
+            except ValueError:
+                message = data.decode(errors='replace')
+            raise DockerAPIError(f"{method} {path} failed ({response.status}): {message}",
+                                 response.status)
+        if not data:
+            return None
+        return json.loads(data)
+
+    def ping(self) -> bool:
+        try:
+            conn = self._acquire()
+            try:
+                response = self._send(conn, 'GET', '/_ping', None, None)
+                response.read()
+            finally:
+                conn.close()
+            return response.status == 200
+        except OSError:
+            return False
+
+    def list_containers(self, labels: Optional[List[str]] = None, all: bool = False) -> List[dict]:
+        params = {'all': '1' if all else '0'}
+        if labels:
+            params['filters'] = json.dumps({'label': labels})
+        return self.request('GET', '/containers/json', params=params)
+
+    def inspect_container(self, container_id: str) -> dict:
+        return self.request('GET', f"/containers/{quote(container_id)}/json")
+
+    def exec_create(self, container_id: str, cmd: List[str], marked: bool = True) -> 'Exec':
+        """Create an exec instance for `cmd` inside a container, `Exec.run` starts it.
+
+        Unless `marked` is False the process gets a marker in its
+        environment, `Exec.kill` needs it to find the process.
+        """
+        marker = uuid.uuid4().hex
+        body = {
+            'Cmd': cmd,
+            'AttachStdout': True,
+            'AttachStderr': True,
+        }
+        if marked:
+            body['Env'] = [f"{EXEC_MARKER_ENV}={marker}"]
+        exec_id = self.request('POST', f"/containers/{quote(container_id)}/exec", body=body)['Id']
+        return Exec(self, exec_id, container_id, marker)
+
+    def exec_run(self, container_id: str, cmd: List[str], on_line: Callable[[str, bool], None],
+                 timeout: Optional[float] = None) -> int:
+        """Run `cmd` inside a container and return its exit code, see `Exec.run`."""
+        return self.exec_create(container_id, cmd).run(on_line, timeout)
+
+    def events(self, filters: Dict[str, List[str]], since: Optional[int] = None) -> EventStream:
+        """Subscribe to the daemon's events matching `filters`, from `since` (unix time) on."""
+        params = {'filters': json.dumps(filters)}
+        if since is not None:
+            params['since'] = str(since)
+        # the stream stays open, it gets its own connection without timeout
+        conn = UnixHTTPConnection(self.socket_path, None)
+        try:
+            conn.connect()
+            sock = conn.sock
+            response = self._send(conn, 'GET', '/events', params, None)
+            if response.status >= 400:
+                raise DockerAPIError(f"Failed to subscribe to events: "
+                                     f"{response.read().decode(errors='replace')}", response.status)
+        except Exception:
+            conn.close()
+            raise
+        return EventStream(conn, sock, response)
+
+    def project_containers(self, project: str, all: bool = False) -> Dict[str, List[dict]]:
+        """Return the containers of a compose project grouped by service."""
+        services: Dict[str, List[dict]] = {}
+        for container in self.list_containers([f"{PROJECT_LABEL}={project}"], all=all):
+            labels = container.get('Labels') or {}
+            services.setdefault(labels.get(SERVICE_LABEL, ''), []).append(container)
+        return services
@@ -0,0 +1,119 @@
+import asyncio
+import itertools
+import threading
+from dataclasses import dataclass, field
+from typing import Dict, Optional, Set, Tuple
+
+# Event kinds
+TASK_QUEUED = 'task_queued'
+TASK_STARTED = 'task_started'
+TASK_FINISHED = 'task_finished'
+TASK_FAILED = 'task_failed'
+STEP_FINISHED = 'step_finished'
+APP_RECONCILED = 'app_reconciled'
+APP_REMOVED = 'app_removed'
+CONTAINERS_CHANGED = 'containers_changed'
+CONFIG_CHANGED = 'config_changed'
+LOG_APPENDED = 'log_appended'
+
+# Scope key of events that affect everything
+ALL = ('*', None)
+
+
+@dataclass(frozen=True)
+class Event:
+    kind: str
+    app_id: Optional[str] = None
+    task_id: Optional[str] = None
+    version: int = 0
+    data: dict = field(default_factory=dict)
+
+    @property
+    def scope(self) -> Tuple[str, Optional[str]]:
+        if self.kind == CONFIG_CHANGED or self.app_id is None:
+            return ALL
+        return self.app_id, self.task_id
+
+
+class Subscription:
+    """Collects the scopes touched by events until the subscriber picks them up.
+
+    Pending changes are kept as a set of (app_id, task_id) scopes, so a slow
+    subscriber uses bounded memory no matter how many events arrive.
+    """
+
+    def __init__(self, bus: 'EventBus', loop: asyncio.AbstractEventLoop):
+        self.bus = bus
+        self.loop = loop
+        self._pending: Set[Tuple[str, Optional[str]]] = set()
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+
+    def _notify(self, event: Event):
+        with self._lock:
+            first = not self._pending
+            self._pending.add(event.scope)
+        if first:
+            self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def changes(self) -> Set[Tuple[str, Optional[str]]]:
+        """Wait for the next changes and return the touched scopes."""
+        await self._ready.wait()
+        with self._lock:
+            self._ready.clear()
+            pending, self._pending = self._pending, set()
+        return pending
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+
+class EventBus:
+    """Publishes state changes to subscribers, usually web sessions.
+
+    Every event but LOG_APPENDED bumps `version`, which can be used to tell
+    whether any state changed since a client last looked. Log lines bump the
+    version of their task's log only, see `log_version`, busy logs would
+    otherwise change `version` all the time.
+    """
+
+    def __init__(self):
+        self._subscriptions: Set[Subscription] = set()
+        self._lock = threading.Lock()
+        self._counter = itertools.count(1)
+        self.version = 0
+        # (app_id, task_id) -> version of the last line appended to the task's log
+        self._log_versions: Dict[Tuple[Optional[str], Optional[str]], int] = {}
+
+    def log_version(self, app_id: str, task_id: str) -> int:
+        with self._lock:
+            return self._log_versions.get((app_id, task_id), 0)
+
+    def subscribe(self) -> Subscription:
+        """Subscribe from a coroutine, notifications arrive on its event loop."""
+        subscription = Subscription(self, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def publish(self, kind: str, app_id: Optional[str] = None,
+                task_id: Optional[str] = None, **data):
+        with self._lock:
+            version = next(self._counter)
+            if kind == LOG_APPENDED:
+                self._log_versions[(app_id, task_id)] = version
+            else:
+                self.version = version
+            event = Event(kind, app_id, task_id, version, data)
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription._notify(event)
+            except RuntimeError:
+                # the subscriber's loop is closed
+                self.unsubscribe(subscription)
+
@@ -1,115 +1,434 @@
-import subprocess
+import asyncio
+import hashlib
+import json
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import Future
 from datetime import datetime
 from pathlib import Path
+from typing import Dict, Iterable, Optional, Set, Tuple
 
-import requests
+from apscheduler.triggers.base import BaseTrigger
 
-from compose_mate.core.models import AppConfig, TaskConfig, StepConfig
+from compose_mate.core.cron import StaggeredTrigger, stagger_offset
+from compose_mate.core.docker_api import APP_LABEL, RUN_LABEL, TASK_LABEL
+from compose_mate.core.events import (STEP_FINISHED, TASK_FAILED, TASK_FINISHED, TASK_QUEUED,
+                                      TASK_STARTED)
+from compose_mate.core.lease import NotLeaseHolder
+from compose_mate.core.metrics import STEP_DURATION, TASK_RUNS
+from compose_mate.core.models import AppConfig, TaskConfig, StepConfig, StepResult, TaskRun
+from compose_mate.core.rest import SessionPool, may_retry, parse_tool, probe_command, tool_command
+from compose_mate.core.runner import CommandError
+from compose_mate.core.task_queue import TaskQueue
+
+
+JOB_OPTIONS = ('misfire_grace_time', 'coalesce', 'max_instances')
+
+
+def _hash(data) -> str:
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
 
 
 class TaskExecutor:
-    def __init__(self, manager):
+    def __init__(self, manager, queue: TaskQueue, stagger: float = 0):
         self.manager = manager
+        # seconds scheduled runs are spread over, so tasks with the same cron don't fire together
+        self.stagger = stagger
+        # runs wait here until a worker, the app and the task have room for them,
+        # the queue and the scheduler may be shared with other repositories
+        self.queue = queue
+        self.namespace = f"{manager.name}:" if manager.name else ''
+        # job id -> (trigger hash, job hash) of what is currently scheduled
+        self._job_hashes: Dict[str, Tuple[str, str]] = {}
+        self._jobs_lock = threading.Lock()
+        # task key -> asyncio tasks of its running instances
+        self._running: Dict[str, Set[asyncio.Task]] = {}
+        # run id -> runs in progress, until they are handed to the store
+        self._runs: Dict[str, TaskRun] = {}
+        self._running_lock = threading.Lock()
+        # pooled sessions for direct rest_api calls
+        self.http = SessionPool()
+        # image ID (or app path and service) -> HTTP client tool found in the container
+        self._http_tools: Dict[str, str] = {}
+        # app path and service -> image ID of its container, looked up once
+        self._service_images: Dict[str, str] = {}
+        self._http_tools_lock = threading.Lock()
 
-    def schedule_task(self, app: AppConfig, task: TaskConfig):
-        job_id = f"{app.id}_{task.id}"
+    def job_id(self, task_key: str) -> str:
+        """Return the id of a task's scheduler job, also its key in the task queue."""
+        return f"{self.namespace}{task_key}"
 
-        self.manager.scheduler.add_job(
-            self.execute_task,
-            'cron',
-            args=[app, task],
-            id=job_id,
-            **self._parse_cron(task.cron)
-        )
+    def queued(self, task_key: str) -> int:
+        return self.queue.queued(self.job_id(task_key))
+
+    def last_wait(self, task_key: str) -> Optional[float]:
+        return self.queue.last_wait(self.job_id(task_key))
+
+    def schedule_task(self, app: AppConfig, task: TaskConfig, trigger: BaseTrigger) -> str:
+        """Add or update the job of a task, leaving unchanged jobs untouched.
+
+        `trigger` is the task's compiled cron, with a stagger window it fires
+        a stable, per task delay later. Jobs whose trigger or options changed
+        are replaced, jobs whose steps changed only get new arguments so they
+        keep their next_run_time.
+        """
+        job_id = self.job_id(f"{app.id}_{task.id}")
+        options = {name: getattr(task, name) for name in JOB_OPTIONS
+                   if getattr(task, name) is not None}
+        trigger_hash = _hash({'cron': task.cron, 'jitter': task.jitter, 'options': options})
+        job_hash = _hash({'path': app.path, 'task': task.model_dump()})
+
+        with self._jobs_lock:
+            current = self._job_hashes.get(job_id)
+            if current == (trigger_hash, job_hash):
+                return job_id
+
+            if current is not None and current[0] == trigger_hash:
+                self.manager.scheduler.modify_job(job_id, args=[app, task])
+            else:
+                if self.stagger:
+                    trigger = StaggeredTrigger(trigger, stagger_offset(job_id, self.stagger))
+                self.manager.scheduler.add_job(
+                    self.trigger_task,
+                    trigger,
+                    args=[app, task],
+                    id=job_id,
+                    replace_existing=True,
+                    **options
+                )
+            self._job_hashes[job_id] = (trigger_hash, job_hash)
+        return job_id
+
+    def unschedule_stale(self, keep: Iterable[str]):
+        """Remove every job not listed in `keep`."""
+        keep = set(keep)
+        with self._jobs_lock:
+            for job_id in list(self._job_hashes):
+                if job_id not in keep:
+                    self.manager.scheduler.remove_job(job_id)
+                    del self._job_hashes[job_id]
+
+    def trigger_task(self, app: AppConfig, task: TaskConfig):
+        """Queue a run of a task without waiting for it, used by the scheduler.
+
+        A run is not queued while an earlier one of the same task still waits.
+        """
+        future = self.submit_task(app, task, coalesce=True)
+        if future is None:
+            self.manager.logger.warning(
+                f"Skipping run of task {app.id}_{task.id}: an earlier run is still queued"
+            )
+        return future
+
+    def submit_task(self, app: AppConfig, task: TaskConfig, run_id: Optional[str] = None,
+                    coalesce: bool = False) -> Optional[Future]:
+        """Queue a run of a task, the future resolves to its TaskRun.
+
+        The run gets `run_id`, or a new one, right away so it can be looked
+        up with `get_run` while it waits. Raises NotLeaseHolder on an instance
+        that doesn't hold the lease of the repository.
+        """
+        if not self.manager.lease.held:
+            raise NotLeaseHolder(f"Another instance runs the tasks of {self.manager.repo_path}")
+        future = self.queue.submit(self.run_task, app, task, run_id or uuid.uuid4().hex, coalesce,
+                                   self.namespace)
+        if future is not None:
+            self.manager.events.publish(TASK_QUEUED, app.id, task.id)
+        return future
 
     def execute_task(self, app: AppConfig, task: TaskConfig):
+        """Run a task and block until it finished."""
+        return self.submit_task(app, task).result()
+
+    def cancel_task(self, app_id: str, task_id: str) -> bool:
+        """Cancel every queued and running instance of a task, returns False if there was none."""
+        task_key = f"{app_id}_{task_id}"
+        dropped = self.queue.cancel(self.job_id(task_key))
+        with self._running_lock:
+            running = list(self._running.get(task_key, ()))
+        for run in running:
+            self.manager.runner.loop.call_soon_threadsafe(run.cancel)
+        if dropped:
+            self.manager.events.publish(TASK_QUEUED, app_id, task_id)
+        return bool(running or dropped)
+
+    def cancel_all(self, timeout: Optional[float] = None):
+        """Cancel every queued and running run and wait up to `timeout` seconds for them to end."""
+        self.queue.cancel_namespace(self.namespace)
+        with self._running_lock:
+            running = [run for runs in self._running.values() for run in runs]
+        if not running:
+            return
+
+        async def cancel_runs():
+            for run in running:
+                run.cancel()
+            await asyncio.wait(running)
+
+        try:
+            self.manager.runner.submit(cancel_runs()).result(timeout)
+        except Exception as e:
+            self.manager.logger.warning(f"Failed to wait for cancelled task runs: {e}")
+
+    async def run_task(self, app: AppConfig, task: TaskConfig, run_id: Optional[str] = None) -> TaskRun:
+        task_key = f"{app.id}_{task.id}"
+        # the check reads the lease files, keep it off the loop every repository's runs share
+        if not await asyncio.get_running_loop().run_in_executor(None, self.manager.lease.check):
+            # the lease was lost while the run waited, another instance runs the tasks now
+            raise NotLeaseHolder(f"Another instance runs the tasks of {self.manager.repo_path}")
+        current = asyncio.current_task()
+        with self._running_lock:
+            self._running.setdefault(task_key, set()).add(current)
+
+        run = TaskRun(
+            id=run_id or uuid.uuid4().hex,
+            app_id=app.id,
+            task_id=task.id,
+            started_at=datetime.now().isoformat(),
+            status='running'
+        )
+        started = time.monotonic()
+        with self._running_lock:
+            self._runs[run.id] = run
+        self.manager.store.record_run(run)
+        events = self.manager.events
+        events.publish(TASK_STARTED, app.id, task.id, run_id=run.id)
+        try:
+            await self._run_steps(app, task, run)
+            run.status, run.exit_code = 'success', 0
+            events.publish(TASK_FINISHED, app.id, task.id, run_id=run.id)
+            return run
+        except asyncio.CancelledError:
+            run.status = 'cancelled'
+            events.publish(TASK_FAILED, app.id, task.id, run_id=run.id)
+            raise
+        except Exception as e:
+            run.status = 'failed'
+            run.exit_code = getattr(e, 'returncode', None) or 1
+            events.publish(TASK_FAILED, app.id, task.id, run_id=run.id)
+            raise
+        finally:
+            run.finished_at = datetime.now().isoformat()
+            run.duration = time.monotonic() - started
+            self.manager.store.record_run(run)
+            TASK_RUNS.inc(app=app.id, task=task.id, status=run.status)
+            with self._running_lock:
+                runs = self._running[task_key]
+                runs.discard(current)
+                if not runs:
+                    # keys of removed or renamed tasks would pile up otherwise
+                    del self._running[task_key]
+                del self._runs[run.id]
+
+    def running_count(self, task_key: Optional[str] = None) -> int:
+        """Return the number of task runs in progress, of one task if `task_key` is given."""
+        with self._running_lock:
+            if task_key is not None:
+                return len(self._running.get(task_key, ()))
+            return sum(len(runs) for runs in self._running.values())
+
+    def get_run(self, run_id: str) -> Optional[TaskRun]:
+        """Return a queued, running or finished run, None if there is no such run.
+
+        Queued runs are returned with status 'queued' and without start time.
+        """
+        status = self.queue.run_status(run_id, self.namespace)
+        if status is None or status[2] == 'running':
+            with self._running_lock:
+                run = self._runs.get(run_id)
+            if run is not None:
+                return run.model_copy(deep=True)
+
+            # finished runs not persisted yet are answered from the store's queue
+            run = self.manager.store.get_run(run_id)
+            if run is not None or status is None:
+                return run
+
+        # queued, or dispatched but not started yet
+        app_id, task_id, state = status
+        return TaskRun(id=run_id, app_id=app_id, task_id=task_id, status=state)
+
+    async def _run_steps(self, app: AppConfig, task: TaskConfig, run: TaskRun):
+        """Run the steps of a task as soon as the steps they depend on succeeded.
+
+        At most `task.parallelism` steps run at once. When a step fails, the
+        steps depending on it are skipped; with `fail_fast` running steps are
+        cancelled and the rest skipped too. The first error is raised once
+        nothing runs anymore.
+        """
+        task_key = f"{app.id}_{task.id}"
+        pending = task.step_dependencies()
+        steps = dict(zip(pending, task.steps))
+        statuses: Dict[str, str] = {}
+        running: Dict[asyncio.Task, str] = {}
+        errors = []
+        self.manager.update_task_state(task_key, steps=[])
+
+        def skip(step_id: str):
+            del pending[step_id]
+            statuses[step_id] = 'skipped'
+            self._record_step(task_key, run, step_id, steps[step_id], 'skipped', datetime.now(), 0.0)
+
+        try:
+            while pending or running:
+                for step_id, depends_on in list(pending.items()):
+                    if any(statuses.get(dep) not in (None, 'success') for dep in depends_on):
+                        skip(step_id)
+                    elif len(running) < task.parallelism and \
+                            all(statuses.get(dep) == 'success' for dep in depends_on):
+                        del pending[step_id]
+                        step_run = asyncio.create_task(self._run_step(app, task, run, step_id, steps[step_id]))
+                        running[step_run] = step_id
+                if not running:
+                    continue
+
+                done, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for step_run in done:
+                    step_id = running.pop(step_run)
+                    if step_run.cancelled():
+                        statuses[step_id] = 'cancelled'
+                    elif step_run.exception():
+                        statuses[step_id] = 'failed'
+                        errors.append(step_run.exception())
+                    else:
+                        statuses[step_id] = 'success'
+
+                if errors and task.on_failure == 'fail_fast':
+                    for step_id in list(pending):
+                        skip(step_id)
+                    await self._cancel_steps(running)
+                    running.clear()
+        except asyncio.CancelledError:
+            await self._cancel_steps(running)
+            for step_id in list(pending):
+                skip(step_id)
+            self.manager.update_task_state(task_key, status='cancelled')
+            raise
+
+        if errors:
+            self.manager.update_task_state(task_key, status='failed')
+            raise errors[0]
+        self.manager.update_task_state(task_key, last_run=datetime.now().isoformat(), status='success')
+
+    @staticmethod
+    async def _cancel_steps(running: Dict[asyncio.Task, str]):
+        for step_run in running:
+            step_run.cancel()
+        await asyncio.gather(*running, return_exceptions=True)
+
+    async def _run_step(self, app: AppConfig, task: TaskConfig, run: TaskRun, step_id: str,
+                        step: StepConfig):
         app_path = self.manager.repo_path / app.path
         logger = self.manager.log_manager.get_task_logger(app.id, task.id)
+        task_key = f"{app.id}_{task.id}"
+        started_at = datetime.now()
+        started = time.monotonic()
 
-        for step in task.steps:
-            try:
-                if step.type == 'compose_run':
-                    self._execute_compose_run(app_path, step.compose_service)
-                elif step.type == 'compose_command':
-                    self._execute_compose_command(app_path, step.compose_service, step.command)
-                elif step.type == 'rest_api':
-                    self._execute_rest_api(app_path, step)
-
-                logger.info(f"Step {step.type} executed successfully")
-                self.manager.state.tasks[f"{app.id}_{task.id}"].last_run = datetime.now().isoformat()
-                self.manager.state.tasks[f"{app.id}_{task.id}"].status = 'success'
-
-            except Exception as e:
-                error_msg = f"Step {step.type} failed: {str(e)}"
-                logger.error(error_msg)
-                self.manager.state.tasks[f"{app.id}_{task.id}"].status = 'failed'
-                raise
-
-    def _execute_compose_run(self, app_path: Path, service: str):
-        cmd = ["docker-compose", "--project-directory", str(app_path), "run", "--rm", service]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Command failed: {result.stderr}")
-
-    def _execute_compose_command(self, app_path: Path, service: str, command: list):
-        cmd = ["docker-compose", "--project-directory", str(app_path), "exec", "-T", service] + command
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        if result.returncode != 0:
-            raise Exception(f"Command failed: {result.stderr}")
-
-    def _execute_rest_api(self, app_path: Path, step: StepConfig):
-        if not step.compose_service:
-            # direct call
-            response = requests.request(
-                method=step.method,
-                url=step.endpoint
-            )
-            response.raise_for_status()
-            return
+        try:
+            if step.type == 'compose_run':
+                # lets container events of the step be traced back to the run
+                labels = {APP_LABEL: app.id, TASK_LABEL: task.id, RUN_LABEL: run.id}
+                await self._execute_compose_run(app_path, step, logger, labels)
+            elif step.type == 'compose_command':
+                await self._execute_compose_command(app_path, step, logger)
+            elif step.type == 'rest_api':
+                await self._execute_rest_api(app_path, step, logger)
 
-        curl_cmd = f"curl -X {step.method} '{step.endpoint}' -s -f"
+            logger.info(f"Step {step_id} ({step.type}) executed successfully")
+            self._record_step(task_key, run, step_id, step, 'success', started_at,
+                              time.monotonic() - started)
 
-        # try curl
-        cmd = ["docker-compose", "--project-directory", str(app_path), "exec", "-T",
-               step.compose_service, "sh", "-c", f"command -v curl >/dev/null 2>&1 && {curl_cmd}"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        except asyncio.CancelledError:
+            logger.error(f"Step {step_id} ({step.type}) cancelled")
+            self._record_step(task_key, run, step_id, step, 'cancelled', started_at,
+                              time.monotonic() - started)
+            raise
+        except Exception as e:
+            logger.error(f"Step {step_id} ({step.type}) failed: {str(e)}")
+            self._record_step(task_key, run, step_id, step, 'failed', started_at,
+                              time.monotonic() - started, str(e))
+            raise
 
-        if result.returncode == 0:
-            return
+    def _record_step(self, task_key: str, run: TaskRun, step_id: str, step: StepConfig, status: str,
+                     started_at: datetime, duration: float, error: Optional[str] = None):
+        """Add the outcome of a step to the run and to the task state."""
+        run.steps.append(StepResult(
+            id=step_id,
+            type=step.type,
+            status=status,
+            started_at=started_at.isoformat(),
+            finished_at=datetime.now().isoformat(),
+            duration=duration,
+            error=error
+        ))
+        if status != 'skipped':
+            STEP_DURATION.observe(duration, type=step.type, status=status)
+        self.manager.update_task_state(task_key, steps=list(run.steps))
+        self.manager.events.publish(STEP_FINISHED, run.app_id, run.task_id, run_id=run.id, step_id=step_id)
+
+    async def _execute_compose_run(self, app_path: Path, step: StepConfig, logger: logging.Logger,
+                                   labels: Optional[Dict[str, str]] = None):
+        await self.manager.backend.run(app_path, step.compose_service, logger, timeout=step.timeout,
+                                       labels=labels)
 
-        # try wget
-        wget_cmd = f"wget -O - --method={step.method} '{step.endpoint}' -q"
-        cmd = ["docker-compose", "--project-directory", str(app_path), "exec", "-T",
-               step.compose_service, "sh", "-c", f"command -v wget >/dev/null 2>&1 && {wget_cmd}"]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+    async def _execute_compose_command(self, app_path: Path, step: StepConfig, logger: logging.Logger):
+        await self.manager.backend.exec(app_path, step.compose_service, step.command, logger,
+                                        timeout=step.timeout)
 
-        if result.returncode == 0:
+    async def _execute_rest_api(self, app_path: Path, step: StepConfig, logger: logging.Logger):
+        if not step.compose_service:
+            # direct call, requests is blocking so keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, self.http.request, step)
             return
 
-        # try python
-        python_cmd = f"""python3 -c 'import urllib.request as r; req=r.Request("{step.endpoint}",method="{step.method}"); r.urlopen(req)'"""
-        cmd = ["docker-compose", "--project-directory", str(app_path), "exec", "-T",
-               step.compose_service, "sh", "-c", python_cmd]
-        result = subprocess.run(cmd, capture_output=True, text=True)
+        # the HTTP client found in a container only changes with its image
+        service_key = f"{app_path}:{step.compose_service}"
+        with self._http_tools_lock:
+            image = self._service_images.get(service_key)
+        if image is None:
+            image = await self.manager.backend.service_image(app_path, step.compose_service)
+            if image:
+                with self._http_tools_lock:
+                    self._service_images[service_key] = image
+        cache_key = image or service_key
+        with self._http_tools_lock:
+            tool = self._http_tools.get(cache_key)
 
-        if result.returncode != 0:
-            raise Exception(f"All HTTP request methods failed: {result.stderr}")
+        retries = step.retries if may_retry(step) else 0
+        for attempt in range(retries + 1):
+            try:
+                cmd = tool_command(tool, step) if tool else probe_command(step)
+                output = await self.manager.backend.exec(app_path, step.compose_service, cmd,
+                                                         logger, timeout=step.timeout)
+                if not tool:
+                    self._remember_http_tool(cache_key, parse_tool(output))
+                return
+            except CommandError as e:
+                if not tool:
+                    # retries use the tool the probe found
+                    tool = parse_tool(e.output)
+                    self._remember_http_tool(cache_key, tool)
+                elif e.returncode == 127:
+                    # the cached tool is gone, the container may run another image now
+                    tool = None
+                    self._remember_http_tool(cache_key, None)
+                    with self._http_tools_lock:
+                        self._service_images.pop(service_key, None)
+                if attempt == retries:
+                    raise Exception(f"HTTP request failed: {e.output or e}")
+                await asyncio.sleep(step.backoff * 2 ** attempt)
+
+    def _remember_http_tool(self, cache_key: str, tool: Optional[str]):
+        with self._http_tools_lock:
+            if tool:
+                self._http_tools[cache_key] = tool
+            else:
+                self._http_tools.pop(cache_key, None)
 
     def _log_execution(self, log_file: Path, message: str):
         timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
         log_file.parent.mkdir(parents=True, exist_ok=True)
         with open(log_file, 'a') as f:
             f.write(f"[{timestamp}] {message}\n")
-
-    def _parse_cron(self, cron_str: str) -> dict:
-        parts = cron_str.split()
-        if len(parts) != 5:
-            raise ValueError(f"Invalid cron expression: {cron_str}")
-
-        return {
-            'minute': parts[0],
-            'hour': parts[1],
-            'day': parts[2],
-            'month': parts[3],
-            'day_of_week': parts[4]
-        }
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set
+
+import pathspec
+import yaml
+
+from compose_mate.core.models import AppConfig
+
+# Files docker compose loads, the first existing main file plus its override
+MAIN_FILES = ('compose.yaml', 'compose.yml', 'docker-compose.yaml', 'docker-compose.yml')
+OVERRIDE_FILES = ('compose.override.yaml', 'compose.override.yml',
+                  'docker-compose.override.yaml', 'docker-compose.override.yml')
+
+
+# Build hash of a service whose image inputs are unknown
+UNKNOWN_HASH = ''
+
+
+def compose_files(app_path: Path) -> List[Path]:
+    """Return the files docker compose loads from a project directory, in merge order."""
+    files = []
+    for names in (MAIN_FILES, OVERRIDE_FILES):
+        for name in names:
+            if (app_path / name).is_file():
+                files.append(app_path / name)
+                break
+    return files
+
+
+def find_compose_files(app_path: Path) -> List[Path]:
+    """Return the compose files docker compose loads, followed by `.env` if there is one."""
+    env_file = app_path / '.env'
+    return compose_files(app_path) + ([env_file] if env_file.is_file() else [])
+
+
+class BuildSpec(NamedTuple):
+    # None for contexts that can't be hashed locally, git urls or missing directories
+    context: Optional[Path]
+    dockerfile: Optional[Path]
+    # the service's `build` section as written, its args etc. affect the image too
+    config: dict
+
+
+def find_build_services(app_path: Path) -> Dict[str, BuildSpec]:
+    """Return the services of an app that have a build section."""
+    services = {}
+    for compose_file in find_compose_files(app_path):
+        if compose_file.name == '.env':
+            continue
+        try:
+            with open(compose_file) as f:
+                config = yaml.safe_load(f) or {}
+        except (OSError, yaml.YAMLError):
+            continue
+
+        for name, service in (config.get('services') or {}).items():
+            build = (service or {}).get('build')
+            if isinstance(build, str):
+                build = {'context': build}
+            elif not isinstance(build, dict):
+                continue
+            context = str(build.get('context', '.'))
+            context_path = None
+            # remote contexts (git urls etc.) can't be hashed locally
+            if '://' not in context and not context.startswith('git@'):
+                context_path = (app_path / context).resolve()
+                if not context_path.is_dir():
+                    context_path = None
+            # later files (overrides) win, like in docker compose
+            services[name] = BuildSpec(
+                context_path,
+                context_path / build.get('dockerfile', 'Dockerfile') if context_path else None,
+                build
+            )
+    return services
+
+
+def find_build_contexts(app_path: Path) -> List[Path]:
+    contexts = []
+    for spec in find_build_services(app_path).values():
+        if spec.context and spec.context not in contexts:
+            contexts.append(spec.context)
+    return contexts
+
+
+def _load_dockerignore(context_path: Path) -> Optional[pathspec.PathSpec]:
+    dockerignore = context_path / '.dockerignore'
+    if not dockerignore.is_file():
+        return None
+    with open(dockerignore) as f:
+        return pathspec.PathSpec.from_lines(pathspec.patterns.GitWildMatchPattern, f)
+
+
+def iter_context_files(context_path: Path) -> Iterator[Path]:
+    """Yield files of a build context in a stable order, skipping .dockerignore'd ones."""
+    ignore = _load_dockerignore(context_path)
+    for root, dirs, files in os.walk(context_path):
+        dirs.sort()
+        rel_root = Path(root).relative_to(context_path)
+        if ignore:
+            dirs[:] = [d for d in dirs if not ignore.match_file(f"{rel_root / d}/")]
+        for name in sorted(files):
+            rel_path = rel_root / name
+            if ignore and ignore.match_file(str(rel_path)):
+                continue
+            yield Path(root) / name
+
+
+def _hash_file(digest, path: Path):
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+    except OSError:
+        # unreadable files still count by name
+        digest.update(b'<unreadable>')
+
+
+def _file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    _hash_file(digest, path)
+    return digest.hexdigest()
+
+
+class HashCache:
+    """File content hashes keyed by (inode, mtime, size), persisted as JSON.
+
+    A file whose stat matches its entry is not read again. Files modified
+    within the last seconds are not cached, a later write in the same
+    mtime tick could otherwise go unnoticed.
+    """
+
+    # seconds a file must be unmodified before its hash is cached
+    SETTLE_TIME = 2.0
+
+    def __init__(self, cache_file: Optional[Path] = None):
+        self.cache_file = cache_file
+        # path -> [inode, mtime_ns, size, sha256]
+        self._entries: Dict[str, list] = {}
+        self._used: Set[str] = set()
+        self._dirty = False
+        self._lock = threading.Lock()
+        if cache_file and cache_file.exists():
+            try:
+                with open(cache_file) as f:
+                    self._entries = json.load(f)
+            except (OSError, ValueError):
+                self._entries = {}
+
+    def file_hash(self, path: Path) -> str:
+        key = str(path)
+        try:
+            stat = path.stat()
+        except OSError:
+            return _file_hash(path)
+        signature = [stat.st_ino, stat.st_mtime_ns, stat.st_size]
+        with self._lock:
+            self._used.add(key)
+            entry = self._entries.get(key)
+            if entry and entry[:3] == signature:
+                return entry[3]
+
+        file_hash = _file_hash(path)
+        if time.time() - stat.st_mtime > self.SETTLE_TIME:
+            with self._lock:
+                self._entries[key] = signature + [file_hash]
+                self._dirty = True
+        return file_hash
+
+    def save(self, prune: bool = False):
+        """Write the cache if it changed, `prune` drops entries unused since the last prune."""
+        with self._lock:
+            if prune:
+                unused = self._entries.keys() - self._used
+                for key in unused:
+                    del self._entries[key]
+                self._dirty = self._dirty or bool(unused)
+                self._used = set()
+            if not self._dirty or not self.cache_file:
+                return
+            data = json.dumps(self._entries)
+            self._dirty = False
+
+        tmp_file = self.cache_file.with_suffix('.tmp')
+        with open(tmp_file, 'w') as f:
+            f.write(data)
+        os.replace(tmp_file, self.cache_file)
+
+
+def hash_build_context(context_path: Path, cache: Optional[HashCache] = None) -> str:
+    digest = hashlib.sha256()
+    for path in iter_context_files(context_path):
+        digest.update(str(path.relative_to(context_path)).encode())
+        digest.update(b'\0')
+        digest.update((cache.file_hash(path) if cache else _file_hash(path)).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def build_hashes(app_path: Path, cache: Optional[HashCache] = None) -> Dict[str, str]:
+    """Hash the image inputs of every service built from a local context.
+
+    Covers the context (respecting .dockerignore), the Dockerfile, which
+    docker reads even when it is ignored or outside the context, and the
+    service's build options.
+
+    Services whose context can't be hashed get an empty hash, their image
+    is rebuilt whenever the app is brought up.
+    """
+    context_hashes = {}
+    hashes = {}
+    for service, spec in find_build_services(app_path).items():
+        if spec.context is None:
+            hashes[service] = UNKNOWN_HASH
+            continue
+        if spec.context not in context_hashes:
+            context_hashes[spec.context] = hash_build_context(spec.context, cache)
+        digest = hashlib.sha256()
+        digest.update(json.dumps(spec.config, sort_keys=True, default=str).encode())
+        digest.update(context_hashes[spec.context].encode())
+        digest.update((cache.file_hash(spec.dockerfile) if cache else _file_hash(spec.dockerfile)).encode())
+        hashes[service] = digest.hexdigest()
+    return hashes
+
+
+def app_fingerprint(repo_path: Path, app: AppConfig,
+                    service_hashes: Optional[Dict[str, str]] = None,
+                    extra_files: Iterable[Path] = ()) -> str:
+    """Hash everything that affects `docker-compose up` for an app.
+
+    Covers the app's `.cm.yaml` entry, its compose files, `extra_files`
+    they refer to (`extends` files, env files) and the build inputs of its
+    services, see `build_hashes`.
+    """
+    app_path = repo_path / app.path
+    if service_hashes is None:
+        service_hashes = build_hashes(app_path)
+    digest = hashlib.sha256()
+    digest.update(json.dumps(app.model_dump(), sort_keys=True).encode())
+
+    for compose_file in find_compose_files(app_path):
+        digest.update(compose_file.name.encode())
+        digest.update(b'\0')
+        _hash_file(digest, compose_file)
+
+    for extra_file in extra_files:
+        digest.update(str(extra_file).encode())
+        digest.update(b'\0')
+        if extra_file.is_file():
+            _hash_file(digest, extra_file)
+        else:
+            digest.update(b'<missing>')
+
+    digest.update(json.dumps(service_hashes, sort_keys=True).encode())
+    return digest.hexdigest()
@@ -0,0 +1,129 @@
+import logging
+import subprocess
+import threading
+from pathlib import Path
+from typing import Callable, List, Optional, Set
+
+from watchdog.events import (EVENT_TYPE_CLOSED, EVENT_TYPE_CLOSED_NO_WRITE, EVENT_TYPE_OPENED,
+                             FileSystemEventHandler)
+from watchdog.observers.api import BaseObserver, ObservedWatch
+
+# Seconds a git command may take before the change is treated as unknown
+GIT_TIMEOUT = 60
+
+
+class GitError(Exception):
+    pass
+
+
+def git(repo_path: Path, *args: str) -> str:
+    """Run a git command in `repo_path` and return its output, raises GitError if it fails."""
+    try:
+        result = subprocess.run(
+            ['git', *args],
+            cwd=repo_path,
+            stdin=subprocess.DEVNULL,
+            capture_output=True,
+            text=True,
+            timeout=GIT_TIMEOUT
+        )
+    except (OSError, subprocess.TimeoutExpired) as e:
+        raise GitError(f"git {args[0]} failed: {e}") from e
+    if result.returncode != 0:
+        raise GitError(f"git {args[0]} failed: {result.stderr.strip()}")
+    return result.stdout
+
+
+class _RefHandler(FileSystemEventHandler):
+    def __init__(self, source: 'GitChangeSource'):
+        self.source = source
+
+    def on_any_event(self, event):
+        # git reads HEAD all the time, rev-parse included, only writes matter
+        if event.event_type in (EVENT_TYPE_OPENED, EVENT_TYPE_CLOSED, EVENT_TYPE_CLOSED_NO_WRITE):
+            return
+        paths = [event.src_path, getattr(event, 'dest_path', '')]
+        if any(self.source.is_ref(path) for path in paths if path):
+            self.source.check()
+
+
+class GitChangeSource:
+    """Detects changes to a git checkout from the commits its HEAD moves to.
+
+    Only HEAD, packed-refs and the refs directory are watched, not the
+    working tree. When HEAD resolves to another commit, a single
+    `git diff --name-only` between the old and the new commit yields the
+    changed paths, relative to `repo_path`, which are passed to `callback`.
+    The callback receives None when the changes can't be determined, for
+    example after a history rewrite dropped the old commit.
+
+    Uncommitted edits to the working tree go unnoticed.
+    """
+
+    def __init__(self, repo_path: Path, callback: Callable[[Optional[Set[str]]], None],
+                 logger: logging.Logger):
+        self.repo_path = repo_path
+        self.callback = callback
+        self.logger = logger
+        # raises GitError if repo_path isn't inside a git checkout
+        self.git_dir = Path(git(repo_path, 'rev-parse', '--absolute-git-dir').strip()).resolve()
+        self.head = self._resolve_head()
+        self._lock = threading.Lock()
+
+    def schedule(self, observer: BaseObserver) -> List[ObservedWatch]:
+        """Watch the refs of the checkout, but not its working tree, with `observer`."""
+        handler = _RefHandler(self)
+        watches = [observer.schedule(handler, str(self.git_dir), recursive=False)]
+        refs_path = self.git_dir / 'refs'
+        if refs_path.is_dir():
+            watches.append(observer.schedule(handler, str(refs_path), recursive=True))
+        return watches
+
+    def is_ref(self, path: str) -> bool:
+        try:
+            rel_path = Path(path).relative_to(self.git_dir).as_posix()
+        except ValueError:
+            return False
+        if rel_path.endswith('.lock'):
+            # written first and renamed into place, the rename is seen as well
+            return False
+        return rel_path in ('HEAD', 'packed-refs') or rel_path.startswith('refs/')
+
+    def _resolve_head(self) -> Optional[str]:
+        try:
+            return git(self.repo_path, 'rev-parse', '--verify', '-q', 'HEAD^{commit}').strip()
+        except GitError:
+            # no commit yet
+            return None
+
+    def _changed_paths(self, old: str, new: str) -> List[str]:
+        # renames count as a deletion and an addition, both paths matter
+        output = git(self.repo_path, 'diff', '--name-only', '--no-renames', '--relative',
+                     '-z', old, new, '--')
+        return [path for path in output.split('\0') if path]
+
+    def check(self):
+        """Report the paths changed since the last check, if HEAD moved."""
+        with self._lock:
+            head = self._resolve_head()
+            if head == self.head:
+                return
+            old, self.head = self.head, head
+            if old is None or head is None:
+                changed_paths = None
+            else:
+                try:
+                    changed_paths = set(self._changed_paths(old, head))
+                except GitError as e:
+                    self.logger.warning(f"Can't tell the paths changed by {old[:12]}..{head[:12]}: {e}")
+                    changed_paths = None
+
+            moved = f"{(old or 'nothing')[:12]} to {(head or 'nothing')[:12]}"
+            if changed_paths is None:
+                self.logger.info(f"HEAD moved from {moved}")
+            else:
+                self.logger.info(f"HEAD moved from {moved}, {len(changed_paths)} path(s) changed")
+            try:
+                self.callback(changed_paths)
+            except Exception as e:
+                self.logger.error(f"Failed to handle git changes: {e}")
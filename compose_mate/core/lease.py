@@ -0,0 +1,190 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Optional
+
+# Seconds without a heartbeat after which a holder is considered hung
+LEASE_TTL = 30.0
+
+
+class NotLeaseHolder(Exception):
+    pass
+
+
+class Lease:
+    """Makes sure only one instance acts on a repository, through files in its state directory.
+
+    The holder keeps an exclusive flock on `lease.lock` and renews a
+    heartbeat in `lease.json` every third of `ttl`. Other instances stand by
+    and try to take over: right away once the holder died and the kernel
+    dropped its lock, or once its heartbeat is older than `ttl` while it
+    hangs, by replacing the lock file it still has locked.
+
+    Every new holder increments the fencing token in `lease.json`. A holder
+    that finds the lock file replaced or another token there lost the lease;
+    `check` tells whether it may still act before every side effect.
+    """
+
+    def __init__(self, state_path: Path, logger: logging.Logger,
+                 on_acquired: Callable[[], None], on_lost: Callable[[], None],
+                 ttl: float = LEASE_TTL):
+        self.lock_path = state_path / 'lease.lock'
+        self.info_path = state_path / 'lease.json'
+        # serializes the changes of lease.json, held only for a moment
+        self.guard_path = state_path / 'lease.guard'
+        self.logger = logger
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self.ttl = ttl
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        # fencing token while the lease is held
+        self.token: Optional[int] = None
+        self._fd: Optional[int] = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='cm-lease', daemon=True)
+
+    @property
+    def held(self) -> bool:
+        return self.token is not None
+
+    def start(self):
+        """Try to take the lease right away, then keep renewing or trying in the background."""
+        self._tick()
+        self._thread.start()
+
+    def stop(self):
+        """Stop renewing and give the lease up, a standby takes over without waiting for the ttl."""
+        self._stopped.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._lock:
+            if self._fd is None:
+                return
+            with self._guard():
+                if self._owns_lock() and self._read().get('token') == self.token:
+                    self._write(heartbeat=0)
+            self._close()
+
+    def check(self) -> bool:
+        """Return whether the lease is still held, as recorded on disk and not just in memory."""
+        with self._lock:
+            return self._fd is not None and self._owns_lock() and \
+                self._read().get('token') == self.token
+
+    def _run(self):
+        while not self._stopped.wait(self.ttl / 3):
+            self._tick()
+
+    def _tick(self):
+        try:
+            with self._lock:
+                if self._fd is not None:
+                    lost = not self._renew()
+                    acquired = False
+                else:
+                    lost = False
+                    acquired = self._acquire()
+        except OSError as e:
+            self.logger.error(f"Failed to update the lease: {e}")
+            return
+        try:
+            if acquired:
+                self.logger.info(f"Acquired the lease of {self.lock_path.parent}, token {self.token}")
+                self.on_acquired()
+            elif lost:
+                self.logger.error(f"Lost the lease of {self.lock_path.parent} to another instance")
+                self.on_lost()
+        except Exception as e:
+            self.logger.exception(f"Failed to handle the lease change: {e}")
+
+    def _acquire(self) -> bool:
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return self._take_over()
+
+        with self._guard():
+            self._fd = fd
+            if not self._owns_lock():
+                # a standby replaced the lock file since we opened it
+                self._close()
+                return False
+            self.token = self._read().get('token', 0) + 1
+            self._write()
+        return True
+
+    def _take_over(self) -> bool:
+        """Replace the lock file of a holder that stopped renewing its heartbeat."""
+        with self._guard():
+            info = self._read()
+            if 'heartbeat' not in info or time.time() - info['heartbeat'] <= self.ttl:
+                return False
+            # the holder keeps its lock on the old file, which is no longer the lock file
+            tmp_path = self.lock_path.with_name(f"{self.lock_path.name}.{self.holder}")
+            fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.replace(tmp_path, self.lock_path)
+            self._fd = fd
+            self.token = info.get('token', 0) + 1
+            self._write()
+            self.logger.warning(f"Took the lease over from {info.get('holder')}, "
+                                f"no heartbeat for {time.time() - info['heartbeat']:.0f}s")
+        return True
+
+    def _renew(self) -> bool:
+        with self._guard():
+            if not self._owns_lock() or self._read().get('token') != self.token:
+                self._close()
+                return False
+            self._write()
+        return True
+
+    def _owns_lock(self) -> bool:
+        try:
+            path_stat = os.stat(self.lock_path)
+        except FileNotFoundError:
+            return False
+        fd_stat = os.fstat(self._fd)
+        return (path_stat.st_dev, path_stat.st_ino) == (fd_stat.st_dev, fd_stat.st_ino)
+
+    def _close(self):
+        os.close(self._fd)
+        self._fd = None
+        self.token = None
+
+    @contextmanager
+    def _guard(self):
+        fd = os.open(self.guard_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(fd)
+
+    def _read(self) -> dict:
+        try:
+            with open(self.info_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, heartbeat: Optional[float] = None):
+        tmp_path = self.info_path.with_name(f"{self.info_path.name}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'holder': self.holder,
+                'token': self.token,
+                'heartbeat': time.time() if heartbeat is None else heartbeat,
+            }, f)
+        os.replace(tmp_path, self.info_path)
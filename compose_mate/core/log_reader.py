@@ -0,0 +1,149 @@
+import asyncio
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
+
+BLOCK_SIZE = 64 * 1024
+# Upper bound of bytes read for one page, whatever the line lengths are
+MAX_PAGE_BYTES = 1024 * 1024
+# RotatingFileHandler backups looked at, matches the handlers' backupCount
+MAX_BACKUPS = 5
+
+
+@dataclass
+class LogPage:
+    lines: List[str]
+    # pass back to `read_page` to get the lines right before this page, None at the start
+    cursor: Optional[str]
+
+
+def log_files(path: Path, max_backups: int = MAX_BACKUPS) -> List[Path]:
+    """Return the log file and its rotated backups, newest first."""
+    files = [path] if path.exists() else []
+    for i in range(1, max_backups + 1):
+        backup = path.with_name(f"{path.name}.{i}")
+        if backup.exists():
+            files.append(backup)
+    return files
+
+
+def _read_backward(f, end: int, n: int, max_bytes: int) -> Tuple[List[bytes], int]:
+    """Read up to `n` lines ending at offset `end`, return them and their start offset."""
+    pos = end
+    data = b''
+    while pos > 0 and data.count(b'\n') <= n and end - pos < max_bytes:
+        size = min(BLOCK_SIZE, pos, max_bytes - (end - pos))
+        pos -= size
+        f.seek(pos)
+        data = f.read(size) + data
+
+    lines = data.split(b'\n')
+    if lines and lines[-1] == b'':
+        # content ends with a newline
+        lines.pop()
+    if pos > 0 and len(lines) > 1:
+        # the first line is incomplete unless we reached the start of the file
+        pos += len(lines[0]) + 1
+        lines = lines[1:]
+    if len(lines) > n:
+        pos += sum(len(line) + 1 for line in lines[:-n])
+        lines = lines[-n:]
+    return lines, pos
+
+
+def _encode_cursor(path: Path, offset: int) -> str:
+    return f"{os.stat(path).st_ino}:{offset}"
+
+
+def _decode_cursor(files: List[Path], cursor: str) -> Tuple[int, int]:
+    """Find the file a cursor points into, rotation may have renamed it since."""
+    inode, _, offset = cursor.partition(':')
+    for index, file in enumerate(files):
+        if str(os.stat(file).st_ino) == inode:
+            return index, int(offset)
+    raise ValueError('Log cursor expired, the file was rotated away')
+
+
+def read_page(path: Path, lines: int = 200, cursor: Optional[str] = None,
+              max_bytes: int = MAX_PAGE_BYTES, max_backups: int = MAX_BACKUPS) -> LogPage:
+    """Read `lines` lines backward from the end of a log, or from `cursor`.
+
+    Continues into rotated backups (`.1` ... `.5`) when the current file has
+    fewer lines. Memory use is bounded by `max_bytes` regardless of log size.
+    """
+    files = log_files(path, max_backups)
+    if not files:
+        return LogPage([], None)
+
+    if cursor is None:
+        index, end = 0, files[0].stat().st_size
+    else:
+        index, end = _decode_cursor(files, cursor)
+
+    collected: List[bytes] = []
+    budget = max_bytes
+    while index < len(files):
+        with open(files[index], 'rb') as f:
+            chunk, start = _read_backward(f, end, lines - len(collected), budget)
+        collected = chunk + collected
+        budget -= sum(len(line) + 1 for line in chunk)
+        if len(collected) >= lines or budget <= 0:
+            next_cursor = _encode_cursor(files[index], start) if start > 0 else None
+            if next_cursor is None and index + 1 < len(files):
+                next_cursor = _encode_cursor(files[index + 1], files[index + 1].stat().st_size)
+            return LogPage([line.decode(errors='replace') for line in collected], next_cursor)
+        index += 1
+        if index < len(files):
+            end = files[index].stat().st_size
+
+    return LogPage([line.decode(errors='replace') for line in collected], None)
+
+
+def tail(path: Path, lines: int = 200, max_bytes: int = MAX_PAGE_BYTES,
+         max_backups: int = MAX_BACKUPS) -> str:
+    """Return the last `lines` lines of a log, at most `max_bytes` of them."""
+    return '\n'.join(read_page(path, lines, max_bytes=max_bytes, max_backups=max_backups).lines)
+
+
+async def follow(path: Path, poll_interval: float = 1.0,
+                 from_end: bool = True) -> AsyncIterator[str]:
+    """Yield lines appended to a log as they are written, across rotations."""
+    f = None
+    inode = None
+    pending = b''
+    try:
+        while True:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                stat = None
+
+            if stat is not None and stat.st_ino != inode:
+                # first open or the file was rotated, start over with the new one
+                if f:
+                    for line in (pending + f.read(MAX_PAGE_BYTES)).splitlines():
+                        yield line.decode(errors='replace')
+                    f.close()
+                f = open(path, 'rb')
+                if inode is None and from_end:
+                    f.seek(0, os.SEEK_END)
+                inode = stat.st_ino
+                pending = b''
+
+            if f:
+                data = f.read(MAX_PAGE_BYTES)
+                if data:
+                    lines = (pending + data).split(b'\n')
+                    pending = lines.pop()
+                    if len(pending) > MAX_PAGE_BYTES:
+                        lines.append(pending)
+                        pending = b''
+                    for line in lines:
+                        yield line.decode(errors='replace')
+                    continue
+
+            await asyncio.sleep(poll_interval)
+    finally:
+        if f:
+            f.close()
@@ -1,20 +1,119 @@
 import logging
-import sys
-from logging.handlers import RotatingFileHandler
+import queue
+import threading
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from compose_mate.core.events import EventBus, LOG_APPENDED
+
+MAIN_LOGGER = 'compose_mate'
+
+
+class _FileDispatcher(logging.Handler):
+    """Writes queued records to the file of the logger they came from.
+
+    Runs on the QueueListener thread only. File handlers are opened lazily
+    and at most `max_open_files` of them keep their file open; the least
+    recently used one is closed first and reopened on its next record.
+    """
+
+    def __init__(self, events: Optional[EventBus], max_open_files: int, main_name: str):
+        super().__init__()
+        self.events = events
+        self.main_name = main_name
+        self.max_open_files = max_open_files
+        # logger name -> (file handler, app id, task id)
+        self.routes: Dict[str, Tuple[RotatingFileHandler, Optional[str], Optional[str]]] = {}
+        self.routes_lock = threading.Lock()
+        self._open: 'OrderedDict[str, RotatingFileHandler]' = OrderedDict()
+
+    def add_route(self, name: str, handler: RotatingFileHandler,
+                  app_id: Optional[str] = None, task_id: Optional[str] = None):
+        with self.routes_lock:
+            self.routes[name] = (handler, app_id, task_id)
+
+    def emit(self, record: logging.LogRecord):
+        with self.routes_lock:
+            route = self.routes.get(record.name) or self.routes.get(self.main_name)
+        if route is None:
+            return
+        handler, app_id, task_id = route
+
+        self._open[record.name] = handler
+        self._open.move_to_end(record.name)
+        while len(self._open) > self.max_open_files:
+            _, evicted = self._open.popitem(last=False)
+            self._close_stream(evicted)
+
+        handler.handle(record)
+        if self.events and task_id:
+            self.events.publish(LOG_APPENDED, app_id, task_id)
+
+    @staticmethod
+    def _close_stream(handler: RotatingFileHandler):
+        handler.acquire()
+        try:
+            if handler.stream:
+                handler.stream.close()
+                handler.stream = None
+        finally:
+            handler.release()
+
+    def close(self):
+        with self.routes_lock:
+            for handler, _, _ in self.routes.values():
+                handler.close()
+        super().close()
 
 
 class LogManager:
-    def __init__(self, state_path: Path):
+    """Registry of the main, app and task loggers.
+
+    Each logger gets its handler once, no matter how often it is requested.
+    Loggers only put records on a queue, a single listener thread does the
+    formatting and file I/O so callers never block on disk.
+
+    Repositories sharing a process get loggers of their own below `name`.
+    Records of the process wide loggers, below MAIN_LOGGER, end up in the
+    main log of each of them.
+    """
+
+    def __init__(self, state_path: Path, events: Optional[EventBus] = None,
+                 max_bytes: int = 1024 * 1024, backup_count: int = 5,
+                 max_open_files: int = 64, name: str = MAIN_LOGGER):
         self.state_path = state_path
+        self.name = name
+        self.events = events
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
         self.log_path = state_path / 'logs'
         self.log_path.mkdir(parents=True, exist_ok=True)
 
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._queue_handler = QueueHandler(self._queue)
+        self._dispatcher = _FileDispatcher(events, max(max_open_files, 1), name)
+        self._listener = QueueListener(self._queue, self._dispatcher)
+        self._loggers: Dict[str, logging.Logger] = {}
+        self._lock = threading.Lock()
+
         # Setup main logger
         self._setup_main_logger()
+        self._listener.start()
+
+    def _file_handler(self, path: Path, fmt: str) -> RotatingFileHandler:
+        handler = RotatingFileHandler(
+            path,
+            maxBytes=self.max_bytes,
+            backupCount=self.backup_count,
+            delay=True
+        )
+        handler.setFormatter(logging.Formatter(fmt))
+        return handler
 
     def _setup_main_logger(self):
-        logger = logging.getLogger('compose_mate')
+        logger = logging.getLogger(self.name)
         logger.setLevel(logging.INFO)
 
         # # Console handler
@@ -24,58 +123,67 @@ class LogManager:
         # ))
         # logger.addHandler(console)
 
-        # File handler
-        file_handler = RotatingFileHandler(
+        # File handler, records of child loggers that propagate end up here too
+        self._dispatcher.add_route(self.name, self._file_handler(
             self.log_path / 'cm.log',
-            maxBytes=1024 * 1024,  # 1MB
-            backupCount=5
-        )
-        file_handler.setFormatter(logging.Formatter(
             '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
         ))
-        logger.addHandler(file_handler)
+        logger.addHandler(self._queue_handler)
+        if self.name != MAIN_LOGGER:
+            # the process wide logger has a handler per repository already
+            logger.propagate = False
+            logging.getLogger(MAIN_LOGGER).setLevel(logging.INFO)
+            logging.getLogger(MAIN_LOGGER).addHandler(self._queue_handler)
 
-    def get_main_logger(self) -> logging.Logger:
-        return logging.getLogger('compose_mate')
+    def _get_logger(self, name: str, log_file: Path, app_id: str,
+                    task_id: Optional[str] = None) -> logging.Logger:
+        with self._lock:
+            logger = self._loggers.get(name)
+            if logger is not None:
+                return logger
 
-    def get_app_logger(self, app_id: str) -> logging.Logger:
-        logger = logging.getLogger(f'compose_mate.app.{app_id}')
-        # Prevent propagation to parent loggers
-        logger.propagate = False
-        logger.setLevel(logging.INFO)
+            logger = logging.getLogger(name)
+            # Prevent propagation to parent loggers
+            logger.propagate = False
+            logger.setLevel(logging.INFO)
 
-        app_log_dir = self.log_path / app_id
-        app_log_dir.mkdir(parents=True, exist_ok=True)
-
-        handler = RotatingFileHandler(
-            app_log_dir / 'app.log',
-            maxBytes=1024 * 1024,
-            backupCount=5
-        )
-        handler.setFormatter(logging.Formatter(
-            '%(asctime)s - %(levelname)s - %(message)s'
-        ))
-        logger.addHandler(handler)
+            log_file.parent.mkdir(parents=True, exist_ok=True)
+            self._dispatcher.add_route(name, self._file_handler(
+                log_file,
+                '%(asctime)s - %(levelname)s - %(message)s'
+            ), app_id, task_id)
+            logger.addHandler(self._queue_handler)
 
-        return logger
+            self._loggers[name] = logger
+            return logger
 
-    def get_task_logger(self, app_id: str, task_id: str) -> logging.Logger:
-        logger = logging.getLogger(f'compose_mate.app.{app_id}.task.{task_id}')
-        # Prevent propagation to parent loggers
-        logger.propagate = False
-        logger.setLevel(logging.INFO)
+    def get_main_logger(self) -> logging.Logger:
+        return logging.getLogger(self.name)
 
-        task_log_dir = self.log_path / app_id / 'tasks'
-        task_log_dir.mkdir(parents=True, exist_ok=True)
+    def get_app_logger(self, app_id: str) -> logging.Logger:
+        return self._get_logger(
+            f'{self.name}.app.{app_id}',
+            self.log_path / app_id / 'app.log',
+            app_id
+        )
 
-        handler = RotatingFileHandler(
-            task_log_dir / f'{task_id}.log',
-            maxBytes=1024 * 1024,
-            backupCount=5
+    def get_task_logger(self, app_id: str, task_id: str) -> logging.Logger:
+        return self._get_logger(
+            f'{self.name}.app.{app_id}.task.{task_id}',
+            self.log_path / app_id / 'tasks' / f'{task_id}.log',
+            app_id,
+            task_id
         )
-        handler.setFormatter(logging.Formatter(
-            '%(asctime)s - %(levelname)s - %(message)s'
-        ))
-        logger.addHandler(handler)
 
-        return logger
+    def pending(self) -> int:
+        """Return the number of records waiting to be written."""
+        return self._queue.qsize()
+
+    def stop(self):
+        """Flush queued records and close every log file."""
+        self._listener.stop()
+        logging.getLogger(self.name).removeHandler(self._queue_handler)
+        logging.getLogger(MAIN_LOGGER).removeHandler(self._queue_handler)
+        for logger in self._loggers.values():
+            logger.removeHandler(self._queue_handler)
+        self._dispatcher.close()
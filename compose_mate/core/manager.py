@@ -1,23 +1,42 @@
-import json
-import subprocess
+import os
+import threading
+import time
+from concurrent.futures import Future, wait
 from datetime import datetime
 from pathlib import Path
-from typing import List
+from typing import AsyncIterator, Dict, List, Mapping, Optional, Set
 
 import pathspec
-import yaml
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.triggers.base import BaseTrigger
 from watchdog.events import FileSystemEventHandler
-from watchdog.observers import Observer
 
+from compose_mate.core.backend import EngineBackend, project_name
+from compose_mate.core.compose_model import ComposeModel, ComposeModelCache
+from compose_mate.core.container_watcher import ContainerWatcher
+from compose_mate.core.config import ConfigStore
+from compose_mate.core.docker_api import DEFAULT_SOCKET
+from compose_mate.core.events import EventBus, APP_RECONCILED, APP_REMOVED, CONFIG_CHANGED
+from compose_mate.core import log_reader
 from compose_mate.core.executor import TaskExecutor
+from compose_mate.core.fingerprint import UNKNOWN_HASH, HashCache, app_fingerprint, build_hashes
+from compose_mate.core.git_source import GitChangeSource, GitError
 from compose_mate.core.models import AppConfig, State, AppState, TaskState
-from compose_mate.core.logging_utils import LogManager
+from compose_mate.core.reconcile_queue import ReconcileQueue
+from compose_mate.core.logging_utils import MAIN_LOGGER, LogManager
+from compose_mate.core.lease import LEASE_TTL, Lease
+from compose_mate.core.metrics import RECONCILE_APP_DURATION, RECONCILE_DURATION, RECONCILE_ERRORS
+from compose_mate.core.runner import CommandError
+from compose_mate.core.runtime import Runtime
+from compose_mate.core.state_store import create_state_store
+from compose_mate.core.watcher import AppPathIndex, ChangeCoalescer
+
+CONFIG_FILE = '.cm.yaml'
 
 
 class ConfigChangeHandler(FileSystemEventHandler):
-    def __init__(self, manager):
+    def __init__(self, manager, coalescer: ChangeCoalescer):
         self.manager = manager
+        self.coalescer = coalescer
         self.logger = manager.log_manager.get_main_logger()
 
         # Convert repo_path to absolute path
@@ -33,7 +52,7 @@ class ConfigChangeHandler(FileSystemEventHandler):
 
     def _load_gitignore(self):
         gitignore_path = self.abs_repo_path / '.gitignore'
-        patterns = []
+        patterns = ['.git/']
 
         if gitignore_path.exists():
             with open(gitignore_path) as f:
@@ -41,202 +60,511 @@ class ConfigChangeHandler(FileSystemEventHandler):
 
         # Add state path pattern
         if self.state_rel_path:
-            patterns.append(str(self.state_rel_path))
+            patterns.append(f"{self.state_rel_path}/")
 
         return pathspec.PathSpec.from_lines(
             pathspec.patterns.GitWildMatchPattern,
             patterns
         )
 
+    def on_created(self, event):
+        self._handle_path(event.src_path, event.is_directory)
+
     def on_modified(self, event):
-        try:
-            # Convert both paths to absolute before comparing
-            abs_path = Path(event.src_path).resolve()
-            rel_path = abs_path.relative_to(self.abs_repo_path)
+        # directory mtime updates are implied by the events of their entries
+        if not event.is_directory:
+            self._handle_path(event.src_path, event.is_directory)
 
-            # Skip if path is under state directory or matches gitignore
-            if (self.state_rel_path and str(rel_path).startswith(str(self.state_rel_path))) or \
-                    self.gitignore.match_file(str(rel_path)):
-                return
+    def on_deleted(self, event):
+        self._handle_path(event.src_path, event.is_directory)
+
+    def on_moved(self, event):
+        self._handle_path(event.src_path, event.is_directory)
+        self._handle_path(event.dest_path, event.is_directory)
 
-            self.logger.info(f"File changed: {event.src_path}")
-            self.manager.reconcile()
+    def _handle_path(self, src_path: str, is_directory: bool):
+        # deleted paths can't be resolved, and os.path.abspath is enough for
+        # paths watchdog reports under the (resolved) watch root
+        abs_path = Path(os.path.abspath(src_path))
+        try:
+            rel_path = abs_path.relative_to(self.abs_repo_path).as_posix()
         except ValueError:
             # Path is not relative to repo_path
-            pass
+            return
+
+        if rel_path == '.gitignore':
+            self.gitignore = self._load_gitignore()
+        elif rel_path == CONFIG_FILE:
+            # readers see the new config right away, reconcile follows after the quiet window
+            self.manager.config_store.invalidate()
+        if self.gitignore.match_file(f"{rel_path}/" if is_directory else rel_path):
+            return
+        if rel_path != CONFIG_FILE and not self.manager.app_index.lookup(rel_path):
+            # not part of any app, nothing to reconcile
+            return
+
+        self.logger.info(f"File changed: {src_path}")
+        self.coalescer.add(rel_path)
 
 
 class ComposeManager:
-    def __init__(self, repo_path: str, state_path: str):
+    def __init__(self, repo_path: str, state_path: str,
+                 watch_quiet_window: float = 1.0, watch_max_delay: float = 10.0,
+                 parallelism: int = 4, max_builds: int = 2,
+                 docker_backend: str = 'auto', docker_socket: str = DEFAULT_SOCKET,
+                 log_max_bytes: int = 1024 * 1024, log_backup_count: int = 5,
+                 state_backend: str = 'sqlite', task_workers: int = 4,
+                 task_workers_per_app: int = 2, cron_stagger: float = 0,
+                 heal_services: bool = False, change_source: str = 'files',
+                 runtime: Optional[Runtime] = None, name: Optional[str] = None,
+                 lease_ttl: float = LEASE_TTL):
         self.repo_path = Path(repo_path)
         self.state_path = Path(state_path)
-        self.state_file = self.state_path / 'state.json'
+        # set when several repositories share a runtime, keeps their jobs and logs apart
+        self.name = name
+
+        # state changes are pushed to web sessions through the event bus
+        self.events = EventBus()
 
         # Initialize logging
-        self.log_manager = LogManager(self.state_path)
+        self.log_manager = LogManager(
+            self.state_path,
+            self.events,
+            max_bytes=log_max_bytes,
+            backup_count=log_backup_count,
+            name=f"{MAIN_LOGGER}.{name}" if name else MAIN_LOGGER
+        )
         self.logger = self.log_manager.get_main_logger()
-
-        self.scheduler = BackgroundScheduler()
-        self.executor = TaskExecutor(self)
-
-        # configure file monitoring
-        self.observer = Observer()
-        self.observer.schedule(
-            ConfigChangeHandler(self),
-            str(self.repo_path),
-            recursive=True
+        self.config_store = ConfigStore(self.repo_path / CONFIG_FILE, self.logger)
+        self._reconciled_digest = None
+        # unchanged build context files are not read again
+        self.hash_cache = HashCache(self.state_path / 'hash-cache.json')
+        # effective compose definitions, to bring up only the services that changed
+        self.compose_models = ComposeModelCache(self.hash_cache)
+        self.store = create_state_store(state_backend, self.state_path, self.logger)
+
+        # scheduler, processes, workers, file and container watching may be shared
+        self._owns_runtime = runtime is None
+        if runtime is None:
+            runtime = Runtime(self.logger, parallelism=parallelism, max_builds=max_builds,
+                              docker_backend=docker_backend, docker_socket=docker_socket,
+                              task_workers=task_workers, task_workers_per_app=task_workers_per_app)
+        self.runtime = runtime
+        self.scheduler = runtime.scheduler
+        self.runner = runtime.runner
+        self.backend = runtime.backend
+        self.reconcile_pool = runtime.reconcile_pool
+        self.build_slots = runtime.build_slots
+        self.observer = runtime.observer
+        self.executor = TaskExecutor(self, runtime.task_queue, stagger=cron_stagger)
+        self.container_watcher = None
+        if runtime.container_events:
+            self.container_watcher = ContainerWatcher(self, heal=heal_services)
+
+        self.state_lock = threading.RLock()
+        # one reconcile at a time, requests made meanwhile share the next run
+        self.reconcile_queue = ReconcileQueue(self._reconcile, self.logger)
+
+        # configure file monitoring, bursts of changes are batched into one reconcile
+        # built from the config right away, file events arriving before the
+        # first reconcile finished are routed like later ones
+        self.app_index = AppPathIndex(self.repo_path, self.config_store.snapshot().apps,
+                                      self.compose_models)
+        self.change_coalescer = ChangeCoalescer(
+            self._on_files_changed,
+            self.logger,
+            quiet_window=watch_quiet_window,
+            max_delay=watch_max_delay
         )
+        self.git_source = None
+        if change_source == 'git':
+            try:
+                self.git_source = GitChangeSource(self.repo_path, self._on_commits, self.logger)
+            except GitError as e:
+                self.logger.error(f"Can't follow git commits, watching files instead: {e}")
+        if self.git_source:
+            # a pull only moves a ref, the working tree isn't watched at all
+            self._watches = self.git_source.schedule(self.observer)
+        else:
+            self._watches = [self.observer.schedule(
+                ConfigChangeHandler(self, self.change_coalescer),
+                str(self.repo_path.resolve()),
+                recursive=True
+            )]
+
+        # only the instance holding the lease of the state directory acts on the repository
+        self.lease = Lease(self.state_path, self.logger, self._on_lease_acquired,
+                           self._on_lease_lost, ttl=lease_ttl)
 
         # start server
         self.state = State(apps={}, tasks={})
-        self.load_state()
-        self.scheduler.start()
-        self.observer.start()
-        self.reconcile()
+        self.startup_reconcile: Optional[Future] = None
+        # containers may have stopped while no instance held the lease
+        self._verify_running = False
+        runtime.register(self)
+        runtime.start()
+        self.reconcile_queue.start()
+        if self.container_watcher:
+            runtime.container_events.add(self.container_watcher)
+        self.change_coalescer.start()
+        self.lease.start()
+        if self.startup_reconcile is None:
+            self.logger.info(f"Standing by, another instance holds the lease of {self.state_path}")
+            self.startup_reconcile = self.request_reconcile()
+
+    def _on_lease_acquired(self):
+        with self.state_lock:
+            self.load_state()
+        self.events.publish(CONFIG_CHANGED)
+        # apps whose containers still run with an unchanged fingerprint are
+        # adopted as they are, everything else is brought up in the background
+        self._verify_running = True
+        self.startup_reconcile = self.request_reconcile()
+
+    def _on_lease_lost(self):
+        # another instance runs the tasks now, stop everything that could act twice
+        self.executor.unschedule_stale(())
+        if self.container_watcher:
+            self.container_watcher.close()
+        self.executor.cancel_all()
+        with self.state_lock:
+            self.state = State(apps={}, tasks={})
+        self.events.publish(CONFIG_CHANGED)
 
     def load_state(self):
-        if self.state_file.exists():
-            try:
-                with open(self.state_file) as f:
-                    data = json.load(f)
-                    self.state = State(**data)
-            except (json.JSONDecodeError, ValueError) as e:
-                self.logger.error(f"Failed to load state file: {e}")
-                # keep the default state
+        self.state = self.store.load()
 
     def save_state(self):
-        # ensure state directory exists
-        self.state_file.parent.mkdir(parents=True, exist_ok=True)
-        with open(self.state_file, 'w') as f:
-            json.dump(self.state.dict(), f, indent=2)
+        """Wait until every state change made so far is persisted."""
+        self.store.flush()
+
+    def set_app_state(self, app_state: AppState):
+        with self.state_lock:
+            self.state.apps[app_state.id] = app_state
+            self.store.put_app(app_state)
+
+    def update_app_state(self, app_id: str, **changes):
+        with self.state_lock:
+            if app_id in self.state.apps:
+                self.set_app_state(self.state.apps[app_id].model_copy(update=changes))
+
+    def remove_app_state(self, app_id: str):
+        with self.state_lock:
+            if self.state.apps.pop(app_id, None) is not None:
+                self.store.delete_app(app_id)
+
+    def set_task_state(self, task_key: str, task_state: TaskState):
+        with self.state_lock:
+            self.state.tasks[task_key] = task_state
+            self.store.put_task(task_key, task_state)
+
+    def update_task_state(self, task_key: str, **changes):
+        with self.state_lock:
+            if task_key in self.state.tasks:
+                self.set_task_state(task_key, self.state.tasks[task_key].model_copy(update=changes))
+
+    def remove_task_state(self, task_key: str):
+        with self.state_lock:
+            if self.state.tasks.pop(task_key, None) is not None:
+                self.store.delete_task(task_key)
 
     def load_config(self) -> List[AppConfig]:
-        config_file = self.repo_path / '.cm.yaml'
-        if not config_file.exists():
-            return []
+        return list(self.config_store.snapshot().apps)
+
+    def _on_files_changed(self, changed_paths: Set[str]):
+        self.logger.info(f"Reconciling after {len(changed_paths)} changed path(s)")
+        self.request_reconcile(changed_paths)
+
+    def _on_commits(self, changed_paths: Optional[Set[str]]):
+        if changed_paths is None:
+            self.config_store.invalidate()
+            self.request_reconcile()
+            return
+        if CONFIG_FILE in changed_paths:
+            self.config_store.invalidate()
+        for rel_path in changed_paths:
+            if rel_path == CONFIG_FILE or self.app_index.lookup(rel_path):
+                self.change_coalescer.add(rel_path)
+
+    def _affected_apps(self, changed_paths: Optional[Set[str]]) -> Optional[Set[str]]:
+        """Return ids of the apps touched by `changed_paths`, None if all may be."""
+        if changed_paths is None or CONFIG_FILE in changed_paths:
+            return None
+        affected = set()
+        for rel_path in changed_paths:
+            affected.update(self.app_index.lookup(rel_path))
+        return affected
+
+    def request_reconcile(self, changed_paths: Optional[Set[str]] = None) -> Future:
+        """Queue a reconcile of the apps touched by `changed_paths`, all apps if None.
+
+        Returns right away with a future resolving to the reconcile generation
+        once a run covering this request finished.
+        """
+        return self.reconcile_queue.request(changed_paths)
+
+    def reconcile(self, changed_paths: Optional[Set[str]] = None) -> int:
+        """Reconcile and wait until done, returns the completed generation."""
+        return self.request_reconcile(changed_paths).result()
+
+    def _reconcile(self, changed_paths: Optional[Set[str]] = None):
+        if not self.lease.check():
+            self.logger.debug("Not holding the lease, skipping reconciliation")
+            return
+        self.logger.info("Starting reconciliation")
+        scheduled_jobs = set()
+        started = time.perf_counter()
+        try:
+            snapshot = self.config_store.refresh()
+            apps = snapshot.apps
+            current_apps = {app.id: app for app in apps}
+            affected_apps = self._affected_apps(changed_paths)
+            self.app_index = AppPathIndex(self.repo_path, apps, self.compose_models)
+            # the startup reconcile checks that apps believed running still are,
+            # later full ones only when the Engine API answers without a process
+            running_projects = None
+            if changed_paths is None and (self._verify_running or isinstance(self.backend, EngineBackend)):
+                self._verify_running = False
+                running_projects = self._running_projects()
+
+            with self.state_lock:
+                removed_apps = [app_state for app_id, app_state in self.state.apps.items()
+                                if app_id not in current_apps]
+
+            # fan out per-app work, failures are handled per app
+            futures = [
+                self.reconcile_pool.submit(self._reconcile_app, app, affected_apps, scheduled_jobs,
+                                           snapshot.triggers, running_projects)
+                for app in current_apps.values()
+            ]
+            futures.extend(
+                self.reconcile_pool.submit(self._remove_app, app_state)
+                for app_state in removed_apps
+            )
+            wait(futures)
+            self.executor.unschedule_stale(scheduled_jobs)
+            if self.container_watcher:
+                # apps brought up again are 'running', keep them degraded if still failing
+                self.container_watcher.refresh(snapshot)
 
-        with open(config_file) as f:
-            config = yaml.safe_load(f)
+            with self.state_lock:
+                for task_key, task_state in list(self.state.tasks.items()):
+                    if task_state.app_id not in current_apps:
+                        self.remove_task_state(task_key)
 
-        apps = []
-        for app_data in config.get('apps', []):
-            apps.append(AppConfig(**app_data))
-        return apps
+            if snapshot.digest != self._reconciled_digest:
+                self._reconciled_digest = snapshot.digest
+                self.events.publish(CONFIG_CHANGED)
 
-    def reconcile(self):
-        self.logger.info("Starting reconciliation")
+        except Exception as e:
+            self.logger.error(f"Reconciliation failed: {e}")
+        finally:
+            self.save_state()
+            try:
+                # a full reconcile hashed every app, entries it didn't use are stale
+                self.hash_cache.save(prune=changed_paths is None)
+            except OSError as e:
+                self.logger.error(f"Failed to save hash cache: {e}")
+            RECONCILE_DURATION.observe(time.perf_counter() - started)
+
+    def _running_projects(self) -> Optional[Set[str]]:
+        """Return the compose projects with running containers, None if unknown."""
         try:
-            self.scheduler.remove_all_jobs()
-
-            apps = self.load_config()
-            current_apps = {app.id: app for app in apps}
+            return self.runner.submit(self.backend.running_projects()).result()
+        except Exception as e:
+            self.logger.error(f"Failed to list running projects: {e}")
+            return None
+
+    def _reconcile_app(self, app: AppConfig, affected_apps: Optional[Set[str]],
+                       scheduled_jobs: Set[str], triggers: Mapping[str, BaseTrigger],
+                       running_projects: Optional[Set[str]] = None):
+        app_id = app.id
+        started = time.perf_counter()
+        action = 'skip'
+        try:
+            app_path = self.repo_path / app.path
+            if not app_path.exists():
+                self.logger.warning(f"App path not found: {app_path}")
+                action = 'missing'
+                return
 
-            for app_id, app in current_apps.items():
+            with self.state_lock:
+                app_state = self.state.apps.get(app_id)
+            model = None
+            if affected_apps is not None and app_id not in affected_apps and \
+                    app_state and app_state.status == 'running':
+                # none of the app's files changed, no need to hash them
+                fingerprint = app_state.fingerprint
+                service_hashes = app_state.build_hashes
+            else:
+                service_hashes = build_hashes(app_path, self.hash_cache)
+                model = self._compose_model(app_path)
+                fingerprint = app_fingerprint(self.repo_path, app, service_hashes,
+                                              model.extra_files if model else ())
+            running = app_state and app_state.status == 'running'
+            if running and running_projects is not None and \
+                    project_name(app_path) not in running_projects:
+                self.logger.info(f"App {app_id} is not running anymore")
+                running = False
+            if running and app_state.fingerprint == fingerprint:
+                self.logger.debug(f"App {app_id} unchanged, skipping compose up")
+            else:
+                # only images whose inputs changed since they were last built,
+                # or can't be compared like remote contexts
+                built = app_state.build_hashes if app_state else {}
+                rebuild = sorted(service for service, service_hash in service_hashes.items()
+                                 if service_hash == UNKNOWN_HASH or built.get(service) != service_hash)
+                model = model or self._compose_model(app_path)
+                definitions = model.hashes if model else None
+
+                services = None
+                applied = app_state.definition_hashes if running else {}
+                if applied and definitions is not None and applied.keys() <= definitions.keys():
+                    # the project runs as last applied, only touch what differs from it
+                    services = sorted(service for service, definition in definitions.items()
+                                      if applied.get(service) != definition or service in rebuild)
+
+                if services == []:
+                    action = 'noop'
+                    self.logger.info(f"App {app_id} changed without affecting its services")
+                else:
+                    action = 'up'
+                    if rebuild:
+                        # image builds are the expensive part, cap them separately
+                        with self.build_slots:
+                            self._ensure_compose_up(app, rebuild, services)
+                    else:
+                        self._ensure_compose_up(app, rebuild, services)
+
+                self.set_app_state(AppState(
+                    id=app_id,
+                    path=app.path,
+                    status='running',
+                    last_reconcile=datetime.now().isoformat(),
+                    fingerprint=fingerprint,
+                    build_hashes=service_hashes,
+                    definition_hashes=definitions or {}
+                ))
+                self.events.publish(APP_RECONCILED, app_id)
+
+            for task in app.tasks:
+                task_key = f"{app_id}_{task.id}"
                 try:
-                    app_path = self.repo_path / app.path
-                    if not app_path.exists():
-                        self.logger.warning(f"App path not found: {app_path}")
-                        continue
-
-                    self._ensure_compose_up(app)
-
-                    self.state.apps[app_id] = AppState(
-                        id=app_id,
-                        path=app.path,
-                        status='running',
-                        last_reconcile=datetime.now().isoformat()
-                    )
-
-                    for task in app.tasks:
-                        try:
-                            self.executor.schedule_task(app, task)
-                            self.state.tasks[f"{app_id}_{task.id}"] = TaskState(
+                    job_id = self.executor.schedule_task(app, task, triggers[task_key])
+                    with self.state_lock:
+                        scheduled_jobs.add(job_id)
+                        # keep last run information of already known tasks
+                        if task_key not in self.state.tasks:
+                            self.set_task_state(task_key, TaskState(
                                 id=task.id,
                                 app_id=app_id,
                                 status='success'
-                            )
-                        except Exception as e:
-                            self.logger.error(f"Failed to schedule task {task.id}: {e}")
-                            self.state.tasks[f"{app_id}_{task.id}"] = TaskState(
-                                id=task.id,
-                                app_id=app_id,
-                                status='failed'
-                            )
+                            ))
                 except Exception as e:
-                    self.logger.error(f"Failed to reconcile app {app_id}: {e}")
-                    if app_id in self.state.apps:
-                        self.state.apps[app_id].status = 'failed'
-
-            for app_id in list(self.state.apps.keys()):
-                if app_id not in current_apps:
-                    try:
-                        app_state = self.state.apps[app_id]
-                        self._ensure_compose_down(app_state)
-                    except Exception as e:
-                        self.logger.error(f"Failed to stop app {app_id}: {e}")
-                    finally:
-                        del self.state.apps[app_id]
-
-            for task_key in list(self.state.tasks.keys()):
-                app_id = task_key.split('_')[0]
-                if app_id not in current_apps:
-                    del self.state.tasks[task_key]
+                    self.logger.error(f"Failed to schedule task {task.id}: {e}")
+                    self.set_task_state(task_key, TaskState(
+                        id=task.id,
+                        app_id=app_id,
+                        status='failed'
+                    ))
+        except Exception as e:
+            self.logger.error(f"Failed to reconcile app {app_id}: {e}")
+            action = 'failed'
+            RECONCILE_ERRORS.inc(app=app_id)
+            self.update_app_state(app_id, status='failed')
+            self.events.publish(APP_RECONCILED, app_id)
+        finally:
+            RECONCILE_APP_DURATION.observe(time.perf_counter() - started, app=app_id, action=action)
 
+    def _remove_app(self, app_state: AppState):
+        try:
+            with RECONCILE_APP_DURATION.time(app=app_state.id, action='down'):
+                self._ensure_compose_down(app_state)
         except Exception as e:
-            self.logger.error(f"Reconciliation failed: {e}")
+            self.logger.error(f"Failed to stop app {app_state.id}: {e}")
         finally:
-            self.save_state()
+            self.remove_app_state(app_state.id)
+            self.events.publish(APP_REMOVED, app_state.id)
 
-    def _ensure_compose_up(self, app: AppConfig):
+    def _ensure_compose_up(self, app: AppConfig, build: Optional[List[str]] = None,
+                           services: Optional[List[str]] = None):
         app_path = self.repo_path / app.path
         app_logger = self.log_manager.get_app_logger(app.id)
 
         try:
-            app_logger.info(f"Starting app {app.id}")
-            result = subprocess.run(
-                ["docker-compose", "--project-directory", str(app_path), "up", "-d", "--build"],
-                check=True,
-                capture_output=True,
-                text=True
-            )
-            app_logger.info(f"Docker compose output:\n{result.stdout}")
-            if result.stderr:
-                app_logger.warning(f"Docker compose warnings:\n{result.stderr}")
-        except subprocess.CalledProcessError as e:
-            app_logger.error(f"Failed to start app: {e.stderr}")
-            self.state.apps[app.id] = AppState(
+            target = f"services {', '.join(services)} of app {app.id}" if services else f"app {app.id}"
+            if build:
+                app_logger.info(f"Starting {target}, building {', '.join(build)}")
+            else:
+                app_logger.info(f"Starting {target}")
+            self.runner.submit(self.backend.up(app_path, app_logger, build, services)).result()
+        except CommandError as e:
+            app_logger.error(f"Failed to start app: {e.output}")
+            # without build hashes the next attempt rebuilds every image
+            self.set_app_state(AppState(
                 id=app.id,
                 path=app.path,
                 status='failed',
                 last_reconcile=datetime.now().isoformat()
-            )
+            ))
             raise
 
+    def _compose_model(self, app_path: Path) -> Optional[ComposeModel]:
+        """Return the effective compose configuration of an app, None if the files can't be read."""
+        try:
+            return self.compose_models.get(app_path)
+        except ValueError as e:
+            self.logger.warning(f"Can't compare the services of {app_path}: {e}")
+            return None
+
     def _ensure_compose_down(self, app_state: AppState):
         app_path = self.repo_path / app_state.path
         try:
-            subprocess.run(
-                ["docker-compose", "--project-directory", str(app_path), "down"],
-                check=True,
-                capture_output=True,
-                text=True
-            )
-        except subprocess.CalledProcessError as e:
-            self.logger.error(f"Failed to stop app {app_state.id}: {e.stderr}")
+            app_logger = self.log_manager.get_app_logger(app_state.id)
+            self.runner.submit(self.backend.down(app_path, app_logger)).result()
+        except CommandError as e:
+            self.logger.error(f"Failed to stop app {app_state.id}: {e.output}")
+
+    def task_log_path(self, app_id: str, task_id: str) -> Path:
+        return self.log_manager.log_path / app_id / 'tasks' / f'{task_id}.log'
+
+    def get_task_log(self, app_id: str, task_id: str, lines: int = 200) -> str:
+        """Return the last `lines` lines of a task's log."""
+        return log_reader.tail(self.task_log_path(app_id, task_id), lines,
+                               max_backups=self.log_manager.backup_count)
 
-    def get_task_log(self, task_id: str) -> str:
-        log_file = self.state_path / 'logs' / f'{task_id}.log'
-        if not log_file.exists():
-            return ''
+    def get_task_log_page(self, app_id: str, task_id: str, lines: int = 200,
+                          cursor: Optional[str] = None) -> log_reader.LogPage:
+        """Page backward through a task's log, including rotated backups."""
+        return log_reader.read_page(self.task_log_path(app_id, task_id), lines, cursor,
+                                    max_backups=self.log_manager.backup_count)
 
-        with open(log_file) as f:
-            return f.read()
+    def follow_task_log(self, app_id: str, task_id: str) -> AsyncIterator[str]:
+        """Yield the lines appended to a task's log from now on, until cancelled."""
+        return log_reader.follow(self.task_log_path(app_id, task_id))
 
     def stop(self):
         try:
-            self.scheduler.shutdown()
-            self.observer.stop()
-            self.observer.join()
-            self.save_state()
+            if not self.runtime.stopped:
+                # leave the shared runtime to the other repositories
+                for watch in self._watches:
+                    self.observer.unschedule(watch)
+                self.executor.unschedule_stale(())
+                if self.container_watcher:
+                    self.runtime.container_events.remove(self.container_watcher)
+                    self.container_watcher.close()
+            self.change_coalescer.stop()
+            self.reconcile_queue.stop()
+            if self._owns_runtime:
+                self.runtime.stop()
+            else:
+                self.executor.cancel_all()
+            self.runtime.unregister(self)
+            self.executor.http.close()
+            self.lease.stop()
+            self.store.close()
         except Exception as e:
             self.logger.error(f"Failed to stop services: {e}")
+        finally:
+            # last, so everything logged while stopping is flushed
+            self.log_manager.stop()
@@ -1,23 +1,85 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, model_validator
 
 
 class StepConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     type: str
     compose_service: str
     command: Optional[List[str]] = None
     endpoint: Optional[str] = None
     method: Optional[str] = None
+    timeout: Optional[float] = None  # seconds, no limit if unset (30s for rest_api)
+    headers: Optional[Dict[str, str]] = None  # rest_api only
+    body: Optional[Union[str, dict, list]] = None  # rest_api only, non-strings are sent as JSON
+    retries: int = 0  # rest_api only
+    backoff: float = 0.5  # rest_api only, seconds, doubled on every retry
+    retry_unsafe: bool = False  # rest_api only, retry methods that aren't idempotent too
+    id: Optional[str] = None  # defaults to "step-<n>", n counting from 1
+    depends_on: Optional[List[str]] = None  # ids of steps that have to succeed first
 
 
 class TaskConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: str
-    cron: str
+    cron: str  # five fields, H picks a value hashed from the app and task id
     steps: List[StepConfig]
+    # scheduler options, unset values fall back to the APScheduler defaults
+    misfire_grace_time: Optional[int] = None  # seconds
+    coalesce: Optional[bool] = None
+    max_instances: Optional[int] = None  # concurrent runs, further runs wait in the queue
+    priority: int = 0  # queued runs with a higher priority start first
+    jitter: Optional[int] = None  # seconds, every run starts up to this much later at random
+    # step execution, steps run one after another unless one declares depends_on
+    parallelism: int = 4  # steps of a run executing at once
+    on_failure: str = 'fail_fast'  # 'fail_fast' cancels the other steps, 'continue' lets them finish
+
+    @model_validator(mode='after')
+    def _check_steps(self) -> 'TaskConfig':
+        if self.on_failure not in ('fail_fast', 'continue'):
+            raise ValueError(f"on_failure must be 'fail_fast' or 'continue', not {self.on_failure!r}")
+        if self.parallelism < 1:
+            raise ValueError('parallelism must be at least 1')
+        self.step_dependencies()
+        return self
+
+    def step_dependencies(self) -> Dict[str, List[str]]:
+        """Return step id -> ids of the steps it waits for, in step order.
+
+        Without any depends_on, every step waits for the one before it.
+        Raises ValueError on duplicate ids, unknown ids and cycles.
+        """
+        ids = [step.id or f"step-{i + 1}" for i, step in enumerate(self.steps)]
+        if len(set(ids)) != len(ids):
+            raise ValueError(f"Duplicate step ids in task {self.id}")
+
+        if not any(step.depends_on for step in self.steps):
+            return {step_id: ids[i - 1:i] for i, step_id in enumerate(ids)}
+
+        dependencies = {step_id: list(step.depends_on or ()) for step_id, step in zip(ids, self.steps)}
+        for step_id, depends_on in dependencies.items():
+            unknown = set(depends_on) - dependencies.keys()
+            if unknown:
+                raise ValueError(f"Step {step_id} of task {self.id} depends on unknown steps: "
+                                 f"{', '.join(sorted(unknown))}")
+
+        resolved: Set[str] = set()
+        while len(resolved) < len(dependencies):
+            ready = {step_id for step_id, depends_on in dependencies.items()
+                     if step_id not in resolved and resolved.issuperset(depends_on)}
+            if not ready:
+                raise ValueError(f"Steps of task {self.id} depend on each other: "
+                                 f"{', '.join(sorted(dependencies.keys() - resolved))}")
+            resolved |= ready
+        return dependencies
 
 
 class AppConfig(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: str
     path: str
     tasks: List[TaskConfig]
@@ -26,8 +88,21 @@ class AppConfig(BaseModel):
 class AppState(BaseModel):
     id: str
     path: str
-    status: str  # 'running' or 'stopped'
+    status: str  # 'running', 'degraded' (a service container failed), 'stopped' or 'failed'
     last_reconcile: str  # ISO format timestamp
+    fingerprint: Optional[str] = None  # hash of the inputs last brought up
+    build_hashes: Dict[str, str] = {}  # service -> hash of the image inputs last built
+    definition_hashes: Dict[str, str] = {}  # service -> hash of its compose definition last applied
+
+
+class StepResult(BaseModel):
+    type: str
+    status: str  # 'success', 'failed', 'cancelled' or 'skipped'
+    started_at: str  # ISO format timestamp
+    finished_at: str  # ISO format timestamp
+    duration: float  # seconds
+    error: Optional[str] = None
+    id: Optional[str] = None
 
 
 class TaskState(BaseModel):
@@ -35,6 +110,19 @@ class TaskState(BaseModel):
     app_id: str
     last_run: Optional[str] = None  # ISO format timestamp
     status: str  # 'success' or 'failed'
+    steps: List[StepResult] = []  # steps of the latest run, in the order they finished
+
+
+class TaskRun(BaseModel):
+    id: str
+    app_id: str
+    task_id: str
+    started_at: Optional[str] = None  # ISO format timestamp, None while queued
+    finished_at: Optional[str] = None  # ISO format timestamp
+    duration: Optional[float] = None  # seconds
+    exit_code: Optional[int] = None  # 0 on success, None if cancelled
+    status: str  # 'queued', 'running', 'success', 'failed' or 'cancelled'
+    steps: List[StepResult] = []
 
 
 class State(BaseModel):
@@ -0,0 +1,99 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, List, Optional, Set
+
+
+class ReconcileQueue:
+    """Runs reconciles one at a time on a background thread.
+
+    Requests that arrive while a reconcile runs are merged into a single
+    follow-up run: their changed paths are united (None meaning everything)
+    and all of them are answered when that run finished. Every request bumps
+    `generation`, the future of a request resolves to the generation the
+    run covered, which is at least the request's own. The request's own is
+    set on its future as `generation` right away.
+    """
+
+    def __init__(self, callback: Callable[[Optional[Set[str]]], None], logger: logging.Logger):
+        self.callback = callback
+        self.logger = logger
+        self.generation = 0
+        self.completed_generation = 0
+
+        self._requested = False
+        # changed paths of the pending requests, None if a full reconcile was asked for
+        self._paths: Optional[Set[str]] = set()
+        self._waiters: List[Future] = []
+        self._running = False
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='cm-reconcile-queue', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """Finish the running reconcile, pending requests are cancelled."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+        with self._cond:
+            waiters, self._waiters = self._waiters, []
+        for future in waiters:
+            future.cancel()
+
+    @property
+    def running(self) -> bool:
+        with self._cond:
+            return self._running
+
+    def request(self, changed_paths: Optional[Set[str]] = None) -> Future:
+        """Ask for a reconcile of `changed_paths`, all apps if None, without waiting."""
+        future = Future()
+        with self._cond:
+            if self._stopped:
+                future.generation = self.generation
+                future.cancel()
+                return future
+            self.generation += 1
+            future.generation = self.generation
+            if changed_paths is None or self._paths is None:
+                self._paths = None
+            else:
+                self._paths.update(changed_paths)
+            self._requested = True
+            self._waiters.append(future)
+            self._cond.notify()
+        return future
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._requested and not self._stopped:
+                    self._cond.wait()
+                if self._stopped:
+                    return
+                paths, self._paths = self._paths, set()
+                waiters, self._waiters = self._waiters, []
+                generation = self.generation
+                self._requested = False
+                self._running = True
+            # requests cancelled by their caller are still merged into the run
+            waiters = [future for future in waiters if future.set_running_or_notify_cancel()]
+
+            try:
+                self.callback(paths)
+            except Exception as e:
+                self.logger.error(f"Reconciliation failed: {e}")
+                for future in waiters:
+                    future.set_exception(e)
+            else:
+                for future in waiters:
+                    future.set_result(generation)
+            finally:
+                with self._cond:
+                    self._running = False
+                    self.completed_generation = generation
@@ -0,0 +1,146 @@
+import json
+import shlex
+import threading
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from compose_mate.core.models import StepConfig
+
+DEFAULT_TIMEOUT = 30.0
+# Marker printed on stderr by the probe script, tells which tool a container has
+TOOL_MARKER = '__cm_http_tool='
+TOOLS = ('curl', 'wget', 'python')
+
+_PYTHON_SCRIPT = (
+    'import json,sys,urllib.request as r;'
+    'a=json.loads(sys.argv[1]);'
+    'd=a["body"].encode() if a["body"] is not None else None;'
+    'q=r.Request(a["url"],data=d,headers=a["headers"],method=a["method"]);'
+    'sys.stdout.write(r.urlopen(q,timeout=a["timeout"]).read().decode(errors="replace"))'
+)
+
+
+def may_retry(step: StepConfig) -> bool:
+    """Return whether a failed request of `step` may be sent again.
+
+    Methods that aren't idempotent, like POST, could take effect twice and
+    are only retried when the step opts in with `retry_unsafe`.
+    """
+    method = (step.method or 'GET').upper()
+    return step.retry_unsafe or method in Retry.DEFAULT_ALLOWED_METHODS
+
+
+def request_parts(step: StepConfig) -> Tuple[str, Dict[str, str], Optional[str]]:
+    """Return method, headers and encoded body of a rest_api step."""
+    method = (step.method or 'GET').upper()
+    headers = dict(step.headers or {})
+    body = step.body
+    if body is not None and not isinstance(body, str):
+        body = json.dumps(body)
+        headers.setdefault('Content-Type', 'application/json')
+    return method, headers, body
+
+
+def tool_command(tool: str, step: StepConfig) -> List[str]:
+    """Build the command that performs the request of `step` with `tool`."""
+    method, headers, body = request_parts(step)
+    timeout = step.timeout or DEFAULT_TIMEOUT
+
+    if tool == 'curl':
+        cmd = ['curl', '-sS', '-f', '-X', method, '--max-time', str(timeout)]
+        for name, value in headers.items():
+            cmd += ['-H', f"{name}: {value}"]
+        if body is not None:
+            cmd += ['--data-binary', body]
+        return cmd + [step.endpoint]
+
+    if tool == 'wget':
+        cmd = ['wget', '-q', '-O', '-', f"--method={method}", f"--timeout={timeout}"]
+        for name, value in headers.items():
+            cmd.append(f"--header={name}: {value}")
+        if body is not None:
+            cmd.append(f"--body-data={body}")
+        return cmd + [step.endpoint]
+
+    args = {'url': step.endpoint, 'method': method, 'headers': headers,
+            'body': body, 'timeout': timeout}
+    return ['python3', '-c', _PYTHON_SCRIPT, json.dumps(args)]
+
+
+def probe_command(step: StepConfig) -> List[str]:
+    """Build one shell command that picks the first available tool and runs the request.
+
+    The chosen tool is reported on the last line of stderr so it can be cached.
+    """
+    branches = []
+    for tool, binary in (('curl', 'curl'), ('wget', 'wget'), ('python', 'python3')):
+        branches.append(
+            f"command -v {binary} >/dev/null 2>&1; then "
+            f"{shlex.join(tool_command(tool, step))}; rc=$?; echo {TOOL_MARKER}{tool} >&2; exit $rc"
+        )
+    script = 'if ' + '; elif '.join(branches) + '; else echo "no HTTP client found" >&2; exit 127; fi'
+    return ['sh', '-c', script]
+
+
+def parse_tool(output: str) -> Optional[str]:
+    for line in reversed(output.splitlines()):
+        if line.startswith(TOOL_MARKER):
+            tool = line[len(TOOL_MARKER):].strip()
+            return tool if tool in TOOLS else None
+    return None
+
+
+class SessionPool:
+    """Keeps one connection-pooled requests session per host and retry policy."""
+
+    def __init__(self, pool_size: int = 10):
+        self.pool_size = pool_size
+        self._sessions: Dict[tuple, requests.Session] = {}
+        self._lock = threading.Lock()
+
+    def session(self, url: str, retries: int = 0, backoff: float = 0.5,
+                retry_unsafe: bool = False) -> requests.Session:
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc, retries, backoff, retry_unsafe)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=self.pool_size,
+                    max_retries=Retry(
+                        total=retries,
+                        backoff_factor=backoff,
+                        status_forcelist=(429, 502, 503, 504),
+                        # urllib3's idempotent methods unless every method may be retried
+                        allowed_methods=None if retry_unsafe else Retry.DEFAULT_ALLOWED_METHODS,
+                        raise_on_status=False
+                    )
+                )
+                session.mount(f"{parts.scheme}://", adapter)
+                self._sessions[key] = session
+            return session
+
+    def request(self, step: StepConfig) -> requests.Response:
+        method, headers, body = request_parts(step)
+        session = self.session(step.endpoint, step.retries, step.backoff, step.retry_unsafe)
+        response = session.request(
+            method=method,
+            url=step.endpoint,
+            headers=headers,
+            data=body.encode() if body is not None else None,
+            timeout=step.timeout or DEFAULT_TIMEOUT
+        )
+        response.raise_for_status()
+        return response
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+import signal
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from typing import Coroutine, List, Optional, Set
+
+from compose_mate.core.metrics import PROCESS_DURATION
+
+# Output lines kept in memory per process, for error messages
+TAIL_LINES = 50
+# Longest line read at once, longer lines are truncated
+LINE_LIMIT = 64 * 1024
+# Seconds between SIGTERM and SIGKILL when stopping a process group
+KILL_GRACE = 5.0
+
+
+class CommandError(Exception):
+    def __init__(self, message: str, returncode: Optional[int] = None, output: str = ''):
+        super().__init__(message)
+        self.returncode = returncode
+        self.output = output
+
+
+class ProcessResult:
+    def __init__(self, returncode: int, output: str):
+        self.returncode = returncode
+        self.output = output
+
+
+class ProcessRunner:
+    """Runs child processes on a single background asyncio event loop.
+
+    Output is streamed line by line into a logger as it arrives, only the last
+    lines are kept in memory. Every child gets its own process group, so it
+    can be killed together with its descendants on timeout, cancellation or
+    shutdown.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self.loop = asyncio.new_event_loop()
+        self._processes: Set[asyncio.subprocess.Process] = set()
+        self._thread = threading.Thread(target=self._run_loop, name='cm-runner', daemon=True)
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        if not self._thread.is_alive():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(KILL_GRACE + 5)
+        except Exception as e:
+            self.logger.error(f"Failed to stop running processes: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+
+    async def _shutdown(self):
+        await asyncio.gather(*(self._terminate(proc) for proc in list(self._processes)),
+                             return_exceptions=True)
+        tasks = [task for task in asyncio.all_tasks(self.loop)
+                 if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule a coroutine on the runner loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def run(self, cmd: List[str], logger: logging.Logger,
+                  timeout: Optional[float] = None, name: Optional[str] = None) -> ProcessResult:
+        """Run `cmd`, streaming its output to `logger`.
+
+        Raises CommandError on a non-zero exit code or when `timeout` seconds
+        pass before the process finishes. `name` labels the duration metric,
+        it defaults to the program name.
+        """
+        started = time.perf_counter()
+        outcome = 'failed'
+        try:
+            result = await self._run(cmd, logger, timeout)
+            outcome = 'success'
+            return result
+        except CommandError as e:
+            # only a timeout ends without a return code
+            outcome = 'failed' if e.returncode is not None else 'timeout'
+            raise
+        except asyncio.CancelledError:
+            outcome = 'cancelled'
+            raise
+        finally:
+            PROCESS_DURATION.observe(time.perf_counter() - started,
+                                     command=name or os.path.basename(cmd[0]), outcome=outcome)
+
+    async def _run(self, cmd: List[str], logger: logging.Logger,
+                   timeout: Optional[float]) -> ProcessResult:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdin=asyncio.subprocess.DEVNULL,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            start_new_session=True,
+            limit=LINE_LIMIT
+        )
+        self._processes.add(proc)
+        tail = deque(maxlen=TAIL_LINES)
+        try:
+            readers = asyncio.gather(
+                self._pipe(proc.stdout, logger, logging.INFO, tail),
+                self._pipe(proc.stderr, logger, logging.WARNING, tail)
+            )
+            try:
+                await asyncio.wait_for(asyncio.shield(readers), timeout)
+                await proc.wait()
+            except asyncio.TimeoutError:
+                await self._terminate(proc)
+                readers.cancel()
+                raise CommandError(f"Command timed out after {timeout}s: {' '.join(cmd)}",
+                                   output='\n'.join(tail))
+            except asyncio.CancelledError:
+                await self._terminate(proc)
+                readers.cancel()
+                raise
+        finally:
+            self._processes.discard(proc)
+
+        output = '\n'.join(tail)
+        if proc.returncode != 0:
+            raise CommandError(f"Command failed: {output}", proc.returncode, output)
+        return ProcessResult(proc.returncode, output)
+
+    async def _pipe(self, stream: asyncio.StreamReader, logger: logging.Logger,
+                    level: int, tail: deque):
+        while True:
+            try:
+                line = await stream.readline()
+            except ValueError:
+                # the line exceeded LINE_LIMIT and was dropped by the reader
+                line = b'<line truncated>\n'
+            if not line:
+                return
+            text = line.decode(errors='replace').rstrip()
+            tail.append(text)
+            logger.log(level, text)
+
+    async def _terminate(self, proc: asyncio.subprocess.Process):
+        if proc.returncode is not None:
+            return
+        try:
+            os.killpg(proc.pid, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), KILL_GRACE)
+            except asyncio.TimeoutError:
+                os.killpg(proc.pid, signal.SIGKILL)
+                await proc.wait()
+        except ProcessLookupError:
+            pass
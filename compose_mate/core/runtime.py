@@ -0,0 +1,120 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List
+
+from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+from apscheduler.schedulers.background import BackgroundScheduler
+from watchdog.observers import Observer
+
+from compose_mate.core.backend import EngineBackend, create_backend
+from compose_mate.core.container_watcher import ContainerEvents
+from compose_mate.core.docker_api import DEFAULT_SOCKET
+from compose_mate.core.metrics import QUEUE_DEPTH, SCHEDULER_LAG, SCHEDULER_MISSED, TASKS_RUNNING
+from compose_mate.core.runner import ProcessRunner
+from compose_mate.core.task_queue import TaskQueue
+
+
+class Runtime:
+    """Threads, pools and connections shared by the managers of one process.
+
+    A manager creates its own runtime unless it is given one, so a single
+    process can host several repositories with one scheduler, one process
+    runner, one task queue, one file observer and one Docker events stream.
+    Concurrency limits apply to all of them together.
+    """
+
+    def __init__(self, logger: logging.Logger, parallelism: int = 4, max_builds: int = 2,
+                 docker_backend: str = 'auto', docker_socket: str = DEFAULT_SOCKET,
+                 task_workers: int = 4, task_workers_per_app: int = 2):
+        self.logger = logger
+        self.managers: List = []
+        self._lock = threading.Lock()
+        self._started = False
+        self._stopped = False
+
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.add_listener(self._on_job_event, EVENT_JOB_SUBMITTED | EVENT_JOB_MISSED)
+        self.runner = ProcessRunner(logger)
+        self.backend = create_backend(docker_backend, self.runner, docker_socket, logger)
+        self.task_queue = TaskQueue(self.runner.loop, logger, max_workers=task_workers,
+                                    max_per_app=task_workers_per_app)
+        self.observer = Observer()
+        # container crashes are only seen through the Engine API's event stream
+        self.container_events = None
+        if isinstance(self.backend, EngineBackend):
+            self.container_events = ContainerEvents(self.backend.client, logger)
+
+        # per-app up/down work runs in parallel, builds have their own cap
+        self.reconcile_pool = ThreadPoolExecutor(
+            max_workers=max(parallelism, 1),
+            thread_name_prefix='cm-reconcile'
+        )
+        self.build_slots = threading.BoundedSemaphore(max(max_builds, 1))
+
+        # queue depths are read when metrics are scraped, not recorded
+        QUEUE_DEPTH.set_function(lambda: self._total('store', 'pending'), queue='state')
+        QUEUE_DEPTH.set_function(lambda: self._total('log_manager', 'pending'), queue='log')
+        QUEUE_DEPTH.set_function(lambda: self._total('change_coalescer', 'pending'),
+                                 queue='file_changes')
+        QUEUE_DEPTH.set_function(self.task_queue.depth, queue='tasks')
+        TASKS_RUNNING.set_function(self.task_queue.running)
+
+    def register(self, manager):
+        with self._lock:
+            self.managers.append(manager)
+
+    def unregister(self, manager):
+        with self._lock:
+            if manager in self.managers:
+                self.managers.remove(manager)
+
+    def _total(self, component: str, method: str) -> int:
+        with self._lock:
+            managers = list(self.managers)
+        return sum(getattr(getattr(manager, component), method)() for manager in managers)
+
+    def _on_job_event(self, event):
+        if event.code == EVENT_JOB_MISSED:
+            SCHEDULER_MISSED.inc()
+            return
+        now = datetime.now(timezone.utc)
+        for run_time in event.scheduled_run_times:
+            SCHEDULER_LAG.observe(max((now - run_time).total_seconds(), 0))
+
+    def start(self):
+        """Start the shared threads, only the first call does anything."""
+        with self._lock:
+            if self._started:
+                return
+            self._started = True
+        self.runner.start()
+        self.scheduler.start()
+        if self.container_events:
+            self.container_events.start()
+        self.observer.start()
+
+    @property
+    def stopped(self) -> bool:
+        with self._lock:
+            return self._stopped
+
+    def stop(self):
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            started = self._started
+        if started:
+            self.scheduler.shutdown()
+            if self.container_events:
+                self.container_events.stop()
+            self.observer.stop()
+            self.observer.join()
+        self.reconcile_pool.shutdown(wait=True)
+        if started:
+            # kills the process groups of steps still running
+            self.runner.stop()
+        if isinstance(self.backend, EngineBackend):
+            self.backend.client.close()
@@ -0,0 +1,359 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from compose_mate.core.models import AppState, State, TaskRun, TaskState
+
+# Most operations applied in one write batch
+BATCH_SIZE = 500
+
+
+class StateStore:
+    """Persists app/task state and the task run history.
+
+    Writes are queued and applied in batches by a background thread, so
+    callers never wait for the disk. `flush()` blocks until everything
+    queued so far is persisted. Run queries don't wait for it, they read
+    what is persisted and add the runs still queued for writing.
+    """
+
+    def __init__(self, logger: logging.Logger):
+        self.logger = logger
+        self._queue: queue.Queue = queue.Queue()
+        # run id -> latest version of a run not persisted yet
+        self._pending_runs: Dict[str, TaskRun] = {}
+        self._pending_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._write_loop, name='cm-state', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def load(self) -> State:
+        raise NotImplementedError
+
+    def put_app(self, app_state: AppState):
+        self._queue.put(('put_app', app_state))
+
+    def delete_app(self, app_id: str):
+        self._queue.put(('delete_app', app_id))
+
+    def put_task(self, task_key: str, task_state: TaskState):
+        self._queue.put(('put_task', task_key, task_state))
+
+    def delete_task(self, task_key: str):
+        self._queue.put(('delete_task', task_key))
+
+    def record_run(self, run: TaskRun):
+        """Insert or update a run of the history."""
+        # the caller keeps changing the run, queue it as it is now
+        run = run.model_copy(deep=True)
+        with self._pending_lock:
+            self._pending_runs[run.id] = run
+        self._queue.put(('put_run', run))
+
+    def recent_runs(self, app_id: str, task_id: str, limit: int = 20) -> List[TaskRun]:
+        """Return the last `limit` runs of a task, newest first."""
+        raise NotImplementedError
+
+    def failures_since(self, since: str) -> List[TaskRun]:
+        """Return failed runs started at or after the ISO timestamp `since`, newest first."""
+        raise NotImplementedError
+
+    def get_run(self, run_id: str) -> Optional[TaskRun]:
+        raise NotImplementedError
+
+    def _pending_runs_matching(self, match: Callable[[TaskRun], bool]) -> List[TaskRun]:
+        """Return the matching runs not persisted yet.
+
+        Call it before reading the persisted runs, a run leaves this list
+        only once it is persisted, so it is found in one of the two.
+        """
+        with self._pending_lock:
+            return [run for run in self._pending_runs.values() if match(run)]
+
+    @staticmethod
+    def _merge_runs(runs: List[TaskRun], pending: List[TaskRun],
+                    limit: Optional[int] = None) -> List[TaskRun]:
+        """Merge runs read from disk with newer pending versions, newest first."""
+        if pending:
+            merged = {run.id: run for run in runs}
+            merged.update((run.id, run) for run in pending)
+            runs = sorted(merged.values(), key=lambda run: run.started_at or '', reverse=True)
+        return runs if limit is None else runs[:limit]
+
+    def pending(self) -> int:
+        """Return the number of writes waiting to be persisted."""
+        return self._queue.qsize()
+
+    def flush(self):
+        if self._thread.is_alive():
+            self._queue.join()
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def _write_loop(self):
+        while True:
+            ops = [self._queue.get()]
+            while len(ops) < BATCH_SIZE:
+                try:
+                    ops.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in ops
+            try:
+                self._apply([op for op in ops if op is not None])
+            except Exception as e:
+                self.logger.error(f"Failed to persist state: {e}")
+            finally:
+                with self._pending_lock:
+                    for op in ops:
+                        # a newer version queued meanwhile stays pending
+                        if op and op[0] == 'put_run' and self._pending_runs.get(op[1].id) is op[1]:
+                            del self._pending_runs[op[1].id]
+                for _ in ops:
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def _apply(self, ops: list):
+        raise NotImplementedError
+
+
+class JsonStateStore(StateStore):
+    """Keeps state in `state.json` and the run history in `runs.jsonl`.
+
+    The state file is rewritten atomically once per write batch.
+    """
+
+    def __init__(self, state_path: Path, logger: logging.Logger):
+        super().__init__(logger)
+        self.state_file = state_path / 'state.json'
+        self.runs_file = state_path / 'runs.jsonl'
+        self._state = State(apps={}, tasks={})
+
+    def load(self) -> State:
+        if self.state_file.exists():
+            try:
+                with open(self.state_file) as f:
+                    self._state = State(**json.load(f))
+            except (json.JSONDecodeError, ValueError) as e:
+                self.logger.error(f"Failed to load state file: {e}")
+                # keep the default state
+        return self._state.model_copy(deep=True)
+
+    def _apply(self, ops: list):
+        state_changed = False
+        runs = []
+        for op in ops:
+            kind = op[0]
+            if kind == 'put_app':
+                self._state.apps[op[1].id] = op[1]
+            elif kind == 'delete_app':
+                self._state.apps.pop(op[1], None)
+            elif kind == 'put_task':
+                self._state.tasks[op[1]] = op[2]
+            elif kind == 'delete_task':
+                self._state.tasks.pop(op[1], None)
+            elif kind == 'put_run':
+                runs.append(op[1])
+            state_changed = state_changed or kind != 'put_run'
+
+        if state_changed:
+            tmp_file = self.state_file.with_suffix('.json.tmp')
+            with open(tmp_file, 'w') as f:
+                f.write(self._state.model_dump_json())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.state_file)
+
+        if runs:
+            # a run is appended again on every update, readers keep the last version
+            with open(self.runs_file, 'a') as f:
+                for run in runs:
+                    f.write(run.model_dump_json() + '\n')
+
+    def _runs(self, match: Callable[[TaskRun], bool]) -> List[TaskRun]:
+        pending = self._pending_runs_matching(match)
+        if not self.runs_file.exists():
+            return self._merge_runs([], pending)
+        runs = {}
+        with open(self.runs_file) as f:
+            for line in f:
+                try:
+                    run = TaskRun.model_validate_json(line)
+                except ValueError:
+                    continue
+                runs[run.id] = run
+        runs = sorted(runs.values(), key=lambda run: run.started_at, reverse=True)
+        return self._merge_runs([run for run in runs if match(run)], pending)
+
+    def recent_runs(self, app_id: str, task_id: str, limit: int = 20) -> List[TaskRun]:
+        return self._runs(lambda run: run.app_id == app_id and run.task_id == task_id)[:limit]
+
+    def failures_since(self, since: str) -> List[TaskRun]:
+        return self._runs(lambda run: run.status == 'failed' and run.started_at >= since)
+
+    def get_run(self, run_id: str) -> Optional[TaskRun]:
+        return next(iter(self._runs(lambda run: run.id == run_id)), None)
+
+
+class SqliteStateStore(StateStore):
+    """Keeps state and the run history in a SQLite database in WAL mode.
+
+    Every app, task and run is its own row, so a change rewrites one row
+    instead of the whole state.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS apps (
+            id TEXT PRIMARY KEY,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tasks (
+            key TEXT PRIMARY KEY,
+            app_id TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS runs (
+            id TEXT PRIMARY KEY,
+            app_id TEXT NOT NULL,
+            task_id TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            duration REAL,
+            exit_code INTEGER,
+            status TEXT NOT NULL,
+            steps TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS runs_by_task ON runs (app_id, task_id, started_at);
+        CREATE INDEX IF NOT EXISTS runs_by_status ON runs (status, started_at);
+    '''
+
+    def __init__(self, state_path: Path, logger: logging.Logger):
+        super().__init__(logger)
+        self.db_file = state_path / 'state.db'
+        self._local = threading.local()
+        # every thread's connection, closed together in `close`
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._connect().executescript(self.SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # one connection per thread, WAL lets readers work alongside the writer
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # used by its thread only, but closed by the one calling `close`
+            conn = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def close(self):
+        super().close()
+        with self._connections_lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            conn.close()
+
+    def load(self) -> State:
+        conn = self._connect()
+        apps = {row[0]: AppState.model_validate_json(row[1])
+                for row in conn.execute('SELECT id, data FROM apps')}
+        tasks = {row[0]: TaskState.model_validate_json(row[1])
+                 for row in conn.execute('SELECT key, data FROM tasks')}
+        return State(apps=apps, tasks=tasks)
+
+    def is_empty(self) -> bool:
+        conn = self._connect()
+        return not any(conn.execute('SELECT 1 FROM apps UNION ALL SELECT 1 FROM tasks LIMIT 1'))
+
+    def _apply(self, ops: list):
+        conn = self._connect()
+        with conn:
+            for op in ops:
+                kind = op[0]
+                if kind == 'put_app':
+                    conn.execute('INSERT OR REPLACE INTO apps (id, data) VALUES (?, ?)',
+                                 (op[1].id, op[1].model_dump_json()))
+                elif kind == 'delete_app':
+                    conn.execute('DELETE FROM apps WHERE id = ?', (op[1],))
+                elif kind == 'put_task':
+                    conn.execute('INSERT OR REPLACE INTO tasks (key, app_id, data) VALUES (?, ?, ?)',
+                                 (op[1], op[2].app_id, op[2].model_dump_json()))
+                elif kind == 'delete_task':
+                    conn.execute('DELETE FROM tasks WHERE key = ?', (op[1],))
+                elif kind == 'put_run':
+                    run = op[1]
+                    conn.execute(
+                        'INSERT OR REPLACE INTO runs (id, app_id, task_id, started_at, finished_at, '
+                        'duration, exit_code, status, steps) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (run.id, run.app_id, run.task_id, run.started_at, run.finished_at,
+                         run.duration, run.exit_code, run.status,
+                         json.dumps([step.model_dump() for step in run.steps]))
+                    )
+
+    def _query_runs(self, where: str, params: tuple, match: Callable[[TaskRun], bool],
+                    limit: Optional[int] = None) -> List[TaskRun]:
+        """Query the persisted runs, `match` is `where` for the runs not persisted yet."""
+        pending = self._pending_runs_matching(match)
+        sql = ('SELECT id, app_id, task_id, started_at, finished_at, duration, exit_code, status, steps '
+               f'FROM runs WHERE {where} ORDER BY started_at DESC')
+        if limit is not None:
+            sql += f' LIMIT {int(limit)}'
+        runs = [
+            TaskRun(id=row[0], app_id=row[1], task_id=row[2], started_at=row[3],
+                    finished_at=row[4], duration=row[5], exit_code=row[6], status=row[7],
+                    steps=json.loads(row[8]))
+            for row in self._connect().execute(sql, params)
+        ]
+        return self._merge_runs(runs, pending, limit)
+
+    def recent_runs(self, app_id: str, task_id: str, limit: int = 20) -> List[TaskRun]:
+        return self._query_runs('app_id = ? AND task_id = ?', (app_id, task_id),
+                                lambda run: run.app_id == app_id and run.task_id == task_id, limit)
+
+    def failures_since(self, since: str) -> List[TaskRun]:
+        return self._query_runs("status = 'failed' AND started_at >= ?", (since,),
+                                lambda run: run.status == 'failed' and run.started_at >= since)
+
+    def get_run(self, run_id: str) -> Optional[TaskRun]:
+        runs = self._query_runs('id = ?', (run_id,), lambda run: run.id == run_id)
+        return runs[0] if runs else None
+
+
+def create_state_store(kind: str, state_path: Path, logger: logging.Logger) -> StateStore:
+    """Create the state store for `kind` ('sqlite' or 'json').
+
+    An existing `state.json` is imported into a new SQLite store and renamed
+    to `state.json.migrated`.
+    """
+    if kind == 'json':
+        store = JsonStateStore(state_path, logger)
+        store.start()
+        return store
+
+    store = SqliteStateStore(state_path, logger)
+    store.start()
+    state_file = state_path / 'state.json'
+    if state_file.exists() and store.is_empty():
+        legacy = JsonStateStore(state_path, logger).load()
+        for app_state in legacy.apps.values():
+            store.put_app(app_state)
+        for task_key, task_state in legacy.tasks.items():
+            store.put_task(task_key, task_state)
+        store.flush()
+        state_file.rename(state_path / 'state.json.migrated')
+        logger.info(f"Migrated {state_file} to {store.db_file}")
+    return store
@@ -0,0 +1,189 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Coroutine, Dict, List, Optional, Tuple
+
+from compose_mate.core.metrics import TASK_QUEUE_WAIT
+from compose_mate.core.models import AppConfig, TaskConfig
+
+
+@dataclass(order=True)
+class _Entry:
+    # heap order: higher priority first, then first come first served
+    sort_key: tuple
+    start_run: Callable[[AppConfig, TaskConfig, Optional[str]], Coroutine] = field(compare=False)
+    app: AppConfig = field(compare=False)
+    task: TaskConfig = field(compare=False)
+    run_id: Optional[str] = field(compare=False)
+    # tells apart apps and tasks of different repositories sharing the queue
+    namespace: str = field(compare=False)
+    enqueued_at: float = field(compare=False)
+    future: Future = field(compare=False)
+    started: bool = field(default=False, compare=False)
+
+    @property
+    def app_key(self) -> str:
+        return f"{self.namespace}{self.app.id}"
+
+    @property
+    def task_key(self) -> str:
+        return f"{self.namespace}{self.app.id}_{self.task.id}"
+
+
+class TaskQueue:
+    """Starts queued task runs on the runner loop within concurrency limits.
+
+    At most `max_workers` runs execute at once, at most `max_per_app` of
+    them for the same app and at most `max_instances` of the same task.
+    Runs that don't fit wait in a priority queue; a waiting run of one app
+    does not hold back runs of other apps.
+
+    One queue can be shared by the executors of several repositories, their
+    runs are told apart by the `namespace` they are submitted with, which
+    prefixes the task keys of the queries as well.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, logger: logging.Logger,
+                 max_workers: int = 4, max_per_app: int = 2):
+        self.loop = loop
+        self.logger = logger
+        self.max_workers = max(max_workers, 1)
+        self.max_per_app = max(max_per_app, 1)
+
+        self._heap: List[_Entry] = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._running = 0
+        self._running_apps: Dict[str, int] = {}
+        self._running_tasks: Dict[str, int] = {}
+        self._queued_tasks: Dict[str, int] = {}
+        # task key -> seconds its last started run waited in the queue
+        self._last_wait: Dict[str, float] = {}
+        # run id -> entry, from submit until the run finished
+        self._entries: Dict[str, _Entry] = {}
+
+    def submit(self, start_run: Callable[[AppConfig, TaskConfig, Optional[str]], Coroutine],
+               app: AppConfig, task: TaskConfig, run_id: Optional[str] = None,
+               coalesce: bool = False, namespace: str = '') -> Optional[Future]:
+        """Queue a run of `task` to be started with `start_run`, the future resolves to its TaskRun.
+
+        With `coalesce`, nothing is queued (and None returned) while another
+        run of the task is still waiting.
+        """
+        entry = _Entry((-task.priority, next(self._counter)), start_run, app, task, run_id,
+                       namespace, time.monotonic(), Future())
+        with self._lock:
+            if coalesce and self._queued_tasks.get(entry.task_key):
+                return None
+            heapq.heappush(self._heap, entry)
+            self._queued_tasks[entry.task_key] = self._queued_tasks.get(entry.task_key, 0) + 1
+            if run_id:
+                self._entries[run_id] = entry
+        self.loop.call_soon_threadsafe(self._dispatch)
+        return entry.future
+
+    def cancel(self, task_key: str) -> int:
+        """Drop the waiting runs of a task, returns how many were dropped."""
+        return self._drop(lambda entry: entry.task_key == task_key)
+
+    def cancel_namespace(self, namespace: str) -> int:
+        """Drop the waiting runs of every task of a namespace, returns how many were dropped."""
+        return self._drop(lambda entry: entry.namespace == namespace)
+
+    def _drop(self, match: Callable[[_Entry], bool]) -> int:
+        with self._lock:
+            dropped = [entry for entry in self._heap if match(entry)]
+            if not dropped:
+                return 0
+            self._heap = [entry for entry in self._heap if not match(entry)]
+            heapq.heapify(self._heap)
+            for entry in dropped:
+                self._dequeued(entry.task_key)
+                self._entries.pop(entry.run_id, None)
+        for entry in dropped:
+            entry.future.cancel()
+        return len(dropped)
+
+    def depth(self) -> int:
+        with self._lock:
+            return len(self._heap)
+
+    def queued(self, task_key: str) -> int:
+        with self._lock:
+            return self._queued_tasks.get(task_key, 0)
+
+    def last_wait(self, task_key: str) -> Optional[float]:
+        with self._lock:
+            return self._last_wait.get(task_key)
+
+    def running(self) -> int:
+        with self._lock:
+            return self._running
+
+    def run_status(self, run_id: str, namespace: str = '') -> Optional[Tuple[str, str, str]]:
+        """Return (app id, task id, 'queued' or 'running') of a run submitted with an id.
+
+        None once the run finished or if it is unknown.
+        """
+        with self._lock:
+            entry = self._entries.get(run_id)
+            if entry is None or entry.namespace != namespace:
+                return None
+            return entry.app.id, entry.task.id, 'running' if entry.started else 'queued'
+
+    def _dispatch(self):
+        started = []
+        with self._lock:
+            waiting = []
+            while self._heap and self._running < self.max_workers:
+                entry = heapq.heappop(self._heap)
+                app_key, task_key = entry.app_key, entry.task_key
+                if self._running_apps.get(app_key, 0) >= self.max_per_app or \
+                        self._running_tasks.get(task_key, 0) >= (entry.task.max_instances or 1):
+                    waiting.append(entry)
+                    continue
+                self._dequeued(task_key)
+                if not entry.future.set_running_or_notify_cancel():
+                    self._entries.pop(entry.run_id, None)
+                    continue
+                entry.started = True
+                self._running += 1
+                self._running_apps[app_key] = self._running_apps.get(app_key, 0) + 1
+                self._running_tasks[task_key] = self._running_tasks.get(task_key, 0) + 1
+                self._last_wait[task_key] = time.monotonic() - entry.enqueued_at
+                started.append(entry)
+            for entry in waiting:
+                heapq.heappush(self._heap, entry)
+
+        for entry in started:
+            TASK_QUEUE_WAIT.observe(time.monotonic() - entry.enqueued_at)
+            self.loop.create_task(self._run(entry))
+
+    def _dequeued(self, task_key: str):
+        count = self._queued_tasks.get(task_key, 0) - 1
+        if count > 0:
+            self._queued_tasks[task_key] = count
+        else:
+            self._queued_tasks.pop(task_key, None)
+
+    async def _run(self, entry: _Entry):
+        try:
+            entry.future.set_result(await entry.start_run(entry.app, entry.task, entry.run_id))
+        except (asyncio.CancelledError, Exception) as e:
+            # a cancelled run ends its future with the CancelledError
+            entry.future.set_exception(e)
+        finally:
+            with self._lock:
+                self._entries.pop(entry.run_id, None)
+                self._running -= 1
+                for counts, key in ((self._running_apps, entry.app_key),
+                                    (self._running_tasks, entry.task_key)):
+                    counts[key] -= 1
+                    if not counts[key]:
+                        del counts[key]
+            self._dispatch()
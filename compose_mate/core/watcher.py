@@ -0,0 +1,134 @@
+import logging
+import threading
+import time
+from pathlib import Path, PurePosixPath
+from typing import Callable, Dict, Iterable, Optional, Set
+
+from compose_mate.core.compose_model import ComposeModelCache
+from compose_mate.core.fingerprint import find_build_contexts
+from compose_mate.core.models import AppConfig
+
+
+class AppPathIndex:
+    """Maps repo-relative paths to the ids of the apps they belong to.
+
+    A path belongs to an app if it lives under the app directory or under one
+    of its build contexts, or is a file its compose files refer to, like
+    `extends` and env files, when `compose_models` is given. Lookups walk the parents of the path, so their
+    cost depends on path depth rather than on the number of apps.
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self, repo_path: Path, apps: Iterable[AppConfig],
+                 compose_models: Optional[ComposeModelCache] = None):
+        self.repo_path = repo_path.resolve()
+        self.prefixes: Dict[PurePosixPath, Set[str]] = {}
+        self._cache: Dict[str, frozenset] = {}
+
+        for app in apps:
+            app_path = self.repo_path / app.path
+            self._add(app_path, app.id)
+            for context_path in find_build_contexts(app_path):
+                self._add(context_path, app.id)
+            if compose_models is not None:
+                try:
+                    extra_files = compose_models.get(app_path).extra_files
+                except ValueError:
+                    # invalid compose files, reconcile reports them
+                    extra_files = ()
+                for extra_file in extra_files:
+                    self._add(extra_file, app.id)
+
+    def _add(self, path: Path, app_id: str):
+        try:
+            rel_path = PurePosixPath(path.resolve().relative_to(self.repo_path).as_posix())
+        except ValueError:
+            # build context outside of the repo, not watched
+            return
+        self.prefixes.setdefault(rel_path, set()).add(app_id)
+
+    def lookup(self, rel_path: str) -> frozenset:
+        cached = self._cache.get(rel_path)
+        if cached is not None:
+            return cached
+
+        app_ids = set()
+        path = PurePosixPath(rel_path)
+        for prefix in (path, *path.parents):
+            app_ids.update(self.prefixes.get(prefix, ()))
+        result = frozenset(app_ids)
+
+        if len(self._cache) >= self.CACHE_SIZE:
+            self._cache.clear()
+        self._cache[rel_path] = result
+        return result
+
+
+class ChangeCoalescer:
+    """Batches bursts of file changes into a single callback.
+
+    The callback fires once no new change arrived for `quiet_window` seconds,
+    or at the latest `max_delay` seconds after the first change of a burst,
+    and receives every path collected in between.
+    """
+
+    def __init__(self, callback: Callable[[Set[str]], None], logger: logging.Logger,
+                 quiet_window: float = 1.0, max_delay: float = 10.0):
+        self.callback = callback
+        self.logger = logger
+        self.quiet_window = quiet_window
+        self.max_delay = max(max_delay, quiet_window)
+
+        self._pending: Set[str] = set()
+        self._first_change: Optional[float] = None
+        self._last_change: Optional[float] = None
+        self._stopped = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='cm-coalescer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def pending(self) -> int:
+        """Return the number of changed paths waiting for the next callback."""
+        with self._cond:
+            return len(self._pending)
+
+    def add(self, path: str):
+        with self._cond:
+            now = time.monotonic()
+            if not self._pending:
+                self._first_change = now
+            self._last_change = now
+            self._pending.add(path)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    if not self._pending:
+                        self._cond.wait()
+                        continue
+                    now = time.monotonic()
+                    deadline = min(self._last_change + self.quiet_window,
+                                   self._first_change + self.max_delay)
+                    if now >= deadline:
+                        break
+                    self._cond.wait(deadline - now)
+                if self._stopped:
+                    return
+                batch, self._pending = self._pending, set()
+
+            try:
+                self.callback(batch)
+            except Exception as e:
+                self.logger.error(f"Failed to handle file changes: {e}")
@@ -5,8 +5,7 @@ import signal
 import sys
 from pathlib import Path
 
-from compose_mate.core.manager import ComposeManager
-from compose_mate.web.app import start_web_server
+from compose_mate.web.server import start_web_server
 
 
 def parse_args():
@@ -14,13 +13,16 @@ def parse_args():
     parser.add_argument(
         '--repo-path',
         type=str,
+        action='append',
         required=True,
-        help='Path to the repository containing docker-compose files'
+        help='Path to the repository containing docker-compose files; repeat it to serve '
+             'several repositories from one process'
     )
     parser.add_argument(
         '--state-path',
         type=str,
-        help='Path to store state files (default: <repo-path>/.cm-state)'
+        help='Path to store state files (default: <repo-path>/.cm-state); with several '
+             'repositories, it holds a directory per repository named after it'
     )
     parser.add_argument(
         '--port',
@@ -28,20 +30,129 @@ def parse_args():
         default=8080,
         help='Web interface port (default: 8080)'
     )
+    parser.add_argument(
+        '--watch-quiet-window',
+        type=float,
+        default=1.0,
+        help='Seconds without file changes before a reconcile is triggered (default: 1.0)'
+    )
+    parser.add_argument(
+        '--watch-max-delay',
+        type=float,
+        default=10.0,
+        help='Maximum seconds a burst of file changes can delay a reconcile (default: 10.0)'
+    )
+    parser.add_argument(
+        '--change-source',
+        choices=['files', 'git'],
+        default='files',
+        help='How changes are detected: by watching every file of the repository, or by '
+             'following the commits its git HEAD moves to, e.g. after a git pull (default: files)'
+    )
+    parser.add_argument(
+        '--parallelism',
+        type=int,
+        default=4,
+        help='Number of apps reconciled concurrently (default: 4)'
+    )
+    parser.add_argument(
+        '--max-builds',
+        type=int,
+        default=2,
+        help='Maximum number of concurrent image builds (default: 2)'
+    )
+    parser.add_argument(
+        '--docker-backend',
+        choices=['auto', 'engine', 'cli'],
+        default='auto',
+        help='How to talk to docker: the Engine API socket, the docker-compose CLI, '
+             'or the socket when reachable (default: auto)'
+    )
+    parser.add_argument(
+        '--docker-socket',
+        type=str,
+        default='/var/run/docker.sock',
+        help='Path of the Docker Engine API socket (default: /var/run/docker.sock)'
+    )
+    parser.add_argument(
+        '--log-max-bytes',
+        type=int,
+        default=1024 * 1024,
+        help='Size in bytes at which a log file is rotated (default: 1048576)'
+    )
+    parser.add_argument(
+        '--log-backup-count',
+        type=int,
+        default=5,
+        help='Number of rotated log files kept (default: 5)'
+    )
+    parser.add_argument(
+        '--state-backend',
+        choices=['sqlite', 'json'],
+        default='sqlite',
+        help='Where state and run history are stored; an existing state.json is '
+             'migrated to sqlite on startup (default: sqlite)'
+    )
+    parser.add_argument(
+        '--task-workers',
+        type=int,
+        default=4,
+        help='Maximum number of task runs executing at once, others wait in a queue (default: 4)'
+    )
+    parser.add_argument(
+        '--task-workers-per-app',
+        type=int,
+        default=2,
+        help='Maximum number of task runs of the same app executing at once (default: 2)'
+    )
+    parser.add_argument(
+        '--cron-stagger',
+        type=float,
+        default=0,
+        help='Seconds scheduled runs are spread over; every task fires a fixed, hashed '
+             'delay within this window after its cron time (default: 0, off)'
+    )
+    parser.add_argument(
+        '--lease-ttl',
+        type=float,
+        default=30.0,
+        help='Seconds without a heartbeat after which another instance takes over a '
+             'repository from a hung one (default: 30)'
+    )
+    parser.add_argument(
+        '--heal-services',
+        action='store_true',
+        help='Recreate services whose containers crashed, ran out of memory or turned '
+             'unhealthy, backing off when they keep failing (Docker Engine API only)'
+    )
 
     args = parser.parse_args()
 
+    # repositories are told apart by their directory name, in URLs and logs
+    args.repo_names = [Path(repo_path).resolve().name for repo_path in args.repo_path]
+    if len(args.repo_path) > 1:
+        if len(set(args.repo_names)) != len(args.repo_names):
+            parser.error('repositories must have different directory names')
+        if 'index' in args.repo_names:
+            parser.error("a repository can't be called 'index'")
+
     # use default value if state_path is not specified
     if not args.state_path:
-        args.state_path = os.path.join(args.repo_path, '.cm-state')
+        args.state_paths = [os.path.join(repo_path, '.cm-state') for repo_path in args.repo_path]
+    elif len(args.repo_path) == 1:
+        args.state_paths = [args.state_path]
+    else:
+        args.state_paths = [os.path.join(args.state_path, name) for name in args.repo_names]
 
     return args
 
 
 def signal_handler(signum, frame):
     logging.info("Shutting down...")
-    if hasattr(signal_handler, 'manager'):
-        signal_handler.manager.stop()
+    for manager in getattr(signal_handler, 'managers', ()):
+        manager.stop()
+    if hasattr(signal_handler, 'runtime'):
+        signal_handler.runtime.stop()
     sys.exit(0)
 
 
@@ -51,13 +162,51 @@ def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    Path(args.state_path).mkdir(parents=True, exist_ok=True)
-    Path(os.path.join(args.state_path, 'logs')).mkdir(exist_ok=True)
-
-    manager = ComposeManager(args.repo_path, args.state_path)
-    signal_handler.manager = manager
-
-    start_web_server(manager, port=args.port)
+    for state_path in args.state_paths:
+        Path(state_path).mkdir(parents=True, exist_ok=True)
+        Path(os.path.join(state_path, 'logs')).mkdir(exist_ok=True)
+
+    def create_managers():
+        # imported here, the web server is already answering while this loads
+        from compose_mate.core.logging_utils import MAIN_LOGGER
+        from compose_mate.core.manager import ComposeManager
+        from compose_mate.core.runtime import Runtime
+
+        runtime_options = dict(
+            parallelism=args.parallelism,
+            max_builds=args.max_builds,
+            docker_backend=args.docker_backend,
+            docker_socket=args.docker_socket,
+            task_workers=args.task_workers,
+            task_workers_per_app=args.task_workers_per_app
+        )
+        options = dict(
+            watch_quiet_window=args.watch_quiet_window,
+            watch_max_delay=args.watch_max_delay,
+            log_max_bytes=args.log_max_bytes,
+            log_backup_count=args.log_backup_count,
+            state_backend=args.state_backend,
+            cron_stagger=args.cron_stagger,
+            heal_services=args.heal_services,
+            change_source=args.change_source,
+            lease_ttl=args.lease_ttl
+        )
+        if len(args.repo_path) == 1:
+            managers = [ComposeManager(args.repo_path[0], args.state_paths[0],
+                                       **runtime_options, **options)]
+        else:
+            # one scheduler, worker pool and set of watchers for every repository
+            runtime = Runtime(logging.getLogger(MAIN_LOGGER), **runtime_options)
+            signal_handler.runtime = runtime
+            managers = []
+            for repo_path, state_path, name in zip(args.repo_path, args.state_paths,
+                                                   args.repo_names):
+                managers.append(ComposeManager(repo_path, state_path, runtime=runtime,
+                                               name=name, **options))
+        signal_handler.managers = managers
+        return managers
+
+    start_web_server(create_managers, port=args.port)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,184 @@
+import uuid
+from typing import Callable, Optional
+
+from fastapi import APIRouter, HTTPException, Request, Response
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from compose_mate.core.lease import NotLeaseHolder
+from compose_mate.core.models import AppConfig, TaskConfig
+
+# Most runs returned by the runs endpoint
+MAX_RUNS = 100
+# Most log lines returned at once
+MAX_LOG_LINES = 1000
+
+
+def create_api(manager) -> APIRouter:
+    """JSON API over apps, tasks, runs and logs, mounted under /api/v1.
+
+    Read endpoints answer with an ETag made from the event bus version, which
+    changes whenever state or runs change, or for logs from the version of
+    the task's log, so polling clients sending If-None-Match get an empty 304
+    until something happened. Trigger
+    endpoints only queue work and answer right away.
+    """
+    router = APIRouter()
+    # versions restart with the process, the boot id keeps old ETags from matching
+    boot_id = uuid.uuid4().hex[:8]
+    # every repository mounts its own router, route names must not clash for url_for
+    route_prefix = f"{manager.name}:" if manager.name else ''
+
+    def conditional(request: Request, build: Callable[[], object],
+                    version: Optional[int] = None) -> Response:
+        # read the version first, the body is then at least as new as its ETag
+        if version is None:
+            version = manager.events.version
+        etag = f'W/"{boot_id}-{version}"'
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if_none_match = request.headers.get('if-none-match', '')
+        if etag in (tag.strip() for tag in if_none_match.split(',')):
+            return Response(status_code=304, headers=headers)
+        return JSONResponse(build(), headers=headers)
+
+    def find_app(app_id: str) -> AppConfig:
+        app = manager.config_store.snapshot().apps_by_id.get(app_id)
+        if app is None:
+            raise HTTPException(404, f"Unknown app: {app_id}")
+        return app
+
+    def find_task(app_id: str, task_id: str):
+        found = manager.config_store.snapshot().tasks_by_key.get(f"{app_id}_{task_id}")
+        if found is None:
+            raise HTTPException(404, f"Unknown task: {app_id}/{task_id}")
+        return found
+
+    def app_json(app: AppConfig) -> dict:
+        app_state = manager.state.apps.get(app.id)
+        return {
+            'id': app.id,
+            'path': app.path,
+            'status': app_state.status if app_state else 'unknown',
+            'last_reconcile': app_state.last_reconcile if app_state else None,
+            'tasks': [task.id for task in app.tasks],
+        }
+
+    def task_json(app: AppConfig, task: TaskConfig) -> dict:
+        task_key = f"{app.id}_{task.id}"
+        task_state = manager.state.tasks.get(task_key)
+        job = manager.scheduler.get_job(manager.executor.job_id(task_key))
+        next_run_time = job.next_run_time if job else None
+        return {
+            'id': task.id,
+            'app_id': app.id,
+            'cron': task.cron,
+            'status': task_state.status if task_state else 'unknown',
+            'last_run': task_state.last_run if task_state else None,
+            'next_run': next_run_time.isoformat() if next_run_time else None,
+            'queued': manager.executor.queued(task_key),
+            'running': manager.executor.running_count(task_key),
+            'steps': [step.model_dump() for step in task_state.steps] if task_state else [],
+        }
+
+    @router.get('/apps')
+    def list_apps(request: Request):
+        return conditional(request, lambda: [
+            app_json(app) for app in manager.config_store.snapshot().apps
+        ])
+
+    @router.get('/apps/{app_id}')
+    def get_app(app_id: str, request: Request):
+        app = find_app(app_id)
+        return conditional(request, lambda: {
+            **app_json(app), 'tasks': [task_json(app, task) for task in app.tasks]
+        })
+
+    @router.get('/apps/{app_id}/tasks')
+    def list_tasks(app_id: str, request: Request):
+        app = find_app(app_id)
+        return conditional(request, lambda: [task_json(app, task) for task in app.tasks])
+
+    @router.get('/apps/{app_id}/tasks/{task_id}')
+    def get_task(app_id: str, task_id: str, request: Request):
+        app, task = find_task(app_id, task_id)
+        return conditional(request, lambda: task_json(app, task))
+
+    @router.get('/apps/{app_id}/tasks/{task_id}/runs')
+    def list_runs(app_id: str, task_id: str, request: Request, limit: int = 20):
+        find_task(app_id, task_id)
+        limit = min(max(limit, 1), MAX_RUNS)
+        return conditional(request, lambda: [
+            run.model_dump() for run in manager.store.recent_runs(app_id, task_id, limit)
+        ])
+
+    @router.get('/apps/{app_id}/tasks/{task_id}/logs')
+    def get_logs(app_id: str, task_id: str, request: Request, lines: int = 200,
+                 cursor: Optional[str] = None):
+        find_task(app_id, task_id)
+        lines = min(max(lines, 1), MAX_LOG_LINES)
+
+        def build():
+            try:
+                page = manager.get_task_log_page(app_id, task_id, lines, cursor)
+            except ValueError as e:
+                raise HTTPException(400, str(e))
+            return {'lines': page.lines, 'cursor': page.cursor}
+
+        return conditional(request, build, manager.events.log_version(app_id, task_id))
+
+    @router.get('/apps/{app_id}/tasks/{task_id}/logs/follow')
+    def follow_logs(app_id: str, task_id: str):
+        find_task(app_id, task_id)
+
+        async def stream():
+            # ends when the client disconnects and the response is cancelled
+            async for line in manager.follow_task_log(app_id, task_id):
+                yield f"{line}\n"
+
+        return StreamingResponse(stream(), media_type='text/plain')
+
+    @router.post('/apps/{app_id}/tasks/{task_id}/runs', status_code=202)
+    def trigger_task(request: Request, app_id: str, task_id: str):
+        app, task = find_task(app_id, task_id)
+        run_id = uuid.uuid4().hex
+        try:
+            manager.executor.submit_task(app, task, run_id)
+        except NotLeaseHolder as e:
+            raise HTTPException(409, str(e))
+        return {'run_id': run_id, 'status': 'queued',
+                'url': str(request.url_for(f"{route_prefix}get_run", run_id=run_id))}
+
+    @router.post('/apps/{app_id}/tasks/{task_id}/cancel')
+    def cancel_task(app_id: str, task_id: str):
+        find_task(app_id, task_id)
+        return {'cancelled': manager.executor.cancel_task(app_id, task_id)}
+
+    @router.get('/runs/{run_id}', name=f"{route_prefix}get_run")
+    def get_run(run_id: str):
+        run = manager.executor.get_run(run_id)
+        if run is None:
+            raise HTTPException(404, f"Unknown run: {run_id}")
+        return run.model_dump()
+
+    @router.post('/reconcile', status_code=202)
+    def reconcile(request: Request):
+        future = manager.request_reconcile()
+        # the run answering the request covers at least this generation
+        return {'generation': future.generation,
+                'url': str(request.url_for(f"{route_prefix}reconcile_status"))}
+
+    @router.get('/reconcile', name=f"{route_prefix}reconcile_status")
+    def reconcile_status():
+        queue = manager.reconcile_queue
+        return {
+            'generation': queue.generation,
+            'completed_generation': queue.completed_generation,
+            'running': queue.running,
+        }
+
+    @router.get('/lease')
+    def lease():
+        # a standby instance holds no state, it serves empty statuses until it takes over
+        return {'held': manager.lease.held, 'token': manager.lease.token,
+                'holder': manager.lease.holder}
+
+    return router
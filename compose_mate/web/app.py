@@ -1,93 +1,223 @@
-from asyncio import sleep
+import re
+from asyncio import CancelledError, sleep, wrap_future
+from typing import List
 
-import uvicorn
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from pywebio.output import *
 from pywebio.platform.fastapi import webio_routes
 
+from compose_mate.core.events import ALL
+from compose_mate.core.lease import NotLeaseHolder
+from compose_mate.core.metrics import REGISTRY
+from compose_mate.web.api import create_api
 
-class WebInterface:
-    def __init__(self, manager):
-        self.manager = manager
+# Minimum seconds between two redraws of a session, bursts of events are merged
+REDRAW_INTERVAL = 1
+# Lines of each task log shown in the page
+LOG_LINES = 100
 
-    async def index(self):
-        put_markdown("# Compose Mate")
 
-        while True:
-            clear('content')
+def _scope_name(*parts: str) -> str:
+    return re.sub(r'[^A-Za-z0-9_-]', '_', '-'.join(parts))
 
-            with use_scope('content'):
-                self._show_resource_tree()
 
-                put_buttons(
-                    ['Reconcile', 'Refresh'],
-                    onclick=[self._handle_reconcile, self._handle_refresh]
-                )
+class WebInterface:
+    def __init__(self, manager):
+        self.manager = manager
 
-            await sleep(5)  # refresh every 5 seconds
+    async def index(self):
+        name = self.manager.name
+        put_markdown(f"# Compose Mate: {name}" if name else "# Compose Mate")
+        put_buttons(
+            ['Reconcile', 'Refresh'],
+            onclick=[self._handle_reconcile, self._handle_refresh]
+        )
+        put_scope('content')
+
+        # redraw only the scopes touched by state changes, idle sessions just wait
+        subscription = self.manager.events.subscribe()
+        try:
+            self._show_resource_tree()
+            while True:
+                changes = await subscription.changes()
+                if ALL in changes:
+                    self._show_resource_tree()
+                else:
+                    self._update_scopes(changes)
+                await sleep(REDRAW_INTERVAL)
+        finally:
+            subscription.close()
 
     def _show_resource_tree(self):
-        apps = self.manager.load_config()
+        with use_scope('content', clear=True):
+            if not self.manager.lease.held:
+                put_warning("Standing by: another instance holds the lease of this repository "
+                            "and runs its apps and tasks")
+            for app in self.manager.config_store.snapshot().apps:
+                put_scope(_scope_name('app', app.id))
+                self._show_app(app)
+
+    def _update_scopes(self, changes):
+        snapshot = self.manager.config_store.snapshot()
+        apps_by_id, tasks_by_key = snapshot.apps_by_id, snapshot.tasks_by_key
+        for app_id, task_id in changes:
+            if app_id not in apps_by_id:
+                # app appeared or disappeared, the tree layout changed
+                self._show_resource_tree()
+                return
+            if task_id is None:
+                self._show_app_info(apps_by_id[app_id])
+            elif f"{app_id}_{task_id}" in tasks_by_key:
+                self._show_task(*tasks_by_key[f"{app_id}_{task_id}"])
+
+    def _show_app(self, app):
+        with use_scope(_scope_name('app', app.id), clear=True):
+            put_scope(_scope_name('app-info', app.id))
+            self._show_app_info(app)
+            for task in app.tasks:
+                put_scope(_scope_name('task', app.id, task.id))
+                self._show_task(app, task)
 
-        for app in apps:
-            app_state = self.manager.state.apps.get(app.id, {})
-            status = app_state.status if app_state else 'unknown'
-            last_reconcile = app_state.last_reconcile if app_state else 'never'
+    def _show_app_info(self, app):
+        app_state = self.manager.state.apps.get(app.id, {})
+        status = app_state.status if app_state else 'unknown'
+        last_reconcile = app_state.last_reconcile if app_state else 'never'
 
+        with use_scope(_scope_name('app-info', app.id), clear=True):
             put_markdown(f"## App: {app.id}")
             put_markdown(f"- Path: `{app.path}`")
             put_markdown(f"- Status: `{status}`")
             put_markdown(f"- Last Reconcile: `{last_reconcile}`")
-
-            for task in app.tasks:
-                task_state = self.manager.state.tasks.get(f"{app.id}_{task.id}", {})
-                task_status = task_state.status if task_state else 'unknown'
-                last_run = task_state.last_run if task_state else 'never'
-
-                put_markdown(f"### Task: {task.id}")
-                put_markdown(f"- Cron: `{task.cron}`")
-                put_markdown(f"- Status: `{task_status}`")
-                put_markdown(f"- Last Run: `{last_run}`")
-
-                log_content = self.manager.get_task_log(f"{app.id}_{task.id}")
-                if log_content:
-                    put_collapse(
-                        'View Logs',
-                        put_code(log_content, language='text')
-                    )
-
-                put_button(
-                    'Execute Now',
-                    onclick=lambda app_id=app.id, task_id=task.id: \
-                        self._handle_execute(app_id, task_id)
+            watcher = self.manager.container_watcher
+            services = watcher.service_states(app.id) if watcher else {}
+            if services:
+                put_markdown("- Services: " + ", ".join(
+                    f"`{service}` {state}" for service, state in sorted(services.items())
+                ))
+
+    def _show_task(self, app, task):
+        task_state = self.manager.state.tasks.get(f"{app.id}_{task.id}", {})
+        task_status = task_state.status if task_state else 'unknown'
+        last_run = task_state.last_run if task_state else 'never'
+
+        with use_scope(_scope_name('task', app.id, task.id), clear=True):
+            put_markdown(f"### Task: {task.id}")
+            put_markdown(f"- Cron: `{task.cron}`")
+            put_markdown(f"- Status: `{task_status}`")
+            put_markdown(f"- Last Run: `{last_run}`")
+            if task_state and task_state.steps:
+                put_markdown("- Steps: " + ", ".join(
+                    f"`{step.id}` {step.status} ({step.duration:.1f}s)" for step in task_state.steps
+                ))
+
+            executor = self.manager.executor
+            task_key = f"{app.id}_{task.id}"
+            queued, last_wait = executor.queued(task_key), executor.last_wait(task_key)
+            if queued:
+                put_markdown(f"- Queued: `{queued} run(s), {executor.queue.depth()} waiting in total`")
+            if last_wait is not None:
+                put_markdown(f"- Last Queue Wait: `{last_wait:.1f}s`")
+
+            log_content = self.manager.get_task_log(app.id, task.id, LOG_LINES)
+            if log_content:
+                put_collapse(
+                    f'View Logs (last {LOG_LINES} lines)',
+                    put_code(log_content, language='text')
                 )
 
-    def _handle_reconcile(self):
-        self.manager.reconcile()
+            put_buttons(
+                ['Execute Now', 'Cancel'],
+                onclick=[
+                    lambda app_id=app.id, task_id=task.id: self._handle_execute(app_id, task_id),
+                    lambda app_id=app.id, task_id=task.id: self._handle_cancel(app_id, task_id)
+                ]
+            )
+
+    async def _handle_reconcile(self):
+        # the session stays responsive while compose up runs
+        future = self.manager.request_reconcile()
+        toast("Reconciliation started")
+        try:
+            await wrap_future(future)
+        except Exception as e:
+            toast(f"Reconciliation failed: {e}", color='error')
+            return
         toast("Reconciliation completed")
 
     def _handle_refresh(self):
+        self._show_resource_tree()
         toast("Page refreshed")
 
-    def _handle_execute(self, app_id: str, task_id: str):
+    def _handle_cancel(self, app_id: str, task_id: str):
+        if self.manager.executor.cancel_task(app_id, task_id):
+            toast(f"Task {task_id} cancelled")
+        else:
+            toast(f"Task {task_id} is not running", color='warn')
+
+    async def _handle_execute(self, app_id: str, task_id: str):
         try:
-            apps = self.manager.load_config()
-            for app in apps:
-                if app.id == app_id:
-                    for task in app.tasks:
-                        if task.id == task_id:
-                            self.manager.executor.execute_task(app, task)
-                            toast(f"Task {task_id} executed successfully")
-                            return
-            toast(f"Task {task_id} not found", color='error')
+            found = self.manager.config_store.snapshot().tasks_by_key.get(f"{app_id}_{task_id}")
+            if found is None:
+                toast(f"Task {task_id} not found", color='error')
+                return
+            app, task = found
+            try:
+                future = self.manager.executor.submit_task(app, task)
+            except NotLeaseHolder as e:
+                toast(str(e), color='warn')
+                return
+            toast(f"Task {task_id} queued")
+            try:
+                await wrap_future(future)
+            except CancelledError:
+                if not future.done():
+                    # the session was closed
+                    raise
+                toast(f"Task {task_id} cancelled", color='warn')
+                return
+            toast(f"Task {task_id} executed successfully")
         except Exception as e:
             toast(f"Task execution failed: {str(e)}", color='error')
 
 
-def start_web_server(manager, port=8080):
-    web_interface = WebInterface(manager)
+def _overview(managers: List):
+    async def index():
+        put_markdown("# Compose Mate")
+        for manager in managers:
+            apps = manager.config_store.snapshot().apps
+            role = 'active' if manager.lease.held else 'standby'
+            put_markdown(f"- [{manager.name}](?app={manager.name}): `{manager.repo_path}`, "
+                         f"{len(apps)} app(s), {role}")
+    return index
+
+
+def create_app(managers: List) -> FastAPI:
+    """Serve the managers of a process, one repository at the root or several side by side.
 
+    With several repositories, each gets its page at `/?app=<name>` and its
+    API under `/api/v1/repos/<name>`.
+    """
     app = FastAPI()
-    app.mount("/", FastAPI(routes=webio_routes(web_interface.index)))
 
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    @app.get("/metrics", response_class=PlainTextResponse)
+    def metrics():
+        return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+    if len(managers) == 1:
+        app.include_router(create_api(managers[0]), prefix='/api/v1')
+        pages = WebInterface(managers[0]).index
+    else:
+        @app.get('/api/v1/repos')
+        def list_repos():
+            return [{'name': manager.name, 'path': str(manager.repo_path),
+                     'lease': manager.lease.held} for manager in managers]
+
+        for manager in managers:
+            app.include_router(create_api(manager), prefix=f'/api/v1/repos/{manager.name}')
+        pages = {'index': _overview(managers)}
+        pages.update({manager.name: WebInterface(manager).index for manager in managers})
+
+    # mounted last, it would shadow every route added after it
+    app.mount("/", FastAPI(routes=webio_routes(pages)))
+    return app
@@ -0,0 +1,62 @@
+import html
+import logging
+import threading
+from typing import Callable, List
+
+import uvicorn
+from starlette.responses import HTMLResponse
+
+from compose_mate.core.logging_utils import MAIN_LOGGER
+
+# Shown while the manager and the web interface are loading
+STARTING_PAGE = '''<!DOCTYPE html>
+<html>
+<head><meta http-equiv="refresh" content="1"><title>Compose Mate</title></head>
+<body><h1>Compose Mate</h1><p>{message}</p></body>
+</html>
+'''
+
+
+class _DeferredApp:
+    """ASGI app that answers right away and hands over to the real app once it is loaded.
+
+    Until then HTTP requests get a page that reloads itself every second and
+    websockets are closed, so browsers retry on their own.
+    """
+
+    def __init__(self):
+        self.app = None
+        self.error = None
+
+    async def __call__(self, scope, receive, send):
+        if self.app is not None:
+            await self.app(scope, receive, send)
+        elif scope['type'] == 'http':
+            message = f"Failed to start: {html.escape(str(self.error))}" if self.error else 'Starting...'
+            response = HTMLResponse(STARTING_PAGE.format(message=message),
+                                    status_code=503, headers={'Retry-After': '1'})
+            await response(scope, receive, send)
+        elif scope['type'] == 'websocket':
+            # 1013: try again later
+            await send({'type': 'websocket.close', 'code': 1013})
+
+
+def start_web_server(create_managers: Callable[[], List], port=8080):
+    """Serve the web interface, creating the managers while the server already answers.
+
+    The managers and the pywebio interface are imported and built on a
+    background thread, so the port is open before the slow imports are done.
+    """
+    deferred = _DeferredApp()
+
+    def load():
+        try:
+            managers = create_managers()
+            from compose_mate.web.app import create_app
+            deferred.app = create_app(managers)
+        except Exception as e:
+            logging.getLogger(MAIN_LOGGER).exception("Failed to start")
+            deferred.error = e
+
+    threading.Thread(target=load, name='cm-startup', daemon=True).start()
+    uvicorn.run(deferred, host="0.0.0.0", port=port, lifespan='off')
@@ -0,0 +1,217 @@
+import json
+import re
+import socketserver
+import struct
+import threading
+from http.server import BaseHTTPRequestHandler
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from compose_mate.core.docker_api import (API_VERSION, EXEC_MARKER_ENV, PROJECT_LABEL, SERVICE_LABEL,
+                                          DockerAPIError, DockerClient)
+
+CONTAINERS = [
+    {'Id': 'c1', 'Labels': {PROJECT_LABEL: 'shop', SERVICE_LABEL: 'web'}},
+    {'Id': 'c2', 'Labels': {PROJECT_LABEL: 'shop', SERVICE_LABEL: 'db'}},
+]
+
+
+def frame(stream_type: int, data: bytes) -> bytes:
+    return struct.pack('>BxxxL', stream_type, len(data)) + data
+
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    """Answers the few Engine API calls the client makes, like dockerd would."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, obj, status=200):
+        body = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        self.server.requests.append(('GET', url.path, parse_qs(url.query)))
+        if url.path == f'/{API_VERSION}/_ping':
+            self.send_response(200)
+            self.send_header('Content-Length', '2')
+            self.end_headers()
+            self.wfile.write(b'OK')
+        elif url.path == f'/{API_VERSION}/containers/json':
+            self._json(CONTAINERS)
+        elif re.fullmatch(f'/{API_VERSION}/exec/[^/]+/json', url.path):
+            instance = self.server.execs[url.path.split('/')[-2]]
+            running = instance['started'].is_set() and not instance['done'].is_set()
+            self._json({'Running': running, 'Pid': 4242, 'ExitCode': instance['exit_code']})
+        else:
+            self._json({'message': 'page not found'}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = json.loads(self.rfile.read(int(self.headers.get('Content-Length') or 0)) or b'null')
+        self.server.requests.append(('POST', url.path, body))
+        if url.path == f'/{API_VERSION}/containers/c1/exec':
+            exec_id = f"e{len(self.server.execs) + 1}"
+            self.server.execs[exec_id] = {'cmd': body['Cmd'], 'env': body.get('Env') or [],
+                                          'started': threading.Event(), 'done': threading.Event(),
+                                          'exit_code': None, 'killed': False}
+            self._json({'Id': exec_id}, 201)
+        elif re.fullmatch(f'/{API_VERSION}/exec/[^/]+/start', url.path):
+            instance = self.server.execs[url.path.split('/')[-2]]
+            # the connection is hijacked, output follows as multiplexed frames
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/vnd.docker.raw-stream')
+            self.send_header('Connection', 'Upgrade')
+            self.send_header('Upgrade', 'tcp')
+            self.end_headers()
+            instance['started'].set()
+            self._run(instance)
+            instance['done'].set()
+            self.close_connection = True
+        else:
+            self._json({'message': 'page not found'}, 404)
+
+    def _run(self, instance):
+        cmd = instance['cmd']
+        if cmd[0] == 'sleep':
+            # runs until killed
+            self.wfile.write(frame(1, b'sleeping\n'))
+            self.wfile.flush()
+            instance['done'].wait(10)
+            instance['exit_code'] = 137
+        elif cmd[:2] == ['sh', '-c'] and 'kill -KILL' in cmd[2]:
+            # the kill script, matches processes by the marker in their environment
+            for other in self.server.execs.values():
+                if any(f'"{env}"' in cmd[2] for env in other['env']):
+                    other['killed'] = True
+                    other['done'].set()
+            instance['exit_code'] = 0
+        else:
+            self.wfile.write(frame(1, b'hello\nwor'))
+            self.wfile.write(frame(2, b'oops\n'))
+            self.wfile.write(frame(1, b'ld\nno newline'))
+            self.wfile.flush()
+            instance['exit_code'] = 3
+
+
+class FakeDockerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path: str):
+        super().__init__(path, FakeDockerHandler)
+        self.requests = []
+        self.execs = {}
+
+
+@pytest.fixture
+def server(tmp_path):
+    server = FakeDockerServer(str(tmp_path / 'docker.sock'))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def client(server):
+    client = DockerClient(server.server_address, timeout=5)
+    yield client
+    client.close()
+
+
+def test_ping(client, tmp_path):
+    assert client.ping()
+    assert not DockerClient(str(tmp_path / 'missing.sock')).ping()
+
+
+def test_list_containers_filters_by_label(client, server):
+    assert client.list_containers([f"{PROJECT_LABEL}=shop"]) == CONTAINERS
+    _, _, params = server.requests[-1]
+    assert json.loads(params['filters'][0]) == {'label': [f"{PROJECT_LABEL}=shop"]}
+    assert params['all'] == ['0']
+
+
+def test_project_containers_groups_by_service(client):
+    services = client.project_containers('shop')
+    assert {service: [c['Id'] for c in items] for service, items in services.items()} == \
+        {'web': ['c1'], 'db': ['c2']}
+
+
+def test_requests_reuse_connections(client):
+    client.list_containers()
+    conn = client._pool.get_nowait()
+    client._pool.put_nowait(conn)
+    client.list_containers()
+    assert client._pool.get_nowait() is conn
+
+
+def test_exec_run_demultiplexes_output(client, server):
+    lines = []
+    exit_code = client.exec_run('c1', ['sh', '-c', 'false'],
+                                lambda line, is_stderr: lines.append((line, is_stderr)))
+
+    assert exit_code == 3
+    # lines split across frames are joined, stdout and stderr are kept apart
+    assert lines == [('hello', False), ('oops', True), ('world', False), ('no newline', False)]
+    method, path, body = server.requests[0]
+    assert (method, path) == ('POST', f'/{API_VERSION}/containers/c1/exec')
+    assert body['Cmd'] == ['sh', '-c', 'false']
+
+
+def test_exec_run_unknown_container(client):
+    with pytest.raises(DockerAPIError) as excinfo:
+        client.exec_run('missing', ['true'], lambda line, is_stderr: None)
+    assert excinfo.value.status == 404
+
+
+def test_exec_run_timeout_kills_the_process(client, server):
+    lines = []
+    with pytest.raises(TimeoutError):
+        client.exec_run('c1', ['sleep', '30'], lambda line, is_stderr: lines.append(line), timeout=0.5)
+
+    assert lines == ['sleeping']
+    sleeper, killer = server.execs['e1'], server.execs['e2']
+    assert sleeper['killed']
+    assert len(sleeper['env']) == 1 and sleeper['env'][0].startswith(f"{EXEC_MARKER_ENV}=")
+    # the kill runs inside the container and isn't marked itself
+    assert killer['cmd'][:2] == ['sh', '-c'] and killer['env'] == []
+
+
+def test_exec_cancel_kills_the_process_and_ends_run(client, server):
+    handle = client.exec_create('c1', ['sleep', '30'])
+    errors = []
+
+    def run():
+        try:
+            handle.run(lambda line, is_stderr: None)
+        except DockerAPIError as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert server.execs['e1']['started'].wait(5)
+    handle.cancel()
+    thread.join(5)
+
+    assert not thread.is_alive()
+    assert [str(e) for e in errors] == ['exec cancelled']
+    assert server.execs['e1']['killed']
+
+
+def test_exec_kill_skips_finished_processes(client, server):
+    handle = client.exec_create('c1', ['true'])
+    assert handle.run(lambda line, is_stderr: None) == 3
+    handle.kill()
+    assert list(server.execs) == ['e1']
@@ -0,0 +1,80 @@
+from pathlib import Path
+
+from compose_mate.core.compose_model import ComposeModelCache, load_compose_model
+from compose_mate.core.fingerprint import HashCache, app_fingerprint, find_compose_files
+from compose_mate.core.models import AppConfig
+from compose_mate.core.watcher import AppPathIndex
+
+APP = AppConfig(id='shop', path='shop', tasks=[])
+
+
+def write(path: Path, content: str):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_compose_override_yaml_changes_the_fingerprint(tmp_path):
+    write(tmp_path / 'shop' / 'compose.yaml', 'services: {web: {image: nginx}}\n')
+    write(tmp_path / 'shop' / 'compose.override.yaml', 'services: {web: {ports: ["80:80"]}}\n')
+    before = app_fingerprint(tmp_path, APP)
+
+    write(tmp_path / 'shop' / 'compose.override.yaml', 'services: {web: {ports: ["81:80"]}}\n')
+    assert app_fingerprint(tmp_path, APP) != before
+
+
+def test_only_files_compose_loads_are_fingerprinted(tmp_path):
+    app_path = tmp_path / 'shop'
+    write(app_path / 'compose.yaml', 'services: {web: {image: nginx}}\n')
+    write(app_path / 'docker-compose.yml', 'services: {web: {image: httpd}}\n')
+    write(app_path / 'docker-compose.override.yml', 'services: {web: {ports: ["80:80"]}}\n')
+    write(app_path / '.env', 'TAG=1\n')
+    assert [path.name for path in find_compose_files(app_path)] == \
+        ['compose.yaml', 'docker-compose.override.yml', '.env']
+    assert load_compose_model(app_path).services['web']['image'] == 'nginx'
+
+    # docker-compose.yml is shadowed by compose.yaml, editing it changes nothing
+    before = app_fingerprint(tmp_path, APP)
+    write(app_path / 'docker-compose.yml', 'services: {web: {image: caddy}}\n')
+    assert app_fingerprint(tmp_path, APP) == before
+
+
+def fingerprint(repo: Path, models: ComposeModelCache):
+    """Fingerprint and service hashes of the app, as the manager computes them."""
+    model = models.get(repo / APP.path)
+    return app_fingerprint(repo, APP, extra_files=model.extra_files), model.hashes
+
+
+def test_extends_file_is_fingerprinted_and_routed(tmp_path):
+    write(tmp_path / 'shop' / 'compose.yaml',
+          'services: {web: {extends: {file: ../common/base.yaml, service: base}}}\n')
+    write(tmp_path / 'common' / 'base.yaml', 'services: {base: {image: nginx}}\n')
+    models = ComposeModelCache(HashCache())
+    before, hashes = fingerprint(tmp_path, models)
+
+    write(tmp_path / 'common' / 'base.yaml', 'services: {base: {image: nginx:2}}\n')
+    after, new_hashes = fingerprint(tmp_path, models)
+    assert after != before
+    assert new_hashes['web'] != hashes['web']
+
+    index = AppPathIndex(tmp_path, [APP], models)
+    assert index.lookup('common/base.yaml') == {'shop'}
+    assert index.lookup('common/other.yaml') == set()
+
+
+def test_env_file_is_fingerprinted_and_routed(tmp_path):
+    write(tmp_path / 'shop' / 'compose.yaml',
+          'services:\n'
+          '  web: {image: nginx, env_file: ../config/web.env}\n'
+          '  db: {image: postgres}\n')
+    write(tmp_path / 'config' / 'web.env', 'MODE=a\n')
+    models = ComposeModelCache(HashCache())
+    before, hashes = fingerprint(tmp_path, models)
+
+    write(tmp_path / 'config' / 'web.env', 'MODE=b\n')
+    after, new_hashes = fingerprint(tmp_path, models)
+    assert after != before
+    # only the service reading the env file is recreated
+    assert new_hashes['web'] != hashes['web']
+    assert new_hashes['db'] == hashes['db']
+
+    assert AppPathIndex(tmp_path, [APP], models).lookup('config/web.env') == {'shop'}
@@ -0,0 +1,152 @@
+import queue
+import subprocess
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import pytest
+import yaml
+
+from compose_mate.core.git_source import git
+from compose_mate.core.manager import ComposeManager
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    for key, value in (('GIT_AUTHOR_NAME', 'test'), ('GIT_AUTHOR_EMAIL', 'test@example.com'),
+                       ('GIT_COMMITTER_NAME', 'test'), ('GIT_COMMITTER_EMAIL', 'test@example.com'),
+                       ('GIT_CONFIG_GLOBAL', '/dev/null')):
+        monkeypatch.setenv(key, value)
+    repo = tmp_path / 'repo'
+    subprocess.run(['git', 'init', '-q', '-b', 'main', str(repo)], check=True)
+    (repo / '.cm.yaml').write_text(yaml.safe_dump({'apps': [
+        {'id': 'shop', 'path': 'shop', 'tasks': []},
+        {'id': 'blog', 'path': 'blog', 'tasks': []},
+    ]}))
+    for app in ('shop', 'blog'):
+        (repo / app).mkdir()
+        (repo / app / 'docker-compose.yml').write_text('services: {}\n')
+    (repo / 'shop' / 'api').mkdir()
+    (repo / 'shop' / 'api' / 'Dockerfile').write_text('FROM scratch\n')
+    commit(repo, 'initial')
+    return repo
+
+
+def commit(repo, message):
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', message)
+    return git(repo, 'rev-parse', 'HEAD').strip()
+
+
+@contextmanager
+def unnoticed(manager: ComposeManager):
+    """Keep the manager's watch from checking HEAD until the block is done."""
+    with manager.git_source._lock:
+        yield
+
+
+class QueuedReconciles:
+    """Stands in for the manager's reconcile queue, records what is requested."""
+
+    def __init__(self, manager: ComposeManager):
+        self.manager = manager
+        self.requests: queue.Queue = queue.Queue()
+
+    def request(self, changed_paths=None) -> Future:
+        self.requests.put(changed_paths)
+        future = Future()
+        future.set_result(0)
+        return future
+
+    def next_apps(self, timeout: float = 5):
+        """Return the apps the next requested reconcile covers, None for all of them."""
+        return self.manager._affected_apps(self.requests.get(timeout=timeout))
+
+    def empty(self) -> bool:
+        return self.requests.empty()
+
+
+@pytest.fixture
+def manager(repo, tmp_path):
+    manager = ComposeManager(str(repo), str(tmp_path / 'state'), docker_backend='cli',
+                             change_source='git', watch_quiet_window=0.05, watch_max_delay=0.5)
+    manager.startup_reconcile.result(timeout=30)
+    yield manager
+    manager.stop()
+
+
+@pytest.fixture
+def reconciles(manager):
+    reconciles = QueuedReconciles(manager)
+    manager.reconcile_queue.request = reconciles.request
+    return reconciles
+
+
+def test_commit_queues_only_touched_apps(repo, manager, reconciles):
+    (repo / 'shop' / 'api' / 'Dockerfile').write_text('FROM busybox\n')
+    commit(repo, 'shop api')
+    manager.git_source.check()
+    assert reconciles.next_apps() == {'shop'}
+
+
+def test_uncommitted_and_unrelated_changes_queue_nothing(repo, manager, reconciles):
+    # edits to the working tree aren't seen until they are committed
+    (repo / 'blog' / 'docker-compose.yml').write_text('services: {web: {image: nginx}}\n')
+    manager.git_source.check()
+    git(repo, 'stash', '-q')
+    # paths outside every app are dropped before they reach the queue
+    (repo / 'README.md').write_text('hello\n')
+    commit(repo, 'readme')
+    manager.git_source.check()
+    assert manager.change_coalescer.pending() == 0
+    time.sleep(0.2)
+    assert reconciles.empty()
+
+
+def test_config_change_queues_every_app(repo, manager, reconciles):
+    (repo / '.cm.yaml').write_text(yaml.safe_dump({'apps': [
+        {'id': 'shop', 'path': 'shop', 'tasks': []},
+    ]}))
+    commit(repo, 'drop blog')
+    manager.git_source.check()
+    assert reconciles.next_apps() is None
+
+
+def test_head_moved_back_covers_all_commits_in_between(repo, manager, reconciles):
+    initial = manager.git_source.head
+    with unnoticed(manager):
+        (repo / 'shop' / 'docker-compose.yml').write_text('services: {web: {image: nginx}}\n')
+        commit(repo, 'shop')
+        (repo / 'blog' / 'docker-compose.yml').write_text('services: {web: {image: nginx}}\n')
+        commit(repo, 'blog')
+    manager.git_source.check()
+    assert reconciles.next_apps() == {'shop', 'blog'}
+
+    git(repo, 'reset', '-q', '--hard', initial)
+    manager.git_source.check()
+    assert reconciles.next_apps() == {'shop', 'blog'}
+
+
+def test_checkout_of_another_branch(repo, manager, reconciles):
+    with unnoticed(manager):
+        git(repo, 'checkout', '-q', '-b', 'feature')
+        (repo / 'blog' / 'docker-compose.yml').write_text('services: {web: {image: nginx}}\n')
+        commit(repo, 'blog')
+    manager.git_source.check()
+    assert reconciles.next_apps() == {'blog'}
+
+    git(repo, 'checkout', '-q', 'main')
+    manager.git_source.check()
+    assert reconciles.next_apps() == {'blog'}
+
+
+def test_rewritten_history_falls_back_to_a_full_reconcile(repo, manager, reconciles):
+    dropped = manager.git_source.head
+    with unnoticed(manager):
+        git(repo, 'commit', '-q', '--amend', '-m', 'rewritten')
+        # the old commit is gone once it is pruned, the changes can't be diffed
+        git(repo, 'reflog', 'expire', '--expire=now', '--all')
+        git(repo, 'gc', '-q', '--prune=now')
+    assert subprocess.run(['git', 'cat-file', '-e', dropped], cwd=repo).returncode != 0
+    manager.git_source.check()
+    assert reconciles.next_apps() is None